@@ -0,0 +1,119 @@
+"""
+Local HTTP server that answers like Bing: HPImageArchive XML and image variants.
+"""
+import datetime
+import http.server
+import io
+import sys
+import threading
+import urllib.parse
+
+URLBASE = '/th?id=OHR.BenchmarkFixture_EN-US0000000000'
+# Variants the stand-in serves, the others are missing like on Bing
+VARIANTS = {'UHD': (3840, 2160), '1920x1080': (1920, 1080), '1366x768': (1366, 768), '1280x720': (1280, 720)}
+
+
+def make_jpeg(width: int, height: int):
+    """
+    A smooth gradient, so the JPEG has a realistic size for a photo of its resolution.
+    """
+    import numpy as np
+    from PIL import Image
+
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = np.stack([255 * x / width, 255 * y / height, 128 + 64 * np.sin(x / 37) * np.cos(y / 23)], axis=-1)
+    f = io.BytesIO()
+    Image.fromarray(image.clip(0, 255).astype(np.uint8)).save(f, 'JPEG', quality=90)
+    return f.getvalue()
+
+
+def make_archive_xml(now: datetime.datetime = None):
+    now = datetime.datetime.now(datetime.timezone.utc) if now is None else now
+    start = now.replace(hour=8, minute=0, second=0, microsecond=0)
+    if start > now:
+        start -= datetime.timedelta(days=1)
+    end = start + datetime.timedelta(days=1)
+    return (
+        '<?xml version="1.0" encoding="utf-8" ?><images><image>'
+        f'<startdate>{start:%Y%m%d}</startdate><fullstartdate>{start:%Y%m%d%H%M}</fullstartdate>'
+        f'<enddate>{end:%Y%m%d}</enddate>'
+        f'<url>{URLBASE}_1920x1080.jpg&amp;rf=LaDigue_1920x1080.jpg&amp;pid=hp</url>'
+        f'<urlBase>{URLBASE}</urlBase>'
+        '<copyright>Benchmark fixture (© Nobody)</copyright><copyrightlink>https://example.com</copyrightlink>'
+        '<headline>Benchmark fixture</headline><hsh>0123456789abcdef0123456789abcdef</hsh>'
+        '</image></images>'
+    ).encode('utf-8')
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # As in mirror.Handler
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def get_body(self):
+        """
+        :return: (status, content type, body)
+        """
+        parts = urllib.parse.urlsplit(self.path)
+        if parts.path == '/HPImageArchive.aspx':
+            return 200, 'text/xml; charset=utf-8', self.server.archive_xml
+        if parts.path == '/th':
+            image_id = urllib.parse.parse_qs(parts.query).get('id', [''])[0]
+            variant = image_id.rsplit('_', 1)[-1].removesuffix('.jpg')
+            if variant in self.server.images:
+                return 200, 'image/jpeg', self.server.images[variant]
+            return 404, 'text/plain', b'Not found'
+        return 200, 'text/html', b'<html></html>'
+
+    def respond(self, send_body: bool):
+        status, content_type, body = self.get_body()
+        self.server.requests += 1
+        self.server.first_request.set()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', f'"{hash(body) & 0xffffffff:08x}"')
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+            self.server.bytes_sent += len(body)
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+
+class BingStandIn(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.archive_xml = make_archive_xml()
+        self.images = {variant: make_jpeg(*size) for variant, size in VARIANTS.items()}
+        self.requests = 0
+        self.bytes_sent = 0
+        self.first_request = threading.Event()
+        self.thread = None
+
+    def handle_error(self, request, client_address):
+        # Clients killed mid-request, as by the startup benchmark, are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
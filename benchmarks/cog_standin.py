@@ -0,0 +1,110 @@
+"""
+Local HTTP server that answers like a cog worker of arbsr-cpu: health check and predictions.
+"""
+import base64
+import http.server
+import io
+import json
+import sys
+import threading
+
+# How a stand-in answers a prediction
+MODES = ['ok', 'truncated', 'garbage']
+
+
+def upscale(data_uri: str, target_width: int, target_height: int):
+    """
+    Bilinear resize of a data URI image.
+
+    :return: Data URI of the PNG.
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(base64.b64decode(data_uri.partition(',')[2]))) as image:
+        f = io.BytesIO()
+        image.resize((target_width, target_height), Image.Resampling.BILINEAR).save(f, 'PNG', compress_level=1)
+    return 'data:image/png;base64,' + base64.b64encode(f.getvalue()).decode('ascii')
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status: int, body: bytes, content_length: int = None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body) if content_length is None else content_length))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health-check':
+            status = 'READY' if self.server.ready.is_set() else 'STARTING'
+            self.send_body(200, json.dumps({'status': status}).encode('utf-8'))
+        else:
+            self.send_body(404, b'{}')
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.path != '/predictions':
+            self.send_body(404, b'{}')
+            return
+        # One prediction at a time, like cog
+        if not self.server.busy.acquire(blocking=False):
+            self.server.rejected += 1
+            self.send_body(409, b'{"detail": "Already running a prediction"}')
+            return
+        try:
+            if self.server.mode == 'truncated':
+                # The worker dies halfway through its response
+                self.send_body(200, b'{"status": "succ', content_length=1024)
+                self.close_connection = True
+                return
+            if self.server.mode == 'garbage':
+                self.send_body(200, b'<html>Bad Gateway</html>')
+                return
+            self.server.hold.wait()
+            output = upscale(request['input']['image'], request['input']['target_width'],
+                             request['input']['target_height'])
+            self.server.predictions += 1
+            self.send_body(200, json.dumps({'status': 'succeeded', 'output': output}).encode('utf-8'))
+        finally:
+            self.server.busy.release()
+
+
+class CogStandIn(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, mode: str = 'ok'):
+        assert mode in MODES
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.mode = mode
+        self.ready = threading.Event()
+        self.ready.set()
+        # Cleared to keep a prediction running, so the worker stays busy
+        self.hold = threading.Event()
+        self.hold.set()
+        self.busy = threading.Lock()
+        self.predictions = 0
+        self.rejected = 0
+        self.thread = None
+
+    def handle_error(self, request, client_address):
+        # Clients that give up on a truncated response are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
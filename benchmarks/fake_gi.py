@@ -0,0 +1,205 @@
+"""
+Stand-ins for the parts of PyGObject (Gio, Gdk, Gtk, Notify, GLib) the program uses.
+
+install() registers them in sys.modules, so main.py can be imported and run
+without a desktop session.
+"""
+import sys
+import threading
+import types
+
+
+class Signals:
+    def __init__(self):
+        self.handlers = {}
+
+    def connect(self, signal, callback, *args):
+        handler = len(self.handlers) + 1
+        self.handlers[handler] = (signal, callback)
+        return handler
+
+    def disconnect(self, handler):
+        self.handlers.pop(handler, None)
+
+    def emit(self, signal, *args):
+        for handler_signal, callback in list(self.handlers.values()):
+            if handler_signal == signal:
+                callback(self, *args)
+
+
+class Settings:
+    # Shared between instances, like the real dconf database
+    values = {}
+
+    def __init__(self, schema):
+        self.schema = schema
+
+    @classmethod
+    def new(cls, schema):
+        return cls(schema)
+
+    def get_string(self, key):
+        return self.values.get((self.schema, key), '')
+
+    def set_string(self, key, value):
+        self.values[(self.schema, key)] = value
+        return True
+
+    def apply(self):
+        pass
+
+    def delay(self):
+        pass
+
+
+class SettingsSchemaSource:
+    @staticmethod
+    def get_default():
+        return SettingsSchemaSource()
+
+    def lookup(self, schema, recursive):
+        return None
+
+
+class NetworkMonitor(Signals):
+    _default = None
+
+    @classmethod
+    def get_default(cls):
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def __init__(self):
+        super().__init__()
+        self.available = True
+
+    def get_network_available(self):
+        return self.available
+
+    def set_network_available(self, available: bool):
+        """
+        Go offline or online, like a real monitor when a connection drops or comes up.
+        """
+        self.available = available
+        self.emit('network-changed', available)
+
+    def get_network_metered(self):
+        return False
+
+
+class Rectangle:
+    def __init__(self, x, y, width, height):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+
+class Screen(Signals):
+    monitors = [(0, 0, 1920, 1080)]
+    _default = None
+
+    @classmethod
+    def get_default(cls):
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def get_n_monitors(self):
+        return len(self.monitors)
+
+    def get_monitor_geometry(self, m):
+        return Rectangle(*self.monitors[m])
+
+    def get_monitor_scale_factor(self, m):
+        return 1
+
+    def get_width(self):
+        return max(x + width for x, _, width, _ in self.monitors)
+
+    def get_height(self):
+        return max(y + height for _, y, _, height in self.monitors)
+
+
+class Notification:
+    shown = []
+
+    @classmethod
+    def new(cls, summary, body, icon):
+        notification = cls()
+        notification.summary = summary
+        notification.body = body
+        return notification
+
+    def show(self):
+        self.shown.append((self.summary, self.body))
+
+
+class MainLoop:
+    """
+    Runs until quit() is called, from a timeout or a signal handler on any thread.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+
+    def run(self):
+        self.done.wait()
+        self.done.clear()
+
+    def quit(self):
+        self.done.set()
+
+
+_timers = {}
+
+
+def timeout_add(interval, callback, *args):
+    timer = threading.Timer(interval / 1000, lambda: _timers.pop(source, None) and callback(*args))
+    source = id(timer)
+    _timers[source] = timer
+    timer.start()
+    return source
+
+
+def source_remove(source):
+    timer = _timers.pop(source, None)
+    if timer is not None:
+        timer.cancel()
+    return True
+
+
+def install():
+    """
+    Register the stand-ins as gi and gi.repository.* in sys.modules.
+    """
+    gi = types.ModuleType('gi')
+    gi.require_version = lambda namespace, version: None
+    repository = types.ModuleType('gi.repository')
+    gi.repository = repository
+
+    Gio = types.ModuleType('gi.repository.Gio')
+    Gio.Settings = Settings
+    Gio.SettingsSchemaSource = SettingsSchemaSource
+    Gio.NetworkMonitor = NetworkMonitor
+
+    Gdk = types.ModuleType('gi.repository.Gdk')
+    Gdk.Screen = Screen
+
+    Gtk = types.ModuleType('gi.repository.Gtk')
+
+    Notify = types.ModuleType('gi.repository.Notify')
+    Notify.init = lambda app_name: True
+    Notify.Notification = Notification
+
+    GLib = types.ModuleType('gi.repository.GLib')
+    GLib.MainLoop = MainLoop
+    GLib.timeout_add = timeout_add
+    GLib.source_remove = source_remove
+
+    for name, module in (('Gio', Gio), ('Gdk', Gdk), ('Gtk', Gtk), ('Notify', Notify), ('GLib', GLib)):
+        setattr(repository, name, module)
+        sys.modules[f'gi.repository.{name}'] = module
+    sys.modules['gi'] = gi
+    sys.modules['gi.repository'] = repository
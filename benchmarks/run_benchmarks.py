@@ -0,0 +1,593 @@
+#!/usr/bin/python3
+"""
+Offline benchmarks of bing-desktop-wallpaper-changer.
+
+Runs main() end to end against a local Bing stand-in with GTK, GIO and
+libnotify replaced by fakes, the startup of main.py up to its first network
+request, waiting for the network, the LAN mirror up and down, the archive index at 1k/10k/100k files and the tiled upscaler with a
+fake upscaling backend, its peak memory on an 8K target, the encodings of its
+output and the worker backend against stand-in cog workers. Results are written as JSON, so the numbers of two commits can be
+compared with --compare.
+
+    python3 benchmarks/run_benchmarks.py --output before.json
+    python3 benchmarks/run_benchmarks.py --output after.json --compare before.json
+"""
+import argparse
+import configparser
+import functools
+import json
+import math
+import os
+import pathlib
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+DIRECTORY_BENCHMARKS = pathlib.Path(__file__).resolve().parent
+DIRECTORY_BIN = DIRECTORY_BENCHMARKS.parent / 'bin'
+
+
+def fake_upscale(path_input, target_width: int, target_height: int, directory_working='/tmp'):
+    """
+    Upscaling backend with the interface of upscale_arbsr, doing a bilinear resize.
+    """
+    from PIL import Image
+
+    path_output = pathlib.Path(directory_working) / 'output.png'
+    with Image.open(path_input) as image:
+        image.resize((target_width, target_height), Image.Resampling.BILINEAR).save(path_output, compress_level=1)
+    return path_output
+
+
+def summarize(seconds):
+    return {'seconds': seconds, 'min': min(seconds), 'median': statistics.median(seconds)}
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=DIRECTORY_BENCHMARKS,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def set_config(path_config: pathlib.Path, section: str, key: str, value):
+    config = configparser.ConfigParser()
+    config.read(path_config)
+    if not config.has_section(section):
+        config.add_section(section)
+    config.set(section, key, str(value))
+    with open(path_config, 'w') as f:
+        config.write(f)
+
+
+def setup_environment(directory_root: pathlib.Path):
+    """
+    Point HOME and the XDG pictures directory at a scratch directory and import main with fake gi modules.
+    """
+    directory_home = directory_root / 'home'
+    directory_pictures = directory_home / 'Pictures'
+    directory_pictures.mkdir(parents=True)
+    directory_path_bin = directory_root / 'path'
+    directory_path_bin.mkdir()
+    path_xdg_user_dir = directory_path_bin / 'xdg-user-dir'
+    path_xdg_user_dir.write_text(f'#!/bin/sh\necho {directory_pictures}\n')
+    path_xdg_user_dir.chmod(0o755)
+    (directory_home / '.config').mkdir()
+    (directory_home / '.config/user-dirs.dirs').write_text('XDG_PICTURES_DIR="$HOME/Pictures"\n')
+
+    os.environ['HOME'] = str(directory_home)
+    os.environ['PATH'] = f'{directory_path_bin}{os.pathsep}{os.environ.get("PATH", "")}'
+
+    sys.path.insert(0, str(DIRECTORY_BENCHMARKS))
+    sys.path.insert(0, str(DIRECTORY_BIN))
+    import fake_gi
+    fake_gi.install()
+
+    import main
+    return main
+
+
+def reset_process_state(main):
+    """
+    Drop what a fresh process wouldn't have: pooled connections and cached screen layout.
+    """
+    import http_pool
+    import pipeline
+    import screen_layout
+
+    http_pool.close_all()
+    pipeline.shutdown_lanes()
+    screen_layout._monitors = None
+
+
+def read_phases(path_log: pathlib.Path):
+    """
+    :return: Dict of phase name to seconds, summed over the spans in a timing log.
+    """
+    phases = {}
+    with open(path_log) as f:
+        for line in f:
+            span = json.loads(line)
+            if span['name'] != 'run':
+                phases[span['name']] = phases.get(span['name'], 0) + span['seconds']
+    return phases
+
+
+def benchmark_main(main, repeat: int):
+    """
+    End-to-end main(): a cold run that downloads the image, and a warm run that finds everything cached.
+    """
+    import bing_standin
+
+    path_config = main.get_config_file()
+    path_log = main.get_config_dir() / 'timing.jsonl'
+    set_config(path_config, 'timing', 'log', path_log)
+    results = {}
+
+    with bing_standin.BingStandIn() as standin:
+        main.BING_URL = standin.url
+        for name, cold in (('main.cold', True), ('main.warm', False)):
+            seconds = []
+            phases = []
+            for _ in range(repeat):
+                if cold:
+                    shutil.rmtree(main.get_download_path(), ignore_errors=True)
+                    main.get_metadata_cache_file().unlink(missing_ok=True)
+                    main.get_image_variants_file().unlink(missing_ok=True)
+                reset_process_state(main)
+                path_log.unlink(missing_ok=True)
+
+                time_start = time.perf_counter()
+                try:
+                    main.main(False, 'gnome', False)
+                except SystemExit as err:
+                    assert not err.code, f'main() exited with {err.code}'
+                seconds.append(time.perf_counter() - time_start)
+                phases.append(read_phases(path_log))
+
+            results[name] = summarize(seconds)
+            results[name]['phases'] = {
+                phase: statistics.median(run.get(phase, 0) for run in phases)
+                for phase in sorted(set().union(*phases))
+            }
+    return results
+
+
+STARTUP_SCRIPT = """
+import sys
+sys.path[:0] = [{bin!r}, {benchmarks!r}]
+try:
+    import gi
+    from gi.repository import Gio
+except ImportError:
+    import fake_gi
+    fake_gi.install()
+sys.argv = ['main.py', '-d', 'fake']
+import runpy
+runpy.run_path({main!r}, run_name='__main__')
+"""
+
+
+def benchmark_startup(main, repeat: int):
+    """
+    Time from starting main.py to its first network request, with an expired metadata cache.
+
+    The real gi modules are used if they are installed, so their import time is included.
+    """
+    import bing_standin
+
+    script = STARTUP_SCRIPT.format(bin=str(DIRECTORY_BIN), benchmarks=str(DIRECTORY_BENCHMARKS),
+                                   main=str(DIRECTORY_BIN / 'main.py'))
+    path_config = main.get_config_file()
+    seconds = []
+    with bing_standin.BingStandIn() as standin:
+        set_config(path_config, 'network', 'upstream', standin.url)
+        try:
+            for _ in range(repeat):
+                main.get_metadata_cache_file().unlink(missing_ok=True)
+                standin.first_request.clear()
+                time_start = time.perf_counter()
+                process = subprocess.Popen([sys.executable, '-c', script],
+                                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                try:
+                    assert standin.first_request.wait(60), 'main.py made no request'
+                    seconds.append(time.perf_counter() - time_start)
+                finally:
+                    process.kill()
+                    process.wait()
+        finally:
+            set_config(path_config, 'network', 'upstream', '')
+    return {'startup.first_request': summarize(seconds)}
+
+
+def benchmark_network(main, repeat: int):
+    """
+    Waiting for the network with the fake network monitor, and the LAN mirror
+    in front of the Bing stand-in, up and down.
+
+    :raises AssertionError: If the backoff isn't capped, going online doesn't end
+        the wait, the mirror doesn't serve from its cache or a dead mirror isn't
+        left for Bing right away.
+    """
+    import bing_standin
+    import connectivity
+    import http_pool
+    import mirror
+    from gi.repository import Gio
+
+    results = {}
+    monitor = Gio.NetworkMonitor.get_default()
+
+    # The backoff stays within its cap, also after an attempt count that overflows 2 ** attempt as a float
+    for attempt in (0, 5, 100, 5000):
+        assert 0 <= connectivity.get_backoff(attempt) <= connectivity.BACKOFF_MAX
+
+    # With the network up, a failing probe is retried with exponential backoff and jitter
+    probes = []
+
+    def flaky_probe(url, timeout):
+        probes.append(time.perf_counter())
+        return len(probes) > 4
+
+    connectivity.wait_for_connection('http://unused.invalid', 30, monitor, probe=flaky_probe, use_glib=True)
+    delays = [later - earlier for earlier, later in zip(probes, probes[1:])]
+    assert len(probes) == 5 and all(delay <= connectivity.BACKOFF_BASE * 2 ** i + 0.1
+                                    for i, delay in enumerate(delays)), delays
+
+    with bing_standin.BingStandIn() as standin:
+        main.BING_URL = standin.url
+
+        # Offline, the wait sleeps until the monitor reports the network
+        seconds = []
+        for _ in range(repeat):
+            monitor.set_network_available(False)
+            timer = threading.Timer(0.5, monitor.set_network_available, (True,))
+            timer.start()
+            time_start = time.perf_counter()
+            connectivity.wait_for_connection(standin.url, 30, monitor, use_glib=True)
+            seconds.append(time.perf_counter() - time_start - 0.5)
+            timer.join()
+        results['connectivity.wakeup'] = summarize(seconds)
+        assert results['connectivity.wakeup']['median'] < 0.5
+
+        path_config = main.get_config_file()
+        with tempfile.TemporaryDirectory() as directory_cache:
+            # Like main.py --serve
+            main.init_dir(main.get_download_path())
+            server = mirror.MirrorServer(('127.0.0.1', 0), main.get_download_path(), directory_cache,
+                                         pathlib.Path(directory_cache) / 'metadata.json', standin.url)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            try:
+                # The second client of the mirror gets the image from its cache, not from Bing
+                url = f'{server.url}{bing_standin.URLBASE}_1920x1080.jpg'
+                assert http_pool.fetch(url).body == standin.images['1920x1080']
+                requests = standin.requests
+                seconds = []
+                for _ in range(repeat):
+                    http_pool.close_all()
+                    time_start = time.perf_counter()
+                    assert http_pool.fetch(url).body == standin.images['1920x1080']
+                    seconds.append(time.perf_counter() - time_start)
+                assert standin.requests == requests, 'the mirror fetched a cached image again'
+                results['mirror.cached_image'] = summarize(seconds)
+                url_mirror = server.url
+            finally:
+                # An idle keep-alive connection would hold a worker of the mirror until it times out
+                http_pool.close_all()
+                server.shutdown()
+                server.server_close()
+
+        # The mirror is gone now, the run falls back to Bing without waiting for the connection timeout
+        set_config(path_config, 'network', 'upstream', url_mirror)
+        try:
+            seconds = []
+            for _ in range(repeat):
+                main.get_metadata_cache_file().unlink(missing_ok=True)
+                reset_process_state(main)
+                time_start = time.perf_counter()
+                try:
+                    main.main(True, 'gnome', False)
+                except SystemExit as err:
+                    assert not err.code, f'main() exited with {err.code}'
+                seconds.append(time.perf_counter() - time_start)
+                assert main._mirror_failed, 'the dead mirror was not left for Bing'
+        finally:
+            set_config(path_config, 'network', 'upstream', '')
+        results['main.mirror_down'] = summarize(seconds)
+        assert results['main.mirror_down']['median'] < main.get_connection_timeout() / 2
+    return results
+
+
+def benchmark_directory(main, sizes, repeat: int):
+    """
+    p2_dirscan and check_limit on download directories of different sizes.
+    """
+    path_config = main.get_config_file()
+    results = {}
+    for size in sizes:
+        directory = pathlib.Path(os.environ['HOME']) / f'dirscan-{size}'
+        directory.mkdir()
+        for i in range(size):
+            (directory / f'{19000101 + i:08d}.jpg').touch()
+        set_config(path_config, 'directory', 'dir_path', directory)
+        set_config(path_config, 'directory', 'dir_max_size', -1)
+
+        seconds = []
+        for _ in range(repeat):
+            time_start = time.perf_counter()
+            main.p2_dirscan(directory)
+            seconds.append(time.perf_counter() - time_start)
+        results[f'p2_dirscan.{size}'] = summarize(seconds)
+
+        cold, warm, added = [], [], []
+        for i in range(repeat):
+            shutil.rmtree(directory / '.bdwc', ignore_errors=True)
+            time_start = time.perf_counter()
+            main.check_limit()
+            cold.append(time.perf_counter() - time_start)
+
+            time_start = time.perf_counter()
+            main.check_limit()
+            warm.append(time.perf_counter() - time_start)
+
+            # Like a run, which records the mtime before downloading
+            dir_mtime = directory.stat().st_mtime_ns
+            path_added = directory / f'29990101_{i}.jpg'
+            path_added.touch()
+            time_start = time.perf_counter()
+            main.check_limit(added=[path_added], dir_mtime=dir_mtime)
+            added.append(time.perf_counter() - time_start)
+        results[f'check_limit.cold.{size}'] = summarize(cold)
+        results[f'check_limit.warm.{size}'] = summarize(warm)
+        results[f'check_limit.added.{size}'] = summarize(added)
+        shutil.rmtree(directory)
+    return results
+
+
+def benchmark_upscale(repeat: int, directory_root: pathlib.Path):
+    """
+    Throughput of the tiling, blending and streaming PNG encoding of upscale_parts, with a fake upscaler,
+    and the time and size of the upscaled image in every derivative encoding.
+    """
+    import bing_standin
+    import derivative_cache
+    import upscale_arbsr
+
+    path_input = directory_root / 'upscale-input.jpg'
+    path_input.write_bytes(bing_standin.make_jpeg(1920, 1080))
+    target_width, target_height = 3840, 2160
+    parts_x, parts_y = upscale_arbsr.get_parts()
+
+    seconds = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory(dir=directory_root) as directory_working:
+            time_start = time.perf_counter()
+            upscale_arbsr.upscale_parts(path_input, target_width, target_height, parts_x, parts_y,
+                                        directory_working=directory_working, backend=fake_upscale)
+            seconds.append(time.perf_counter() - time_start)
+
+    result = summarize(seconds)
+    result['parts'] = [parts_x, parts_y]
+    result['megapixels_per_second'] = target_width * target_height / 1e6 / result['median']
+    results = {'upscale_parts': result}
+
+    path_upscaled = upscale_arbsr.upscale_parts(path_input, target_width, target_height, parts_x, parts_y,
+                                                directory_working=directory_root, backend=fake_upscale)
+    for encoding in [derivative_cache.Encoding('png', 1), derivative_cache.Encoding('png', 6),
+                     derivative_cache.Encoding('jpeg'), derivative_cache.Encoding('webp')]:
+        path_output = directory_root / f'encoded{derivative_cache.SUFFIXES[encoding.format]}'
+        seconds = []
+        for _ in range(repeat):
+            time_start = time.perf_counter()
+            derivative_cache.encode(path_upscaled, path_output, encoding)
+            seconds.append(time.perf_counter() - time_start)
+        result = summarize(seconds)
+        result['bytes'] = path_output.stat().st_size
+        results[f'encode.{encoding.format}.{derivative_cache.get_encoding_id(encoding)}'] = result
+    return results
+
+
+def benchmark_upscale_workers(repeat: int, directory_root: pathlib.Path):
+    """
+    upscale_parts with the worker backend against two stand-in cog workers, and
+    checks that a busy worker is waited for while a broken one is dropped.
+
+    :raises AssertionError: If a tile went to the fallback although a worker was alive.
+    """
+    import bing_standin
+    import cog_standin
+    import upscale_arbsr
+    import upscale_worker
+
+    path_input = directory_root / 'upscale-workers-input.jpg'
+    path_input.write_bytes(bing_standin.make_jpeg(1920, 1080))
+    path_tile = directory_root / 'upscale-workers-tile.jpg'
+    path_tile.write_bytes(bing_standin.make_jpeg(64, 64))
+    fallbacks = []
+
+    def fallback(path_input, target_width, target_height, directory_working):
+        fallbacks.append(path_input)
+        return fake_upscale(path_input, target_width, target_height, directory_working)
+
+    with cog_standin.CogStandIn() as worker_a, cog_standin.CogStandIn() as worker_b, \
+            cog_standin.CogStandIn('truncated') as worker_truncated, \
+            cog_standin.CogStandIn('garbage') as worker_garbage:
+        assert upscale_worker.is_ready(worker_a.url)
+        worker_b.ready.clear()
+        assert not upscale_worker.is_ready(worker_b.url)
+        worker_b.ready.set()
+
+        # Without a fallback, any tile the workers didn't take fails the run
+        backend = functools.partial(upscale_worker.upscale, base_urls=[worker_a.url, worker_b.url])
+        max_workers = upscale_worker.get_worker_count(backend)
+        assert max_workers == 2
+        seconds = []
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory(dir=directory_root) as directory_working:
+                time_start = time.perf_counter()
+                upscale_arbsr.upscale_parts(path_input, 3840, 2160, 2, 2, directory_working=directory_working,
+                                            backend=backend, max_workers=max_workers)
+                seconds.append(time.perf_counter() - time_start)
+        assert worker_a.predictions + worker_b.predictions == 4 * repeat
+
+        # A busy worker is waited for, not replaced by the fallback
+        worker_a.hold.clear()
+        with tempfile.TemporaryDirectory(dir=directory_root) as directory_busy, \
+                tempfile.TemporaryDirectory(dir=directory_root) as directory_working:
+            blocker = threading.Thread(target=upscale_worker.upscale, args=(path_tile, 128, 128, directory_busy),
+                                       kwargs={'base_urls': [worker_a.url]})
+            blocker.start()
+            while not worker_a.busy.locked():
+                time.sleep(0.01)
+            waiting = threading.Thread(target=upscale_worker.upscale, args=(path_tile, 128, 128, directory_working),
+                                       kwargs={'base_urls': [worker_a.url], 'fallback': fallback})
+            waiting.start()
+            waiting.join(3)
+            assert waiting.is_alive() and worker_a.rejected > 0 and not fallbacks
+            worker_a.hold.set()
+            blocker.join()
+            waiting.join()
+            assert not fallbacks
+
+        # Malformed responses drop the worker, the fallback only runs once none is left
+        with tempfile.TemporaryDirectory(dir=directory_root) as directory_working:
+            predictions = worker_b.predictions
+            upscale_worker.upscale(path_tile, 128, 128, directory_working,
+                                   base_urls=[worker_truncated.url, worker_garbage.url, worker_b.url],
+                                   fallback=fallback)
+            assert worker_b.predictions == predictions + 1 and not fallbacks
+            upscale_worker.upscale(path_tile, 128, 128, directory_working,
+                                   base_urls=[worker_truncated.url, worker_garbage.url], fallback=fallback)
+            assert fallbacks == [path_tile]
+
+    result = summarize(seconds)
+    result['workers'] = max_workers
+    return {'upscale_parts.workers': result}
+
+
+MEMORY_SCRIPT = """
+import sys
+import time
+sys.path[:0] = [{bin!r}, {benchmarks!r}]
+import numpy
+import PIL.Image
+import run_benchmarks
+import upscale_arbsr
+def get_peak():
+    # VmHWM rather than ru_maxrss, which keeps the peak of the parent process across exec
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+baseline = get_peak()
+time_start = time.perf_counter()
+upscale_arbsr.upscale_parts({input!r}, {width}, {height}, {parts_x}, {parts_y}, overlap={overlap},
+                            directory_working={working!r}, backend=run_benchmarks.fake_upscale)
+print(time.perf_counter() - time_start, baseline, get_peak())
+"""
+# Peak memory of upscale_parts above the interpreter's, in float32 bands of one
+# row of tiles. Assembling the whole output in memory takes about 3 outputs.
+UPSCALE_MEMORY_BANDS = 5
+
+
+def benchmark_upscale_memory(directory_root: pathlib.Path):
+    """
+    Peak memory of upscale_parts on an 8K target split 4x4, with a fake upscaler.
+
+    It runs in a fresh process, so its peak resident memory is only that of
+    upscale_parts (the tiles are upscaled in child processes, which aren't counted).
+
+    :raises AssertionError: If the peak exceeds UPSCALE_MEMORY_BANDS bands of one row of tiles.
+    """
+    import bing_standin
+
+    path_input = directory_root / 'upscale-memory-input.jpg'
+    path_input.write_bytes(bing_standin.make_jpeg(1920, 1080))
+    target_width, target_height = 7680, 4320
+    parts_x, parts_y, overlap = 4, 4, 128
+    band_bytes = (math.ceil(target_height / parts_y) + overlap) * target_width * 3 * 4
+
+    with tempfile.TemporaryDirectory(dir=directory_root) as directory_working:
+        script = MEMORY_SCRIPT.format(bin=str(DIRECTORY_BIN), benchmarks=str(DIRECTORY_BENCHMARKS),
+                                      input=str(path_input), width=target_width, height=target_height,
+                                      parts_x=parts_x, parts_y=parts_y, overlap=overlap, working=directory_working)
+        output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True).stdout
+    seconds, baseline, peak = output.split()
+    # VmHWM is in KiB
+    peak_bytes = (int(peak) - int(baseline)) * 1024
+    bound_bytes = UPSCALE_MEMORY_BANDS * band_bytes
+    assert peak_bytes <= bound_bytes, \
+        f'upscale_parts peaked at {peak_bytes / 2 ** 20:.0f} MiB, more than {bound_bytes / 2 ** 20:.0f} MiB'
+
+    result = summarize([float(seconds)])
+    result['peak_mib'] = peak_bytes / 2 ** 20
+    result['bound_mib'] = bound_bytes / 2 ** 20
+    return {'upscale_parts.memory': result}
+
+
+def compare(path_old: pathlib.Path, results: dict):
+    with open(path_old) as f:
+        old = json.load(f)
+    print(f'{"benchmark":<32} {"old":>10} {"new":>10} {"ratio":>7}')
+    for name, result in results['results'].items():
+        if name not in old['results']:
+            continue
+        median_old = old['results'][name]['median']
+        median_new = result['median']
+        ratio = median_new / median_old if median_old else float('nan')
+        print(f'{name:<32} {median_old:>10.4f} {median_new:>10.4f} {ratio:>7.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='benchmark-results.json', help='JSON file the results are written to')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per benchmark (default: 5)')
+    parser.add_argument('--dir-sizes', default='1000,10000,100000',
+                        help='comma separated numbers of files in the download directory')
+    parser.add_argument('--skip', action='append', default=[],
+                        choices=['main', 'startup', 'network', 'directory', 'upscale'],
+                        help='skip a group of benchmarks')
+    parser.add_argument('--compare', metavar='PATH', default=None, help='results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    results = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'time': time.time(),
+        'repeat': args.repeat,
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory(prefix='bdwc-benchmark-') as directory_root:
+        directory_root = pathlib.Path(directory_root)
+        main_module = setup_environment(directory_root)
+        if 'main' not in args.skip:
+            results['results'].update(benchmark_main(main_module, args.repeat))
+        if 'startup' not in args.skip:
+            results['results'].update(benchmark_startup(main_module, args.repeat))
+        if 'network' not in args.skip:
+            results['results'].update(benchmark_network(main_module, args.repeat))
+        if 'directory' not in args.skip:
+            sizes = [int(size) for size in args.dir_sizes.split(',') if size]
+            results['results'].update(benchmark_directory(main_module, sizes, args.repeat))
+        if 'upscale' not in args.skip:
+            results['results'].update(benchmark_upscale(args.repeat, directory_root))
+            results['results'].update(benchmark_upscale_memory(directory_root))
+            results['results'].update(benchmark_upscale_workers(args.repeat, directory_root))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for name, result in results['results'].items():
+        print(f'{name:<32} {result["median"]:>10.4f} s')
+    if args.compare:
+        compare(pathlib.Path(args.compare), results)
+
+
+if __name__ == '__main__':
+    main()
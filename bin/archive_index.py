@@ -0,0 +1,456 @@
+import collections
+import contextlib
+import os
+import pathlib
+import re
+import sqlite3
+import time
+
+import blob_store
+
+# Kept in a subdirectory, so the database journal doesn't touch the mtime of
+# the download directory itself
+STATE_DIR_NAME = '.bdwc'
+INDEX_FILE_NAME = 'archive-index.sqlite3'
+SUFFIXES = {'.jpg', '.png'}
+# Derivatives are named after their source image, e.g. 20231017_2560x1440.png
+# or 20231017_5760x2160-span.jpg
+DERIVATIVE_STEM = re.compile(r'^(?P<source>.+)_\d+x\d+(-[\w-]+)?$')
+EVICTION_ORDERS = {
+    # Filenames start with the image date, so this evicts the oldest image first
+    'name': 'name',
+    'lru': 'last_shown',
+}
+
+# shuffle: every original once in random order, then again in a new order
+# chronological: originals in date order, starting over after the newest
+# favourites: like shuffle, but only pinned originals
+ROTATION_ORDERS = ['shuffle', 'chronological', 'favourites']
+
+EvictionPolicy = collections.namedtuple(
+    'EvictionPolicy', ['max_size', 'max_count', 'max_age', 'order'],
+    defaults=[-1, -1, -1, 'name'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    kind TEXT NOT NULL,
+    source TEXT,
+    last_shown REAL NOT NULL,
+    pinned INTEGER NOT NULL DEFAULT 0,
+    inode INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_source ON files (source);
+CREATE INDEX IF NOT EXISTS files_mtime ON files (kind, pinned, mtime);
+CREATE INDEX IF NOT EXISTS files_name ON files (kind, pinned, name);
+CREATE INDEX IF NOT EXISTS files_last_shown ON files (kind, pinned, last_shown);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+""" + blob_store.SCHEMA
+
+
+def classify(name: str):
+    """
+    Get the kind of an archived file and the name of the image it was derived from.
+
+    :param name: Filename in the download directory.
+    :return: Tuple of ('original', None) or ('derivative', source filename).
+    """
+    path = pathlib.Path(name)
+    match = DERIVATIVE_STEM.match(path.stem)
+    if match:
+        return 'derivative', match.group('source') + '.jpg'
+    return 'original', None
+
+
+@contextlib.contextmanager
+def open_index(directory: pathlib.Path):
+    """
+    Open the archive index of a download directory, creating it if needed.
+    """
+    state_dir = pathlib.Path(directory) / STATE_DIR_NAME
+    state_dir.mkdir(exist_ok=True)
+    connection = sqlite3.connect(str(state_dir / INDEX_FILE_NAME))
+    try:
+        connection.executescript(SCHEMA)
+        # Indexes from before the blob store, the inodes are filled in by dedupe()
+        if 'inode' not in {row[1] for row in connection.execute('PRAGMA table_info(files)')}:
+            connection.execute('ALTER TABLE files ADD COLUMN inode INTEGER')
+        connection.execute('CREATE INDEX IF NOT EXISTS files_inode ON files (inode)')
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def _get_meta(index, key: str, default=None):
+    row = index.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return default if row is None else row[0]
+
+
+def _set_meta(index, key: str, value):
+    index.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+
+def _adjust_totals(index, size: int, count: int, kind: str):
+    _set_meta(index, 'total_size', _get_meta(index, 'total_size', 0) + size)
+    _set_meta(index, 'total_count', _get_meta(index, 'total_count', 0) + count)
+    if kind == 'original':
+        _set_meta(index, 'original_count', _get_meta(index, 'original_count', 0) + count)
+
+
+def get_blob_dir(directory: pathlib.Path):
+    return pathlib.Path(directory) / STATE_DIR_NAME / blob_store.BLOBS_DIR_NAME
+
+
+def get_totals(index):
+    """
+    :return: Tuple of (total bytes, number of files) in the archive.
+    """
+    return _get_meta(index, 'total_size', 0), _get_meta(index, 'total_count', 0)
+
+
+# Hardlinked names share an inode, which is only counted once: the size column
+# holds its size for one of the names and 0 for the others.
+
+def _unlink_inode(index, name: str, size: int, inode):
+    """
+    Account for name no longer linking to inode.
+
+    :return: Tuple of (bytes still in use by other names, inode if no name links to it anymore).
+    """
+    if inode is None:
+        return 0, None
+    row = index.execute('SELECT name FROM files WHERE inode = ? AND name != ? LIMIT 1', (inode, name)).fetchone()
+    if row is None:
+        return 0, inode
+    if size:
+        index.execute('UPDATE files SET size = ? WHERE name = ?', (size, row[0]))
+    return size, None
+
+
+def _insert(index, name: str, stat):
+    """
+    :return: Inode that name linked to before and no name links to anymore, or None.
+    """
+    kind, source = classify(name)
+    previous = index.execute('SELECT size, inode FROM files WHERE name = ?', (name,)).fetchone()
+    delta, released = 0, None
+    if previous is not None:
+        delta = -previous[0]
+        if previous[1] != stat.st_ino:
+            kept, released = _unlink_inode(index, name, *previous)
+            delta += kept
+    # A file without other links can't share its inode with another name
+    counted = stat.st_nlink > 1 and index.execute(
+        'SELECT 1 FROM files WHERE inode = ? AND name != ? AND size > 0', (stat.st_ino, name)).fetchone()
+    size = 0 if counted else stat.st_size
+    index.execute(
+        'INSERT INTO files (name, size, mtime, kind, source, last_shown, inode) VALUES (?, ?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT (name) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, inode = excluded.inode',
+        (name, size, stat.st_mtime, kind, source, stat.st_mtime, stat.st_ino))
+    _adjust_totals(index, delta + size, 0 if previous is not None else 1, kind)
+    return released
+
+
+def _remove(index, name: str):
+    """
+    :return: Inode of the file if no other name links to it, or None.
+    """
+    row = index.execute('SELECT size, kind, inode FROM files WHERE name = ?', (name,)).fetchone()
+    if row is None:
+        return None
+    index.execute('DELETE FROM files WHERE name = ?', (name,))
+    kept, released = _unlink_inode(index, name, row[0], row[2])
+    _adjust_totals(index, kept - row[0], -1, row[1])
+    return released
+
+
+def _release(index, directory: pathlib.Path, inode):
+    # The blob store holds the last link of an inode that no file links to anymore
+    if inode is not None:
+        blob_store.release(index, get_blob_dir(directory), inode)
+
+
+def sync(index, directory: pathlib.Path):
+    """
+    Bring the index up to date with the download directory.
+
+    Nothing is read unless the directory's mtime changed since the last sync.
+    Otherwise the directory listing is diffed against the index, and only new
+    files are stat'ed, so known files cost no I/O (which matters on network
+    home directories).
+
+    :return: Number of directory entries scanned.
+    """
+    directory = pathlib.Path(directory)
+    dir_mtime = directory.stat().st_mtime_ns
+    if _get_meta(index, 'dir_mtime') == dir_mtime:
+        return 0
+
+    scanned = 0
+    names = set()
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            scanned += 1
+            if os.path.splitext(entry.name)[1] in SUFFIXES and not entry.name.startswith('.') \
+                    and entry.is_file():
+                names.add(entry.name)
+
+    known = {name for name, in index.execute('SELECT name FROM files')}
+    for name in known - names:
+        _release(index, directory, _remove(index, name))
+    for name in names - known:
+        try:
+            _insert(index, name, (directory / name).stat())
+        except FileNotFoundError:
+            pass
+    _set_meta(index, 'dir_mtime', dir_mtime)
+    return scanned
+
+
+def is_current(index, dir_mtime: int):
+    """
+    :param dir_mtime: st_mtime_ns of the download directory before this program wrote to it.
+    :return: True if the index was up to date at that point, so the files this
+        program wrote are the only changes since.
+    """
+    return _get_meta(index, 'dir_mtime') == dir_mtime
+
+
+def add(index, path: pathlib.Path):
+    """
+    Register a file this program just wrote, so the next sync doesn't need to rescan.
+    """
+    path = pathlib.Path(path)
+    _release(index, path.parent, _insert(index, path.name, path.stat()))
+    _set_meta(index, 'dir_mtime', path.parent.stat().st_mtime_ns)
+
+
+def mark_shown(index, path: pathlib.Path, now: float = None):
+    """
+    Record that a file was set as the wallpaper, a derivative also refreshes its source.
+    """
+    now = time.time() if now is None else now
+    name = pathlib.Path(path).name
+    _, source = classify(name)
+    index.execute('UPDATE files SET last_shown = ? WHERE name IN (?, ?)', (now, name, source))
+
+
+def set_pinned(index, name: str, pinned: bool):
+    """
+    Pin or unpin a favourite, pinned images (and their derivatives) are never evicted.
+
+    :return: True if the file is in the index.
+    """
+    cursor = index.execute('UPDATE files SET pinned = ? WHERE name = ?', (int(pinned), name))
+    return cursor.rowcount > 0
+
+
+def _delete(index, directory: pathlib.Path, name: str):
+    (directory / name).unlink(missing_ok=True)
+    _release(index, directory, _remove(index, name))
+
+
+def _evict_original(index, directory: pathlib.Path, name: str):
+    """
+    Delete an original together with its derivatives.
+    """
+    for derivative, in index.execute('SELECT name FROM files WHERE source = ?', (name,)).fetchall():
+        _delete(index, directory, derivative)
+    _delete(index, directory, name)
+
+
+def evict(index, directory: pathlib.Path, policy: EvictionPolicy, protect=(), now: float = None):
+    """
+    Delete files until the archive satisfies the policy.
+
+    Totals are kept in the index and victims are read from an index in eviction
+    order, so the cost is proportional to the number of evicted files rather
+    than the size of the archive. The last remaining original is never deleted,
+    nor are pinned files or the names in protect.
+
+    :param policy: EvictionPolicy, negative limits are disabled.
+    :param protect: Filenames that must not be deleted, e.g. the current wallpaper.
+    :return: List of deleted filenames.
+    """
+    directory = pathlib.Path(directory)
+    now = time.time() if now is None else now
+    protect = set(protect)
+    # Deleting the source of a protected derivative would delete the derivative too
+    protect |= {classify(name)[1] for name in protect} - {None}
+    evicted = []
+
+    def victims(condition: str = '', parameters=()):
+        # Protected rows are never deleted and come back in every batch,
+        # so fetch enough rows to always get past them
+        order = EVICTION_ORDERS[policy.order]
+        query = ('SELECT name FROM files WHERE kind = ? AND pinned = 0 '
+                 f'{condition} ORDER BY {order} LIMIT ?')
+        while True:
+            rows = index.execute(query, ('original',) + tuple(parameters) + (64 + len(protect),)).fetchall()
+            rows = [name for name, in rows if name not in protect]
+            if not rows:
+                return
+            yield from rows
+
+    def count_originals():
+        return _get_meta(index, 'original_count', 0)
+
+    # Derivatives whose source is gone are useless
+    for name, in index.execute(
+            'SELECT name FROM files WHERE kind = ? AND pinned = 0 '
+            'AND source NOT IN (SELECT name FROM files)', ('derivative',)).fetchall():
+        if name not in protect:
+            _delete(index, directory, name)
+            evicted.append(name)
+
+    if policy.max_age > 0:
+        for name in victims('AND mtime < ?', (now - policy.max_age * 24 * 60 * 60,)):
+            if count_originals() <= 1:
+                break
+            _evict_original(index, directory, name)
+            evicted.append(name)
+
+    def over_limit():
+        size, count = get_totals(index)
+        return (0 < policy.max_size < size) or (0 < policy.max_count < count)
+
+    if over_limit():
+        for name in victims():
+            if not over_limit() or count_originals() <= 1:
+                break
+            _evict_original(index, directory, name)
+            evicted.append(name)
+
+    _set_meta(index, 'dir_mtime', directory.stat().st_mtime_ns)
+    return evicted
+
+
+def _recount(index, directory: pathlib.Path):
+    """
+    Recompute the sizes and totals from the files, counting every inode once.
+    """
+    inodes = set()
+    for name, in index.execute('SELECT name FROM files ORDER BY name').fetchall():
+        try:
+            stat = (directory / name).stat()
+        except FileNotFoundError:
+            index.execute('DELETE FROM files WHERE name = ?', (name,))
+            continue
+        size = 0 if stat.st_ino in inodes else stat.st_size
+        inodes.add(stat.st_ino)
+        index.execute('UPDATE files SET size = ?, inode = ? WHERE name = ?', (size, stat.st_ino, name))
+    total_size, total_count = index.execute('SELECT COALESCE(SUM(size), 0), COUNT(*) FROM files').fetchone()
+    _set_meta(index, 'total_size', total_size)
+    _set_meta(index, 'total_count', total_count)
+    _set_meta(index, 'original_count',
+              index.execute('SELECT COUNT(*) FROM files WHERE kind = ?', ('original',)).fetchone()[0])
+
+
+def dedupe(index, directory: pathlib.Path, hashes=None):
+    """
+    Move every file of the archive into the blob store, replacing files with
+    the same content by hardlinks.
+
+    Every file is read once. Afterwards originals of the same photo in
+    different sizes, known by Bing's hsh, are all linked to the largest one.
+
+    :param hashes: Dict of filename to Bing's hsh, e.g. from the catalog.
+    :return: Tuple of (number of files replaced by a link, bytes freed).
+    """
+    directory = pathlib.Path(directory)
+    blob_dir = get_blob_dir(directory)
+    hashes = hashes or {}
+    sync(index, directory)
+    replaced, freed = 0, 0
+
+    names = [name for name, in index.execute('SELECT name FROM files ORDER BY name').fetchall()]
+    for name in names:
+        path = directory / name
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        path_blob, duplicate = blob_store.add(index, blob_dir, path, hashes.get(name))
+        if path_blob is None:
+            raise RuntimeError(f'{directory} is on a filesystem without hardlinks')
+        if duplicate:
+            replaced += 1
+            freed += stat.st_size if stat.st_nlink == 1 else 0
+
+    for name in names:
+        path = directory / name
+        if classify(name)[0] != 'original' or not hashes.get(name) or not path.is_file():
+            continue
+        path_largest = blob_store.find(index, blob_dir, hashes[name])
+        if path_largest is not None and not path_largest.samefile(path):
+            stat = path.stat()
+            blob_store.link(path_largest, path)
+            replaced += 1
+            # The name and its blob were the only links
+            freed += stat.st_size if stat.st_nlink == 2 else 0
+
+    _recount(index, directory)
+    for inode, in index.execute(
+            'SELECT inode FROM blobs WHERE inode NOT IN (SELECT inode FROM files WHERE inode IS NOT NULL)').fetchall():
+        blob_store.release(index, blob_dir, inode)
+    _set_meta(index, 'dir_mtime', directory.stat().st_mtime_ns)
+    return replaced, freed
+
+
+def pick_next(index, order: str, current: str = None, now: float = None):
+    """
+    Pick the original to show after current when rotating through the archive.
+
+    Shuffling needs no stored permutation: a cycle starts at a recorded time and
+    every original not shown since then is a candidate, so each one is shown
+    once per cycle.
+
+    :param order: One of ROTATION_ORDERS.
+    :param current: Filename of the original shown now, it is never picked unless it is the only one.
+    :return: Filename, or None if there is nothing to rotate through.
+    """
+    if order == 'chronological':
+        row = index.execute('SELECT name FROM files WHERE kind = ? AND name > ? ORDER BY name LIMIT 1',
+                            ('original', current or '')).fetchone()
+        if row is None:
+            row = index.execute('SELECT name FROM files WHERE kind = ? ORDER BY name LIMIT 1',
+                                ('original',)).fetchone()
+        return None if row is None else row[0]
+
+    condition = 'AND pinned = 1' if order == 'favourites' else ''
+    query = (f'SELECT name FROM files WHERE kind = ? {condition} AND name != ? AND last_shown < ? '
+             'ORDER BY random() LIMIT 1')
+    key = f'rotation_cycle_{order}'
+    row = index.execute(query, ('original', current or '', _get_meta(index, key, 0))).fetchone()
+    if row is None:
+        # Everything was shown in this cycle, start the next one
+        now = time.time() if now is None else now
+        _set_meta(index, key, now)
+        row = index.execute(query, ('original', current or '', now)).fetchone()
+    if row is None:
+        return current
+    return row[0]
+
+
+def get_rotation_next(index, order: str):
+    """
+    :return: Filename of the original picked to be shown next in order, or None
+        if none was picked or it has been deleted since.
+    """
+    if _get_meta(index, 'rotation_order') != order:
+        return None
+    name = _get_meta(index, 'rotation_next')
+    if name is None or index.execute('SELECT 1 FROM files WHERE name = ?', (name,)).fetchone() is None:
+        return None
+    return name
+
+
+def set_rotation_next(index, order: str, name: str):
+    _set_meta(index, 'rotation_order', order)
+    _set_meta(index, 'rotation_next', name)
@@ -0,0 +1,150 @@
+import concurrent.futures
+import pathlib
+import xml.etree.ElementTree as ET
+
+import catalog
+import download
+import http_pool
+
+# HPImageArchive returns at most 8 images per request and does not go back
+# further than idx=7, so 15 days is the most that can be recovered.
+ARCHIVE_PAGE_SIZE = 8
+ARCHIVE_MAX_IDX = 7
+ARCHIVE_MAX_DAYS = ARCHIVE_MAX_IDX + ARCHIVE_PAGE_SIZE
+
+
+def get_archive_pages(days: int):
+    """
+    Split a number of days into the (idx, n) pages accepted by HPImageArchive.
+
+    A page can't start after ARCHIVE_MAX_IDX, so the last one may overlap the
+    one before, e.g. (0, 8), (7, 8) for 15 days. collapse_duplicates drops the
+    day fetched twice.
+
+    :param days: Number of days to go back, including today.
+    :return: List of (idx, n) tuples.
+    """
+    days = max(1, min(days, ARCHIVE_MAX_DAYS))
+    pages = []
+    for start in range(0, days, ARCHIVE_PAGE_SIZE):
+        idx = min(start, ARCHIVE_MAX_IDX)
+        pages.append((idx, min(ARCHIVE_PAGE_SIZE, days - idx)))
+    return pages
+
+
+def get_photo_key(metadata):
+    """
+    Get a market independent key for an image.
+
+    The urlbase of an image is e.g. /th?id=OHR.SomePlace_EN-US1234567890, where the
+    suffix after the last underscore differs between markets for the same photo.
+
+    :param metadata: XML tag object with image metadata.
+    :return: Key identifying the photo across markets.
+    """
+    urlbase = catalog.get_text(metadata, 'urlBase', 'urlbase')
+    image_id = urlbase[urlbase.find('id=') + 3:] if 'id=' in urlbase else urlbase
+    return '_'.join(image_id.split('_')[:-1]) or image_id
+
+
+def fetch_market(get_bing_xml, market: str, days: int):
+    """
+    Fetch the image metadata of the last days for one market.
+
+    :return: List of (market, metadata) tuples.
+    """
+    images = []
+    for idx, n in get_archive_pages(days):
+        response = http_pool.fetch(get_bing_xml(market, idx, n))
+        if response.status != 200:
+            raise RuntimeError(f'HPImageArchive returned HTTP {response.status} for {market}')
+        images.extend((market, image) for image in ET.fromstring(response.body).findall('image'))
+    return images
+
+
+def collapse_duplicates(images, preferred_market: str):
+    """
+    Keep a single entry per photo, preferring the configured market.
+
+    :param images: Iterable of (market, metadata) tuples.
+    :return: Dict of photo key to (market, metadata).
+    """
+    unique = {}
+    for market, metadata in images:
+        key = get_photo_key(metadata)
+        if key not in unique or (market == preferred_market and unique[key][0] != preferred_market):
+            unique[key] = (market, metadata)
+    return unique
+
+
+def get_image_name(market: str, metadata, preferred_market: str):
+    """
+    Images of the configured market keep the regular YYYYMMDD.jpg name, images
+    only found in other markets get the market appended.
+    """
+    startdate = metadata.find('startdate').text
+    if market == preferred_market:
+        return f'{startdate}.jpg'
+    return f'{startdate}_{market}.jpg'
+
+
+def backfill(
+    markets, days: int, download_path: pathlib.Path, preferred_market: str,
+    get_bing_xml, get_image_url, link_stored=None, workers: int = 16
+):
+    """
+    Download the images of the last days for many markets at once.
+
+    The metadata of all markets is fetched concurrently over pooled keep-alive
+    connections, duplicates across markets are collapsed, and every photo that
+    isn't in the download directory yet is downloaded once, unless link_stored
+    finds it in the blob store.
+
+    :param markets: Bing markets to sweep.
+    :param days: Number of days to go back, including today.
+    :param download_path: Wallpaper directory.
+    :param preferred_market: Market whose images keep the plain YYYYMMDD.jpg name.
+    :param get_bing_xml: Callable (market, idx, n) -> HPImageArchive URL.
+    :param get_image_url: Callable (metadata) -> image URL.
+    :param link_stored: Optional callable (metadata, image path) -> True if the
+        image was linked to a stored copy instead of downloading it.
+    :param workers: Maximum number of concurrent requests.
+    :return: Tuple of (downloaded or linked paths, list of (market, error) for failed markets).
+    """
+    errors = []
+    images = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch_market, get_bing_xml, market, days): market for market in markets}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                images.extend(future.result())
+            except Exception as err:
+                errors.append((futures[future], err))
+
+        downloads = {}
+        linked = []
+        for market, metadata in collapse_duplicates(images, preferred_market).values():
+            image_path = download_path / get_image_name(market, metadata, preferred_market)
+            if not image_path.is_file() or not download.is_valid_jpeg(image_path):
+                if link_stored is not None and link_stored(metadata, image_path):
+                    linked.append((market, metadata, image_path))
+                    continue
+                future = executor.submit(download.download, get_image_url(metadata), image_path)
+                downloads[future] = (market, metadata)
+
+        downloaded = []
+        with catalog.open_catalog(download_path) as image_catalog:
+            for market, metadata, image_path in linked:
+                catalog.add_image(image_catalog, metadata, market, image_path)
+                downloaded.append(image_path)
+            for future in concurrent.futures.as_completed(downloads):
+                try:
+                    image_path = future.result()
+                except Exception as err:
+                    errors.append((None, err))
+                    continue
+                market, metadata = downloads[future]
+                catalog.add_image(image_catalog, metadata, market, image_path)
+                downloaded.append(image_path)
+
+    return sorted(downloaded), errors
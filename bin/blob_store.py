@@ -0,0 +1,118 @@
+import hashlib
+import os
+import pathlib
+
+import image_probe
+
+BLOBS_DIR_NAME = 'blobs'
+CHUNK_SIZE = 1024 * 1024
+
+# Every blob is named after the SHA-256 of its content. hsh is Bing's hash of
+# the photo, which is the same in every market and for every size, so an image
+# can be found before it is downloaded.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    inode INTEGER,
+    hsh TEXT,
+    width INTEGER,
+    height INTEGER
+);
+CREATE INDEX IF NOT EXISTS blobs_hsh ON blobs (hsh);
+CREATE INDEX IF NOT EXISTS blobs_inode ON blobs (inode);
+"""
+
+
+def hash_file(path: pathlib.Path):
+    """
+    :return: Hex SHA-256 of a file, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link(source: pathlib.Path, path: pathlib.Path):
+    """
+    Make path a hardlink of source, replacing it atomically if it exists.
+
+    :raise OSError: If the filesystem doesn't support hardlinks.
+    """
+    path = pathlib.Path(path)
+    path_tmp = path.with_name(f'.{path.name}.link')
+    path_tmp.unlink(missing_ok=True)
+    os.link(source, path_tmp)
+    os.replace(path_tmp, path)
+
+
+def add(index, blob_dir: pathlib.Path, path: pathlib.Path, hsh: str = None, digest: str = None):
+    """
+    Move a file's content into the store, keeping path as a hardlink to the blob.
+
+    If a blob with the same content exists, path is replaced by a link to it.
+
+    :param index: Open archive index, see archive_index.open_index.
+    :param hsh: Bing's hash of the photo, if known.
+    :param digest: SHA-256 of the file, if already computed.
+    :return: Tuple of (blob path, True if path was a duplicate of an existing blob),
+        (None, False) if the filesystem doesn't support hardlinks.
+    """
+    path = pathlib.Path(path)
+    digest = hash_file(path) if digest is None else digest
+    row = index.execute('SELECT path FROM blobs WHERE digest = ?', (digest,)).fetchone()
+    if row is not None and (blob_dir / row[0]).is_file():
+        path_blob = blob_dir / row[0]
+        duplicate = not path_blob.samefile(path)
+        if duplicate:
+            link(path_blob, path)
+        if hsh is not None:
+            index.execute('UPDATE blobs SET hsh = ? WHERE digest = ?', (hsh, digest))
+        return path_blob, duplicate
+
+    name = f'{digest[:2]}/{digest}{path.suffix}'
+    path_blob = blob_dir / name
+    path_blob.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        link(path, path_blob)
+    except OSError:
+        return None, False
+    try:
+        width, height = image_probe.get_size(path)
+    except ValueError:
+        width, height = None, None
+    index.execute(
+        'INSERT OR REPLACE INTO blobs (digest, path, inode, hsh, width, height) VALUES (?, ?, ?, ?, ?, ?)',
+        (digest, name, path_blob.stat().st_ino, hsh, width, height))
+    return path_blob, False
+
+
+def find(index, blob_dir: pathlib.Path, hsh: str, width: int = 0, height: int = 0):
+    """
+    Find a stored photo at least as large as width x height.
+
+    :return: Path of the blob, or None.
+    """
+    if not hsh:
+        return None
+    rows = index.execute('SELECT path, width, height FROM blobs WHERE hsh = ? ORDER BY width * height DESC',
+                         (hsh,)).fetchall()
+    for name, blob_width, blob_height in rows:
+        if (blob_width or 0) >= width and (blob_height or 0) >= height and (blob_dir / name).is_file():
+            return blob_dir / name
+    return None
+
+
+def release(index, blob_dir: pathlib.Path, inode: int):
+    """
+    Delete the blob of an inode that no file in the download directory links to anymore.
+    """
+    row = index.execute('SELECT digest, path FROM blobs WHERE inode = ?', (inode,)).fetchone()
+    if row is not None:
+        (blob_dir / row[1]).unlink(missing_ok=True)
+        index.execute('DELETE FROM blobs WHERE digest = ?', (row[0],))
@@ -0,0 +1,242 @@
+import ast
+import contextlib
+import json
+import pathlib
+import sqlite3
+
+import archive_index
+
+CATALOG_FILE_NAME = 'catalog.sqlite3'
+DETAILS_FILE_NAME = 'image-details.txt'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    startdate TEXT NOT NULL,
+    market TEXT NOT NULL,
+    fullstartdate TEXT,
+    enddate TEXT,
+    url TEXT,
+    urlbase TEXT,
+    copyright TEXT,
+    copyrightlink TEXT,
+    title TEXT,
+    hsh TEXT,
+    path TEXT,
+    fields TEXT,
+    PRIMARY KEY (startdate, market)
+);
+CREATE INDEX IF NOT EXISTS images_market ON images (market, startdate);
+CREATE INDEX IF NOT EXISTS images_hsh ON images (hsh);
+CREATE INDEX IF NOT EXISTS images_path ON images (path);
+CREATE INDEX IF NOT EXISTS images_urlbase ON images (urlbase);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+"""
+
+# External content table, kept in sync by triggers
+SCHEMA_FTS = """
+CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(
+    copyright, title, content='images', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS images_ai AFTER INSERT ON images BEGIN
+    INSERT INTO images_fts (rowid, copyright, title) VALUES (new.rowid, new.copyright, new.title);
+END;
+CREATE TRIGGER IF NOT EXISTS images_ad AFTER DELETE ON images BEGIN
+    INSERT INTO images_fts (images_fts, rowid, copyright, title)
+    VALUES ('delete', old.rowid, old.copyright, old.title);
+END;
+CREATE TRIGGER IF NOT EXISTS images_au AFTER UPDATE ON images BEGIN
+    INSERT INTO images_fts (images_fts, rowid, copyright, title)
+    VALUES ('delete', old.rowid, old.copyright, old.title);
+    INSERT INTO images_fts (rowid, copyright, title) VALUES (new.rowid, new.copyright, new.title);
+END;
+"""
+
+COLUMNS = ['startdate', 'market', 'fullstartdate', 'enddate', 'url', 'urlbase',
+           'copyright', 'copyrightlink', 'title', 'hsh', 'path']
+
+
+def get_text(metadata, *tags):
+    """
+    Get the text of the first child element that exists.
+
+    The casing of some tags differs between API versions, e.g. urlBase and urlbase.
+    """
+    for tag in tags:
+        element = metadata.find(tag)
+        if element is not None and element.text is not None:
+            return element.text
+    return None
+
+
+def has_fts(catalog):
+    return catalog.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'images_fts'").fetchone() is not None
+
+
+@contextlib.contextmanager
+def open_catalog(directory: pathlib.Path):
+    """
+    Open the wallpaper catalog of a download directory, creating it if needed.
+
+    An image-details.txt left by older versions is imported the first time.
+    """
+    directory = pathlib.Path(directory)
+    state_dir = directory / archive_index.STATE_DIR_NAME
+    state_dir.mkdir(exist_ok=True)
+    connection = sqlite3.connect(str(state_dir / CATALOG_FILE_NAME))
+    connection.row_factory = sqlite3.Row
+    try:
+        connection.executescript(SCHEMA)
+        try:
+            connection.executescript(SCHEMA_FTS)
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5, search falls back to LIKE
+            pass
+        with connection:
+            path_details = directory / DETAILS_FILE_NAME
+            if path_details.is_file() and _get_meta(connection, 'details_imported') is None:
+                import_details(connection, path_details)
+            yield connection
+    finally:
+        connection.close()
+
+
+def _get_meta(catalog, key: str, default=None):
+    row = catalog.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return default if row is None else row[0]
+
+
+def _set_meta(catalog, key: str, value):
+    catalog.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+
+def add_image(catalog, metadata, market: str, path: pathlib.Path = None):
+    """
+    Store every field of an <image> element.
+
+    :param metadata: XML tag object with image metadata.
+    :param market: Bing market the metadata was fetched for.
+    :param path: Local path of the downloaded image.
+    """
+    fields = {child.tag: child.text for child in metadata if child.text is not None}
+    row = {
+        'startdate': get_text(metadata, 'startdate'),
+        'market': market,
+        'fullstartdate': get_text(metadata, 'fullstartdate'),
+        'enddate': get_text(metadata, 'enddate'),
+        'url': get_text(metadata, 'url'),
+        'urlbase': get_text(metadata, 'urlBase', 'urlbase'),
+        'copyright': get_text(metadata, 'copyright'),
+        'copyrightlink': get_text(metadata, 'copyrightlink'),
+        'title': get_text(metadata, 'title', 'headline'),
+        'hsh': get_text(metadata, 'hsh'),
+        'path': str(path) if path is not None else None,
+    }
+    catalog.execute(
+        f'INSERT INTO images ({", ".join(COLUMNS)}, fields) VALUES ({", ".join("?" * (len(COLUMNS) + 1))}) '
+        'ON CONFLICT (startdate, market) DO UPDATE SET '
+        + ', '.join(f'{column} = COALESCE(excluded.{column}, {column})' for column in COLUMNS[2:])
+        + ', fields = excluded.fields',
+        [row[column] for column in COLUMNS] + [json.dumps(fields)])
+
+
+def parse_details_line(line: str):
+    """
+    Parse a line of image-details.txt, e.g. 20231017.jpg -- b'Some place (\\xc2\\xa9 Someone)'
+
+    :return: Tuple of (image name, copyright), or None for malformed lines.
+    """
+    name, separator, body = line.rstrip('\n').partition(' -- ')
+    if not separator or not name:
+        return None
+    if body.startswith(("b'", 'b"')):
+        # Older versions wrote the repr of the utf-8 encoded copyright
+        try:
+            body = ast.literal_eval(body).decode('utf-8', errors='replace')
+        except (ValueError, SyntaxError):
+            pass
+    return name, body
+
+
+def import_details(catalog, path_details: pathlib.Path):
+    """
+    Import an image-details.txt written by older versions.
+
+    The market of these entries is unknown and stored as an empty string.
+
+    :return: Number of imported entries.
+    """
+    count = 0
+    with open(path_details, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            parsed = parse_details_line(line)
+            if parsed is None:
+                continue
+            name, copyright = parsed
+            path = pathlib.Path(path_details).parent / name
+            catalog.execute(
+                'INSERT OR IGNORE INTO images (startdate, market, copyright, path) VALUES (?, ?, ?, ?)',
+                (pathlib.Path(name).stem.split('_')[0], '', copyright, str(path)))
+            count += 1
+    _set_meta(catalog, 'details_imported', str(path_details))
+    return count
+
+
+def to_fts_query(text: str):
+    """
+    Quote every word of user input as an FTS5 string, so characters like - ' ( and
+    words like AND aren't parsed as query syntax. All words must match.
+    """
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+
+def search(catalog, text: str = None, since: str = None, until: str = None,
+           market: str = None, limit: int = 100):
+    """
+    Look up images by date range, market and/or full-text search over copyright and title.
+
+    :param text: Words that must all occur (or a substring, if FTS5 isn't available).
+    :param since: First startdate, YYYYMMDD.
+    :param until: Last startdate, YYYYMMDD.
+    :return: List of sqlite3.Row, newest first.
+    """
+    conditions = []
+    parameters = []
+    if text and text.strip():
+        if has_fts(catalog):
+            conditions.append('images.rowid IN (SELECT rowid FROM images_fts WHERE images_fts MATCH ?)')
+            parameters.append(to_fts_query(text))
+        else:
+            conditions.append('(images.copyright LIKE ? OR images.title LIKE ?)')
+            parameters.extend([f'%{text}%'] * 2)
+    if since:
+        conditions.append('startdate >= ?')
+        parameters.append(since)
+    if until:
+        conditions.append('startdate <= ?')
+        parameters.append(until)
+    if market:
+        conditions.append('market = ?')
+        parameters.append(market)
+    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    query = f'SELECT * FROM images {where} ORDER BY startdate DESC, market LIMIT ?'
+    return catalog.execute(query, parameters + [limit]).fetchall()
+
+
+def get_paths(catalog, urlbase: str):
+    """
+    :return: Local paths of the downloaded images with a urlBase, e.g. /th?id=OHR.Example_EN-US1234567890
+    """
+    rows = catalog.execute('SELECT path FROM images WHERE urlbase = ? AND path IS NOT NULL', (urlbase,))
+    return [pathlib.Path(path) for path, in rows.fetchall()]
+
+
+def get_hashes(catalog):
+    """
+    :return: Dict of the filenames of the downloaded images to Bing's hsh.
+    """
+    rows = catalog.execute('SELECT path, hsh FROM images WHERE path IS NOT NULL AND hsh IS NOT NULL')
+    return {pathlib.Path(path).name: hsh for path, hsh in rows.fetchall()}
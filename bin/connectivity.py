@@ -0,0 +1,140 @@
+import random
+import threading
+import time
+
+import http_pool
+
+PROBE_TIMEOUT = 5
+BACKOFF_BASE = 0.25
+BACKOFF_MAX = 30
+# Beyond this many doublings base * 2 ** attempt is far above any maximum, and
+# a float overflows at about 1024
+BACKOFF_MAX_EXPONENT = 32
+
+
+def get_network_monitor():
+    """
+    :return: The default Gio.NetworkMonitor, or None if GIO isn't available.
+    """
+    try:
+        from gi.repository import Gio
+    except ImportError:
+        return None
+    return Gio.NetworkMonitor.get_default()
+
+
+def is_metered(monitor=None):
+    """
+    Check whether the network is metered (e.g. a mobile hotspot), as far as GIO knows.
+    """
+    monitor = get_network_monitor() if monitor is None else monitor
+    return monitor is not None and monitor.get_network_metered()
+
+
+def probe(url: str, timeout: float = PROBE_TIMEOUT):
+    """
+    Check that url is reachable with a HEAD request, which doesn't transfer a body.
+
+    The request goes through the connection pool, so the connection is reused
+    by the requests that follow.
+    """
+    try:
+        return http_pool.fetch(url, method='HEAD', timeout=timeout).status < 500
+    except Exception:
+        return False
+
+
+def get_backoff(attempt: int, base: float = BACKOFF_BASE, maximum: float = BACKOFF_MAX):
+    """
+    Exponential backoff with full jitter.
+    """
+    return random.uniform(0, min(maximum, base * 2 ** min(attempt, BACKOFF_MAX_EXPONENT)))
+
+
+class _Waiter:
+    """
+    Sleep until a timeout or until the network monitor reports a change.
+
+    A real Gio.NetworkMonitor only emits signals while a GLib main loop runs, so
+    the waiting is done in a (nested) main loop. A monitor that doesn't need one,
+    like a fake in tests, may call notify() from any thread.
+    """
+
+    def __init__(self, use_glib: bool):
+        self.use_glib = use_glib
+        self.changed = threading.Event()
+        self.loop = None
+
+    def notify(self, *args):
+        self.changed.set()
+        if self.loop is not None:
+            self.loop.quit()
+
+    def wait(self, timeout: float):
+        if not self.use_glib:
+            self.changed.wait(timeout)
+            return
+        if self.changed.is_set():
+            return
+
+        from gi.repository import GLib
+
+        self.loop = GLib.MainLoop()
+        fired = []
+
+        def on_timeout():
+            fired.append(True)
+            self.loop.quit()
+            return False
+
+        source = GLib.timeout_add(max(1, int(timeout * 1000)), on_timeout)
+        try:
+            self.loop.run()
+        finally:
+            if not fired:
+                GLib.source_remove(source)
+            self.loop = None
+
+
+def wait_for_connection(url: str, timeout: float, monitor=None, probe=probe, use_glib: bool = False):
+    """
+    Block until url is reachable.
+
+    While the monitor reports no network the wait doesn't use any CPU and ends
+    as soon as the network-changed signal arrives. With a network, url is probed
+    with exponential backoff and jitter, and any network change triggers an
+    immediate retry.
+
+    :param url: URL to probe, e.g. https://www.bing.com
+    :param timeout: Seconds to wait before giving up.
+    :param monitor: Gio.NetworkMonitor (or compatible fake), None to only probe.
+    :param probe: Callable (url, timeout) -> bool.
+    :param use_glib: Wait in a GLib main loop, required for a real Gio monitor.
+    :raises ConnectionError: If url isn't reachable within timeout.
+    """
+    waiter = _Waiter(use_glib)
+    handler = monitor.connect('network-changed', waiter.notify) if monitor is not None else None
+
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    try:
+        while True:
+            waiter.changed.clear()
+            available = monitor is None or monitor.get_network_available()
+            if available and probe(url, max(0.1, min(PROBE_TIMEOUT, deadline - time.monotonic()))):
+                return
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ConnectionError(f'{url} not reachable after {timeout} seconds')
+            if available:
+                delay = get_backoff(attempt)
+                attempt += 1
+            else:
+                # Nothing to probe, sleep until the network changes
+                delay = remaining
+                attempt = 0
+            waiter.wait(min(delay, remaining))
+    finally:
+        if handler is not None:
+            monitor.disconnect(handler)
@@ -0,0 +1,134 @@
+import collections
+import os
+import pathlib
+
+import blob_store
+
+ENCODINGS = ['png', 'jpeg', 'webp']
+SUFFIXES = {'png': '.png', 'jpeg': '.jpg', 'webp': '.webp'}
+# Hex digits of the source's SHA-256 in a key
+DIGEST_LENGTH = 16
+# Rows decoded and handed to the PNG writer at a time
+ENCODE_ROWS = 256
+
+# png_level: zlib level 0-9 of PNG, quality: 1-100 of JPEG and WebP
+Encoding = collections.namedtuple('Encoding', ['format', 'png_level', 'quality'], defaults=['png', 6, 95])
+
+
+def get_key(source: pathlib.Path, width: int, height: int, digest: str = None):
+    """
+    Get the part of a derivative's name identifying its source and size.
+
+    It is named after the source, so archive_index.classify() knows which image it was derived from,
+    e.g. 20231017_3840x2160-3fa9c1d2e4b5a6b7.
+
+    :param digest: SHA-256 of the source, if already computed.
+    """
+    source = pathlib.Path(source)
+    digest = blob_store.hash_file(source) if digest is None else digest
+    return f'{source.stem}_{width}x{height}-{digest[:DIGEST_LENGTH]}'
+
+
+def get_encoding_id(encoding: Encoding):
+    if encoding.format == 'png':
+        return f'z{encoding.png_level}'
+    return f'q{encoding.quality}'
+
+
+def get_path(cache_dir: pathlib.Path, key: str, model_id: str, encoding: Encoding):
+    """
+    :param model_id: Backend and model version that upscaled the image, e.g. arbsr-cpu.
+    :return: Path of the derivative, e.g. 20231017_3840x2160-3fa9c1d2e4b5a6b7-arbsr-cpu-z6.png.
+    """
+    return pathlib.Path(cache_dir) / f'{key}-{model_id}-{get_encoding_id(encoding)}{SUFFIXES[encoding.format]}'
+
+
+def find(cache_dir: pathlib.Path, key: str, model_ids, encoding: Encoding):
+    """
+    Find a cached derivative and mark it as used.
+
+    :param model_ids: Acceptable models, preferred first.
+    :return: Path, or None if none of them made it yet.
+    """
+    for model_id in model_ids:
+        path = get_path(cache_dir, key, model_id, encoding)
+        if path.is_file():
+            touch(path)
+            return path
+    return None
+
+
+def touch(path: pathlib.Path):
+    """
+    Mark a derivative as used, the least recently used ones are evicted first.
+    """
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def evict(cache_dir: pathlib.Path, max_size: int, protect=()):
+    """
+    Delete the least recently used derivatives until the cache is within max_size bytes.
+
+    :param max_size: Negative for unlimited.
+    :param protect: Paths that must not be deleted, e.g. the current wallpaper.
+    :return: List of deleted paths.
+    """
+    if max_size < 0:
+        return []
+    protect = {pathlib.Path(path).name for path in protect}
+    files = []
+    try:
+        with os.scandir(cache_dir) as entries:
+            for entry in entries:
+                if not entry.name.startswith('.') and entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, pathlib.Path(entry.path)))
+    except FileNotFoundError:
+        return []
+
+    size = sum(file_size for _, file_size, _ in files)
+    evicted = []
+    for _, file_size, path in sorted(files):
+        if size <= max_size:
+            break
+        if path.name in protect:
+            continue
+        path.unlink(missing_ok=True)
+        size -= file_size
+        evicted.append(path)
+    return evicted
+
+
+def encode(path_input: pathlib.Path, path_output: pathlib.Path, encoding: Encoding, workers: int = None):
+    """
+    Encode an image as a derivative.
+
+    PNGs are compressed strip-parallel by png_writer, JPEGs are written without
+    chroma subsampling, as a derivative is meant to look like the lossless image.
+
+    :param workers: Threads compressing PNG strips, defaults to the number of cores.
+    """
+    import numpy as np
+    from PIL import Image
+
+    import png_writer
+
+    with Image.open(path_input) as image:
+        if image.mode not in ('L', 'RGB', 'RGBA'):
+            image = image.convert('RGB')
+        if encoding.format == 'png':
+            width, height = image.size
+            with png_writer.PngWriter(path_output, width, height, len(image.mode), encoding.png_level,
+                                      workers or os.cpu_count() or 1) as writer:
+                for top in range(0, height, ENCODE_ROWS):
+                    writer.write_rows(np.asarray(image.crop((0, top, width, min(height, top + ENCODE_ROWS)))))
+        elif encoding.format == 'jpeg':
+            image.convert('RGB').save(path_output, 'JPEG', quality=encoding.quality, subsampling=0)
+        elif encoding.format == 'webp':
+            image.save(path_output, 'WEBP', quality=encoding.quality)
+        else:
+            raise ValueError(f'Unknown encoding {encoding.format}, expected one of {", ".join(ENCODINGS)}')
+    return path_output
@@ -0,0 +1,182 @@
+import pathlib
+import urllib.parse
+
+DESKTOP_ENVIRONMENTS = ['gnome', 'cinnamon', 'fake']
+
+
+def to_uri(path: pathlib.Path):
+    return pathlib.Path(path).absolute().as_uri()
+
+
+def from_uri(uri: str):
+    """
+    :return: Path of a file:// URI, or None if uri is empty or not a local file.
+    """
+    parts = urllib.parse.urlsplit(uri)
+    if parts.scheme != 'file' or not parts.path:
+        return None
+    return pathlib.Path(urllib.parse.unquote(parts.path))
+
+
+class Desktop:
+    """
+    Wallpaper settings of a desktop environment.
+
+    Values are read once and cached, writes that don't change anything are
+    skipped, and the keys written together are applied at once. Call refresh()
+    before reusing an instance after the user may have changed the wallpaper,
+    e.g. at the start of every run of the daemon.
+    """
+
+    BACKGROUND_SCHEMA = None
+    # The lock screen of both desktops uses GNOME's screensaver settings
+    SCREENSAVER_SCHEMA = 'org.gnome.desktop.screensaver'
+
+    def __init__(self):
+        self._values = {}
+
+    def refresh(self):
+        self._values.clear()
+
+    def _read(self, schema: str, key: str):
+        raise NotImplementedError
+
+    def _write(self, schema: str, values: dict):
+        raise NotImplementedError
+
+    def _has_key(self, schema: str, key: str):
+        return True
+
+    def get(self, schema: str, key: str):
+        if (schema, key) not in self._values:
+            self._values[(schema, key)] = self._read(schema, key)
+        return self._values[(schema, key)]
+
+    def set(self, schema: str, values: dict):
+        """
+        Write the keys of values that differ from their current value, in one batch.
+
+        :return: True if anything was written.
+        """
+        changed = {key: value for key, value in values.items() if self.get(schema, key) != value}
+        if changed:
+            self._write(schema, changed)
+            self._values.update({(schema, key): value for key, value in changed.items()})
+        return bool(changed)
+
+    def get_background(self):
+        """
+        :return: Path of the current wallpaper, or None.
+        """
+        return from_uri(self.get(self.BACKGROUND_SCHEMA, 'picture-uri'))
+
+    def set_background(self, path: pathlib.Path, spanned: bool = False):
+        """
+        :param spanned: Stretch the image across all monitors, for images composed by screen_layout.
+        """
+        uri = to_uri(path)
+        values = {'picture-uri': uri}
+        # GNOME 42+ shows picture-uri-dark with the dark style
+        if self._has_key(self.BACKGROUND_SCHEMA, 'picture-uri-dark'):
+            values['picture-uri-dark'] = uri
+        options = self.get(self.BACKGROUND_SCHEMA, 'picture-options')
+        if spanned != (options == 'spanned'):
+            values['picture-options'] = 'spanned' if spanned else 'zoom'
+        return self.set(self.BACKGROUND_SCHEMA, values)
+
+    def set_screensaver(self, path: pathlib.Path):
+        return self.set(self.SCREENSAVER_SCHEMA, {'picture-uri': to_uri(path)})
+
+
+class GSettingsDesktop(Desktop):
+    def __init__(self):
+        super().__init__()
+        self._settings = {}
+
+    def _get_settings(self, schema: str):
+        """
+        Get a Gio.Settings object, created once per schema and kept in delay-apply mode.
+        """
+        if schema not in self._settings:
+            from gi.repository import Gio
+
+            settings = Gio.Settings.new(schema)
+            settings.delay()
+            self._settings[schema] = settings
+        return self._settings[schema]
+
+    def _read(self, schema: str, key: str):
+        return self._get_settings(schema).get_string(key)
+
+    def _write(self, schema: str, values: dict):
+        settings = self._get_settings(schema)
+        for key, value in values.items():
+            settings.set_string(key, value)
+        settings.apply()
+
+    def _has_key(self, schema: str, key: str):
+        from gi.repository import Gio
+
+        source = Gio.SettingsSchemaSource.get_default()
+        settings_schema = source.lookup(schema, True) if source is not None else None
+        return settings_schema is not None and settings_schema.has_key(key)
+
+
+class GnomeDesktop(GSettingsDesktop):
+    BACKGROUND_SCHEMA = 'org.gnome.desktop.background'
+
+
+class CinnamonDesktop(GSettingsDesktop):
+    BACKGROUND_SCHEMA = 'org.cinnamon.desktop.background'
+
+
+class FakeDesktop(Desktop):
+    """
+    In-memory desktop for tests and benchmarks, counts the batches written.
+    """
+
+    BACKGROUND_SCHEMA = 'org.gnome.desktop.background'
+
+    def __init__(self, values: dict = None):
+        super().__init__()
+        self.store = dict(values or {})
+        self.writes = 0
+
+    def _read(self, schema: str, key: str):
+        return self.store.get((schema, key), '')
+
+    def _write(self, schema: str, values: dict):
+        self.store.update({(schema, key): value for key, value in values.items()})
+        self.writes += 1
+
+
+DESKTOPS = {'gnome': GnomeDesktop, 'cinnamon': CinnamonDesktop, 'fake': FakeDesktop}
+_desktops = {}
+
+
+def detect():
+    """
+    :return: 'cinnamon' if Cinnamon's settings are installed, 'gnome' otherwise.
+    """
+    from gi.repository import Gio
+
+    source = Gio.SettingsSchemaSource.get_default()
+    if source is not None and source.lookup(CinnamonDesktop.BACKGROUND_SCHEMA, True):
+        return 'cinnamon'
+    return 'gnome'
+
+
+def get_desktop(desktop_environment: str = None):
+    """
+    Get the backend of a desktop environment, created once and reused afterwards.
+
+    :param desktop_environment: One of DESKTOP_ENVIRONMENTS, detected if None.
+    """
+    if desktop_environment is None:
+        desktop_environment = detect()
+    if desktop_environment not in DESKTOPS:
+        raise ValueError(f'Unknown desktop environment {desktop_environment}, '
+                         f'expected one of {", ".join(DESKTOP_ENVIRONMENTS)}')
+    if desktop_environment not in _desktops:
+        _desktops[desktop_environment] = DESKTOPS[desktop_environment]()
+    return _desktops[desktop_environment]
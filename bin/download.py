@@ -0,0 +1,166 @@
+import http.client
+import json
+import os
+import pathlib
+import re
+import time
+
+import http_pool
+import timing
+
+CHUNK_SIZE = 64 * 1024
+MAX_ATTEMPTS = 5
+# JPEG files may carry some padding after the EOI marker
+JPEG_TAIL_SEARCH = 1024
+
+
+def get_part_path(path: pathlib.Path):
+    """
+    Hidden temporary file next to the destination, so renaming it is atomic
+    and it isn't picked up by the directory scans.
+    """
+    return path.with_name(f'.{path.name}.part')
+
+
+def get_part_meta_path(path: pathlib.Path):
+    return path.with_name(f'.{path.name}.part.json')
+
+
+def is_valid_jpeg(path: pathlib.Path):
+    """
+    Check that a file starts with a JPEG SOI marker and ends with an EOI marker.
+
+    Only the first and last bytes are read, so this is cheap enough to run on
+    every start to catch truncated files.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read(3) != b'\xff\xd8\xff':
+                return False
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - JPEG_TAIL_SEARCH))
+            return b'\xff\xd9' in f.read()
+    except OSError:
+        return False
+
+
+def _parse_content_range(value: str):
+    """
+    :return: (first byte, total length or None) of a 'bytes first-last/total' header.
+    """
+    match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', value or '')
+    if match is None:
+        return None, None
+    total = match.group(2)
+    return int(match.group(1)), None if total == '*' else int(total)
+
+
+def _load_part_meta(path: pathlib.Path, url: str):
+    try:
+        with open(get_part_meta_path(path)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('url') == url else None
+
+
+def _save_part_meta(path: pathlib.Path, url: str, response):
+    meta = {
+        'url': url,
+        'etag': response.getheader('ETag'),
+        'last_modified': response.getheader('Last-Modified'),
+    }
+    with open(get_part_meta_path(path), 'w') as f:
+        json.dump(meta, f)
+
+
+def _discard_part(path: pathlib.Path):
+    get_part_path(path).unlink(missing_ok=True)
+    get_part_meta_path(path).unlink(missing_ok=True)
+
+
+def download(url: str, path: pathlib.Path, chunk_size: int = CHUNK_SIZE,
+             attempts: int = MAX_ATTEMPTS, timeout: float = 30):
+    """
+    Download url to path.
+
+    The body is streamed into a hidden .part file in fixed-size chunks. After an
+    interruption, in this run or a previous one, the download resumes with a
+    Range request (guarded by If-Range). Once the length and, for .jpg files,
+    the JPEG markers check out, the file is renamed into place atomically.
+
+    :param url: Image URL.
+    :param path: Destination path.
+    :param chunk_size: Bytes read from the connection at a time.
+    :param attempts: Number of tries before giving up.
+    :param timeout: Socket timeout in seconds.
+    :return: path
+    """
+    path = pathlib.Path(path)
+    path_part = get_part_path(path)
+    last_error = None
+
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(min(2 ** attempt, 30))
+
+        meta = _load_part_meta(path, url)
+        offset = path_part.stat().st_size if path_part.exists() and meta is not None else 0
+        headers = {}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            validator = meta.get('etag') or meta.get('last_modified')
+            if validator:
+                headers['If-Range'] = validator
+
+        try:
+            with http_pool.stream(url, headers=headers, timeout=timeout) as response:
+                if response.status == 416:
+                    # The partial file doesn't match the resource anymore
+                    response.read()
+                    _discard_part(path)
+                    continue
+                elif response.status == 206:
+                    first, total = _parse_content_range(response.getheader('Content-Range'))
+                    if first != offset:
+                        response.read()
+                        _discard_part(path)
+                        continue
+                    mode = 'ab'
+                elif response.status == 200:
+                    length = response.getheader('Content-Length')
+                    total = int(length) if length is not None else None
+                    mode = 'wb'
+                    _save_part_meta(path, url, response)
+                else:
+                    raise RuntimeError(f'HTTP {response.status} for {url}')
+
+                with open(path_part, mode) as f:
+                    while True:
+                        chunk = response.read(chunk_size)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        timing.count(n_bytes=len(chunk))
+                    f.flush()
+                    os.fsync(f.fileno())
+        except (OSError, http.client.HTTPException) as err:
+            # Connection errors and timeouts, keep the partial file to resume from
+            last_error = err
+            continue
+
+        size = path_part.stat().st_size
+        if total is not None and size != total:
+            last_error = RuntimeError(f'Expected {total} bytes, got {size}')
+            if size > total:
+                _discard_part(path)
+            continue
+        if path.suffix.lower() in {'.jpg', '.jpeg'} and not is_valid_jpeg(path_part):
+            _discard_part(path)
+            raise RuntimeError(f'Downloaded file is not a valid JPEG: {url}')
+
+        os.replace(path_part, path)
+        get_part_meta_path(path).unlink(missing_ok=True)
+        return path
+
+    raise RuntimeError(f'Download of {url} failed after {attempts} attempts: {last_error}')
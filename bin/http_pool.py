@@ -0,0 +1,139 @@
+import collections
+import contextlib
+import http.client
+import os
+import threading
+import urllib.parse
+
+import timing
+
+# Each thread keeps one keep-alive connection per (scheme, host), so worker
+# pools reuse TLS sessions instead of reconnecting for every request.
+_local = threading.local()
+
+USER_AGENT = 'bing-desktop-wallpaper-changer'
+MAX_REDIRECTS = 5
+
+Response = collections.namedtuple('Response', ['status', 'headers', 'body', 'url'])
+
+
+def _connections():
+    if not hasattr(_local, 'connections'):
+        _local.connections = {}
+    return _local.connections
+
+
+def _get_connection(scheme: str, netloc: str, timeout: float):
+    key = (scheme, netloc)
+    connections = _connections()
+    connection = connections.get(key)
+    if connection is None:
+        if scheme == 'https':
+            connection = http.client.HTTPSConnection(netloc, timeout=timeout)
+        elif scheme == 'http':
+            connection = http.client.HTTPConnection(netloc, timeout=timeout)
+        else:
+            raise ValueError(f'Unsupported URL scheme: {scheme}')
+        connections[key] = connection
+    connection.timeout = timeout
+    if connection.sock is not None:
+        connection.sock.settimeout(timeout)
+    return connection
+
+
+def _drop_connection(scheme: str, netloc: str):
+    connection = _connections().pop((scheme, netloc), None)
+    if connection is not None:
+        connection.close()
+
+
+def _forget_connections():
+    # A forked child, e.g. of the tile process pool, must not send over the
+    # sockets of its parent, or the requests of both get interleaved
+    global _local
+    _local = threading.local()
+
+
+os.register_at_fork(after_in_child=_forget_connections)
+
+
+def close_all():
+    """
+    Close every pooled connection of the calling thread.
+    """
+    for connection in _connections().values():
+        connection.close()
+    _connections().clear()
+
+
+def _send(method: str, url: str, headers: dict, timeout: float, body: bytes = None):
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    request_headers = {'User-Agent': USER_AGENT}
+    request_headers.update(headers or {})
+
+    # A pooled connection may have been closed by the server while idle,
+    # in that case retry once on a fresh connection.
+    for attempt in range(2):
+        connection = _get_connection(parts.scheme, parts.netloc, timeout)
+        try:
+            connection.request(method, path, body=body, headers=request_headers)
+            return connection.getresponse()
+        except (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                http.client.ResponseNotReady, BrokenPipeError, ConnectionResetError):
+            _drop_connection(parts.scheme, parts.netloc)
+            if attempt:
+                raise
+        except Exception:
+            _drop_connection(parts.scheme, parts.netloc)
+            raise
+
+
+@contextlib.contextmanager
+def stream(url: str, method: str = 'GET', headers: dict = None, timeout: float = 10, body: bytes = None):
+    """
+    Open a pooled HTTP(S) request, following redirects.
+
+    The body can be read incrementally from the yielded response. If it is not
+    read completely, the underlying connection is discarded on exit.
+
+    :param url: Absolute http or https URL.
+    :param method: HTTP method.
+    :param headers: Extra request headers.
+    :param timeout: Socket timeout in seconds.
+    :param body: Request body.
+    :return: http.client.HTTPResponse, with the final URL as its `url` attribute.
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        response = _send(method, url, headers, timeout, body)
+        location = response.getheader('Location')
+        if response.status in (301, 302, 303, 307, 308) and location:
+            response.read()
+            url = urllib.parse.urljoin(url, location)
+            continue
+        break
+    else:
+        raise http.client.HTTPException(f'Too many redirects for {url}')
+
+    response.url = url
+    try:
+        yield response
+    finally:
+        if not response.isclosed():
+            parts = urllib.parse.urlsplit(url)
+            _drop_connection(parts.scheme, parts.netloc)
+
+
+def fetch(url: str, method: str = 'GET', headers: dict = None, timeout: float = 10, body: bytes = None):
+    """
+    Perform a pooled HTTP(S) request and read the whole body.
+
+    :return: Response with status, headers (http.client.HTTPMessage), body and final url.
+    """
+    with stream(url, method, headers, timeout, body) as response:
+        data = response.read()
+    timing.count(n_bytes=len(data))
+    return Response(response.status, response.headers, data, response.url)
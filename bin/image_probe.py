@@ -0,0 +1,88 @@
+import collections
+import functools
+import os
+import pathlib
+import struct
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Start of frame markers, all SOFn except DHT (C4), JPG (C8) and DAC (CC)
+JPEG_SOF_MARKERS = {0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf}
+JPEG_PROGRESSIVE_MARKERS = {0xc2, 0xc6, 0xca, 0xce}
+# Markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01} | set(range(0xd0, 0xd9))
+JPEG_SOS = 0xda
+PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+
+ImageInfo = collections.namedtuple('ImageInfo', ['format', 'width', 'height', 'channels', 'progressive'])
+
+
+def _read_exactly(f, size: int):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError('Truncated image header')
+    return data
+
+
+def _probe_jpeg(f):
+    while True:
+        byte = _read_exactly(f, 1)
+        if byte != b'\xff':
+            raise ValueError('Invalid JPEG marker')
+        # Markers may be preceded by any number of fill bytes
+        while byte == b'\xff':
+            byte = _read_exactly(f, 1)
+        marker = byte[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker == JPEG_SOS:
+            raise ValueError('JPEG has no frame header')
+        length, = struct.unpack('>H', _read_exactly(f, 2))
+        if marker in JPEG_SOF_MARKERS:
+            _, height, width, channels = struct.unpack('>BHHB', _read_exactly(f, 6))
+            return ImageInfo('jpeg', width, height, channels, marker in JPEG_PROGRESSIVE_MARKERS)
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def _probe_png(f):
+    length, chunk_type = struct.unpack('>I4s', _read_exactly(f, 8))
+    if chunk_type != b'IHDR' or length < 13:
+        raise ValueError('PNG does not start with IHDR')
+    width, height, _, color_type, _, _, interlace = struct.unpack('>IIBBBBB', _read_exactly(f, 13))
+    if color_type not in PNG_CHANNELS:
+        raise ValueError(f'Invalid PNG colour type {color_type}')
+    return ImageInfo('png', width, height, PNG_CHANNELS[color_type], interlace == 1)
+
+
+@functools.lru_cache(maxsize=1024)
+def _probe(path: str, mtime_ns: int, size: int):
+    with open(path, 'rb') as f:
+        signature = f.read(len(PNG_SIGNATURE))
+        if signature == PNG_SIGNATURE:
+            return _probe_png(f)
+        if signature[:2] == b'\xff\xd8':
+            f.seek(2)
+            return _probe_jpeg(f)
+    raise ValueError(f'Not a JPEG or PNG image: {path}')
+
+
+def probe(path: pathlib.Path):
+    """
+    Read the dimensions of a JPEG or PNG image from its header, without decoding it.
+
+    Results are cached by path and modification time, so a file that was
+    replaced is probed again.
+
+    :raises ValueError: If the file isn't a valid JPEG or PNG.
+    :return: ImageInfo of format ('jpeg' or 'png'), width, height, number of
+             channels and whether it is progressive (or interlaced).
+    """
+    stat = os.stat(path)
+    return _probe(os.fspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def get_size(path: pathlib.Path):
+    """
+    :return: (width, height) of a JPEG or PNG image.
+    """
+    info = probe(path)
+    return info.width, info.height
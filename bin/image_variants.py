@@ -0,0 +1,130 @@
+import pathlib
+import time
+
+import http_pool
+import json_file
+
+# Bing itself, main and mirror fetch from it unless told otherwise
+BING_URL = 'https://www.bing.com'
+# Sizes Bing publishes the image of the day in, as {urlBase}_{size}.jpg
+VARIANTS = {
+    'UHD': (3840, 2160),
+    '1920x1200': (1920, 1200),
+    '1920x1080': (1920, 1080),
+    '1366x768': (1366, 768),
+    '1280x768': (1280, 768),
+    '1280x720': (1280, 720),
+    '1024x768': (1024, 768),
+    '800x600': (800, 600),
+    '800x480': (800, 480),
+    '640x480': (640, 480),
+    '640x360': (640, 360),
+    '400x240': (400, 240),
+    '320x240': (320, 240),
+    '1080x1920': (1080, 1920),
+    '768x1366': (768, 1366),
+    '768x1280': (768, 1280),
+    '720x1280': (720, 1280),
+    '480x800': (480, 800),
+    '240x320': (240, 320),
+}
+REFERENCE_VARIANT = 'UHD'
+PROBE_TIMEOUT = 10
+# Probed sizes of images that haven't been looked up for this long are dropped
+PRUNE_AGE = 30 * 24 * 60 * 60
+
+
+def get_variant_url(urlbase: str, variant: str, bing_url: str = BING_URL):
+    return f'{bing_url}{urlbase}_{variant}.jpg'
+
+
+def probe(url: str, timeout: float = PROBE_TIMEOUT):
+    """
+    Get the size of a variant with a HEAD request.
+
+    Bing redirects missing variants to a placeholder, so anything but a
+    direct 200 counts as missing.
+
+    :return: Content-Length in bytes, or None if the variant doesn't exist.
+    """
+    response = http_pool.fetch(url, method='HEAD', timeout=timeout)
+    if response.status != 200 or response.url != url:
+        return None
+    if not response.headers.get('Content-Type', '').startswith('image/'):
+        return None
+    length = response.headers.get('Content-Length')
+    return int(length) if length is not None and length.isdigit() else None
+
+
+def get_area(variant: str):
+    width, height = VARIANTS[variant]
+    return width * height
+
+
+def select_variant(urlbase: str, width: int, height: int, path: pathlib.Path, max_bytes: int = -1,
+                   probe=probe, now: float = None, bing_url: str = BING_URL):
+    """
+    Pick the smallest variant of an image that covers width x height.
+
+    Variants are probed lazily, smallest covering one first, so usually only a
+    couple of HEAD requests are made per image, and the results are cached per
+    urlBase. If the covering variant is larger than max_bytes, the smaller
+    variant within max_bytes that covers most of the target is picked instead,
+    preferring the target's orientation.
+
+    :param urlbase: urlBase of the image metadata, e.g. /th?id=OHR.Example_EN-US1234567890.
+    :param path: Path to the JSON cache file.
+    :param max_bytes: Size limit of the download, disabled if not positive.
+    :param probe: Callable (url) -> size in bytes or None, see probe.
+    :return: Tuple of (variant, its size in bytes, size of the UHD variant in bytes or None),
+             or None if no variant could be found.
+    """
+    now = time.time() if now is None else now
+    cache = json_file.load(path)
+    entry = cache.setdefault(urlbase, {'sizes': {}})
+    sizes = entry['sizes']
+    changed = entry.get('used', 0) < now - 24 * 60 * 60
+
+    def get_size(variant):
+        nonlocal changed
+        if variant not in sizes:
+            sizes[variant] = probe(get_variant_url(urlbase, variant, bing_url))
+            changed = True
+        return sizes[variant]
+
+    by_area = sorted(VARIANTS, key=get_area)
+    covering = [variant for variant in by_area
+                if VARIANTS[variant][0] >= width and VARIANTS[variant][1] >= height]
+
+    def is_same_orientation(variant):
+        variant_width, variant_height = VARIANTS[variant]
+        return (variant_width >= variant_height) == (width >= height)
+
+    def get_fit(variant):
+        # Pixels of the target the variant covers, e.g. a portrait variant covers
+        # less of a landscape screen than a landscape one of the same area
+        variant_width, variant_height = VARIANTS[variant]
+        return is_same_orientation(variant), min(variant_width, width) * min(variant_height, height), get_area(variant)
+
+    selected = next((variant for variant in covering if get_size(variant) is not None), None)
+    if selected is None or 0 < max_bytes < sizes[selected]:
+        # Nothing covers the target or it is too large, fall back to the smaller variant that covers most of it
+        smaller = sorted((variant for variant in by_area
+                          if selected is None or get_area(variant) < get_area(selected)),
+                         key=get_fit, reverse=True)
+        fallback = next((variant for variant in smaller
+                         if get_size(variant) is not None and not 0 < max_bytes < sizes[variant]), None)
+        if fallback is None and selected is not None:
+            # Nothing fits, take the smallest there is in the target's orientation
+            fallback = min((variant for variant in smaller if sizes.get(variant) is not None),
+                           key=lambda variant: (not is_same_orientation(variant), sizes[variant]), default=None)
+        selected = fallback or selected
+
+    reference = get_size(REFERENCE_VARIANT)
+    if changed:
+        entry['used'] = now
+        cache = {key: value for key, value in cache.items() if value.get('used', now) > now - PRUNE_AGE}
+        json_file.save(path, cache)
+    if selected is None:
+        return None
+    return selected, sizes[selected], reference
@@ -0,0 +1,24 @@
+import json
+import os
+import pathlib
+
+
+def load(path: pathlib.Path):
+    """
+    :return: The JSON object in path, or an empty dict if it is missing or unreadable.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save(path: pathlib.Path, data: dict, indent: int = None):
+    """
+    Write a JSON object through a temporary file, so readers never see a partial file.
+    """
+    path_tmp = path.with_name(path.name + '.tmp')
+    with open(path_tmp, 'w') as f:
+        json.dump(data, f, indent=indent)
+    os.replace(path_tmp, path)
@@ -3,20 +3,38 @@
 
 import locale
 import pathlib
+import signal
 import sys
+import threading
 import time
 import urllib.error
 import urllib.parse
-import urllib.request
 import xml.etree.ElementTree as ET
-from configparser import ConfigParser
-from subprocess import check_output
 
-import gi
-from gi.repository import Gio, Gtk, Notify
-
-gi.require_version('Gtk', '3.0')
-gi.require_version('Notify', '0.7')
+import archive_index
+import blob_store
+import catalog
+import connectivity
+import derivative_cache
+import desktop
+import download
+import image_probe
+import image_variants
+import metadata_cache
+import pipeline
+import screen_layout
+import settings
+import timing
+
+# Overridden by the benchmarks, which serve the API from a local stand-in
+BING_URL = image_variants.BING_URL
+# Set once the configured mirror failed, the rest of the run goes to Bing
+_mirror_failed = False
+# Seconds a mirror on the LAN may take to answer once the network is known to be up
+MIRROR_PROBE_TIMEOUT = 2
+APP_NAME = 'Bing Desktop Wallpaper'
+# gi.repository.Notify, imported by get_notify()
+Notify = None
 
 BING_MARKETS = [u'ar-XA',
                 u'bg-BG',
@@ -91,33 +109,142 @@ dir_path =
 # limit is the size of 1 image (whatever size that image is)
 # Set to negative value for unlimit. Default value is 100MiB
 dir_max_size =
+# Limit the number of files in the directory.
+# Set to negative value for unlimit (default)
+dir_max_count =
+# Delete images older than this number of days.
+# Set to negative value for unlimit (default)
+dir_max_age =
+# Order in which images are deleted when a limit is exceeded:
+# name (oldest image first, default) or lru (least recently shown first)
+# Pinned images (main.py --pin) are never deleted
+eviction =
+[screen]
+# Layout on multiple monitors: largest (default), per-monitor or span.
+# largest sets the image sized for the largest monitor, per-monitor shows the
+# whole image on every monitor and span stretches one image across all of them.
+# The image is downloaded once, the other two are composed from it locally
+layout =
+[rotation]
+# Order of main.py --rotate: shuffle (default), chronological or favourites
+# (pinned images only, shuffled)
+order =
+# Minutes between wallpaper changes of main.py --rotate --daemon. Default value is 30
+interval =
+[network]
+# Seconds to wait for a network connection at login. Default value is 60
+timeout =
+# Maximum size of a downloaded image in bytes. The smallest size Bing offers
+# that covers the screen is downloaded, or a smaller one if it exceeds this.
+# Set to negative value for unlimit (default)
+max_image_size =
+# Same on metered connections, e.g. a mobile hotspot. Default value is 1MiB
+metered_max_image_size =
+# Base URL of a mirror started with main.py --serve on another machine, e.g.
+# http://mirror.lan:8080. Bing is used if the mirror can't be reached.
+# Leave empty to download from Bing (default)
+upstream =
+[upscale]
+# Upscaling backend: auto (default), arbsr-cpu, arbsr-gpu or lanczos.
+# auto runs a short benchmark once and picks ArbSR if it is expected to finish
+# within time_budget, and the much faster Lanczos resampling otherwise
+backend =
+# Seconds an upscale may take with backend = auto. Default value is 600
+time_budget =
+# URLs of persistent upscaler workers (cog HTTP API of arbsr-cpu), comma separated.
+# Set to auto to start local arbsr-cpu containers on first use and keep them running.
+# Leave empty to start a new container for every upscale.
+worker_urls =
+# Number of local workers started by worker_urls = auto. Default value is 1
+workers =
+# Format of upscaled images: png (lossless, default), jpeg or webp
+format =
+# zlib level of png, 0 (fastest, largest) to 9 (slowest, smallest). Default value is 6
+png_compression =
+# Quality of jpeg and webp, 1 to 100. Default value is 95
+quality =
+# Upscaled images are kept in ~/.cache/bing-desktop-wallpaper-changer/derivatives/,
+# separate from the download directory. Limit its size in bytes, the least
+# recently shown images are deleted first. Set to negative value for unlimit.
+# Default value is 500MiB
+cache_max_size =
+[timing]
+# File the duration, bytes and files of every phase of a run are appended to,
+# as JSON lines. Leave empty to disable (default)
+log =
+# Prometheus textfile collector file (*.prom) with the phases of the last run.
+# Leave empty to disable (default)
+prometheus_textfile =
 """
 
 
-def get_file_uri(filename):
-    return f'file://{filename}'
+def change_background(filename, desktop_environment, spanned: bool = False):
+    """
+    :param spanned: Stretch the image across all monitors, for images composed by screen_layout.
+    """
+    desktop.get_desktop(desktop_environment).set_background(filename, spanned)
+    mark_shown(filename)
+
+
+def get_current_background(desktop_environment):
+    """
+    :return: Path of the current wallpaper, or None if it isn't a local file.
+    """
+    return desktop.get_desktop(desktop_environment).get_background()
+
+
+def change_screensaver(filename, desktop_environment):
+    desktop.get_desktop(desktop_environment).set_screensaver(filename)
 
 
-def set_gsetting(schema, key, value):
-    gsettings = Gio.Settings.new(schema)
-    gsettings.set_string(key, value)
-    gsettings.apply()
+def get_config_dir():
+    """
+    Get the program's config directory.
 
+    :return: Path to the program's config directory.
+    """
+    config_dir = pathlib.Path.home() / '.config/bing-desktop-wallpaper-changer'
+    init_dir(config_dir)
+    return config_dir
 
-def change_background(filename, desktop_environment):
-    set_gsetting(f'org.{desktop_environment}.desktop.background', 'picture-uri',
-                 get_file_uri(filename))
 
+def get_cache_dir():
+    """
+    Get the program's cache directory, for data that can be recreated.
 
-def get_current_background_uri(desktop_environment):
-    gsettings = Gio.Settings.new(f'org.{desktop_environment}.desktop.background')
-    path = gsettings.get_string('picture-uri')
-    return pathlib.Path(path[7:])
+    :return: Path to the program's cache directory.
+    """
+    cache_dir = pathlib.Path.home() / '.cache/bing-desktop-wallpaper-changer'
+    init_dir(cache_dir)
+    return cache_dir
 
 
-def change_screensaver(filename, desktop_environment):
-    set_gsetting(f'org.{desktop_environment}.desktop.screensaver', 'picture-uri',
-                 get_file_uri(filename))
+def get_upscale_queue_dir():
+    return get_cache_dir() / 'upscale-jobs'
+
+
+def get_rotation_dir():
+    """
+    Directory of the images rendered for the screen by --rotate, kept apart
+    from the download directory so they don't count towards its limits.
+    """
+    rotation_dir = get_cache_dir() / 'rotation'
+    init_dir(rotation_dir)
+    return rotation_dir
+
+
+def get_derivative_cache_dir():
+    cache_dir = get_cache_dir() / 'derivatives'
+    init_dir(cache_dir)
+    return cache_dir
+
+
+def get_metadata_cache_file():
+    return get_config_dir() / 'metadata-cache.json'
+
+
+def get_image_variants_file():
+    return get_config_dir() / 'image-variants.json'
 
 
 def get_config_file():
@@ -126,15 +253,22 @@ def get_config_file():
 
     :return: Path to the program's config file.
     """
-    config_dir = pathlib.Path.home() / '.config/bing-desktop-wallpaper-changer'
-    init_dir(config_dir)
-    config_path = config_dir / 'config.ini'
+    config_path = get_config_dir() / 'config.ini'
     if not config_path.is_file():
         with open(config_path, 'w') as config_file:
             config_file.write(config_file_skeleton)
     return config_path
 
 
+def get_settings():
+    """
+    Get the settings of the config file, parsed once and again only after it changed.
+
+    :return: settings.Settings
+    """
+    return settings.load(get_config_file())
+
+
 def get_market():
     """
     Get the desired Bing Market.
@@ -147,9 +281,7 @@ def get_market():
     :return: Bing Market
     :rtype: str
     """
-    config = ConfigParser()
-    config.read(get_config_file())
-    market_area_override = config.get('market', 'area')
+    market_area_override = get_settings().market_area
     if market_area_override:
         return market_area_override
 
@@ -162,62 +294,219 @@ def get_market():
 
 def get_download_path():
     # By default images are saved to '/home/[user]/[Pictures]/BingWallpapers/'
-    default_path = check_output("xdg-user-dir PICTURES", shell=True).strip().decode("utf-8") + "/BingWallpapers"
-
-    try:
-        config = ConfigParser()
-        config.read(get_config_file())
-        path = config.get('directory', 'dir_path')
-
-        return pathlib.Path(path or default_path)
-    except Exception:
-        return pathlib.Path(default_path)
+    return pathlib.Path(get_settings().dir_path or settings.get_user_dir('PICTURES') / 'BingWallpapers')
 
 
 def get_directory_limit():
     """
     Get the directory sized limit
     """
-    config = ConfigParser()
-    config.read(get_config_file())
-    try:
-        size = config.getint('directory', 'dir_max_size')
-        return size
-    except Exception:
-        return 100 * 1024 * 1024
+    return get_settings().dir_max_size
+
+
+def get_connection_timeout():
+    """
+    Get the number of seconds to wait for a network connection.
+    """
+    return get_settings().timeout
+
+
+def get_layout_mode():
+    """
+    Get how the wallpaper is laid out over multiple monitors, see screen_layout.LAYOUT_MODES.
+    """
+    return get_settings().layout
+
+
+def get_rotation_order():
+    """
+    Get the order in which --rotate shows the archived images, see archive_index.ROTATION_ORDERS.
+    """
+    return get_settings().rotation_order
+
+
+def get_rotation_interval():
+    """
+    Get the number of seconds between wallpaper changes in rotation mode.
+    """
+    return max(1, int(get_settings().rotation_interval * 60))
+
+
+def get_upstream_url():
+    """
+    Get the base URL the metadata and images are fetched from: the configured
+    mirror, or Bing if there is none or it failed during this run.
+    """
+    if _mirror_failed:
+        return BING_URL
+    return get_settings().upstream or BING_URL
+
+
+def fall_back_to_bing(err):
+    """
+    Stop using the mirror for the rest of the run after a request to it failed.
+
+    :return: True if a mirror was in use, so the request should be repeated against Bing.
+    """
+    global _mirror_failed
+    upstream = get_upstream_url()
+    if upstream == BING_URL:
+        return False
+    print(f'Mirror {upstream} failed ({err}), falling back to Bing')
+    _mirror_failed = True
+    return True
+
+
+def get_max_image_size():
+    """
+    Get the size limit of a downloaded image in bytes, depending on whether the network is metered.
+    """
+    if connectivity.is_metered():
+        return get_settings().metered_max_image_size
+    return get_settings().max_image_size
+
+
+def get_eviction_policy():
+    """
+    Get the limits of the download directory.
+
+    :return: archive_index.EvictionPolicy
+    """
+    config = get_settings()
+    return archive_index.EvictionPolicy(
+        max_size=config.dir_max_size,
+        max_count=config.dir_max_count,
+        max_age=config.dir_max_age,
+        order=config.eviction)
+
+
+def get_derivative_encoding():
+    """
+    :return: derivative_cache.Encoding of upscaled images.
+    """
+    return derivative_cache.Encoding(get_settings().upscale_format, get_settings().png_level,
+                                     get_settings().upscale_quality)
+
+
+def get_upscale_model_ids():
+    """
+    Get the models whose upscaled images can be shown, best first.
+
+    :return: List of upscale_arbsr.MODEL_IDS values.
+    """
+    import upscale_arbsr
+
+    name = get_settings().upscale_backend
+    # The backends auto chooses from, see select_upscale_backend
+    names = ['arbsr-cpu', 'lanczos'] if name == 'auto' else [name]
+    return [upscale_arbsr.MODEL_IDS[name] for name in names]
+
+
+def get_upscale_backend():
+    """
+    Get the backend that upscales an image (or tile), see upscale_arbsr.
+
+    :return: Function (path_input, target_width, target_height, directory_working) -> path_output
+    """
+    import functools
+
+    import upscale_arbsr
+    import upscale_worker
+
+    worker_urls = get_settings().worker_urls
+    if not worker_urls:
+        return upscale_arbsr.upscale_cpu
+
+    if worker_urls == 'auto':
+        try:
+            base_urls = upscale_worker.ensure_local_workers(get_settings().workers)
+        except Exception as err:
+            print(f'Not using upscaler workers: {err}')
+            return upscale_arbsr.upscale_cpu
+    else:
+        base_urls = [url.strip().rstrip('/') for url in worker_urls.split(',') if url.strip()]
+    return functools.partial(upscale_worker.upscale, base_urls=base_urls, fallback=upscale_arbsr.upscale_cpu)
+
+
+def get_upscale_benchmark_file():
+    return get_config_dir() / 'upscale-benchmark.json'
+
+
+def select_upscale_backend(pixels: int):
+    """
+    Select the upscaling backend for an image with this many output pixels.
+
+    :return: Tuple of (backend name, backend function).
+    """
+    import upscale_arbsr
+    import upscale_select
+
+    name = get_settings().upscale_backend
+    time_budget = get_settings().time_budget
+
+    if name == 'arbsr-gpu':
+        return name, upscale_arbsr.upscale_gpu
+    if name == 'lanczos':
+        return name, upscale_arbsr.upscale_lanczos
+
+    # Only built when it may be used, it may start the local workers
+    backends = {
+        'arbsr-cpu': get_upscale_backend(),
+        'lanczos': upscale_arbsr.upscale_lanczos,
+    }
+    if name in backends:
+        return name, backends[name]
+
+    benchmarks = upscale_select.get_benchmarks(backends, get_upscale_benchmark_file())
+    name = upscale_select.select_backend(list(backends), benchmarks, pixels, time_budget)
+    if name is None:
+        raise RuntimeError('No upscaling backend available')
+    return name, backends[name]
 
 
-def get_bing_xml():
+def get_bing_xml(market: str = None, idx: int = 0, n: int = 1):
     """
     Get BingXML file which contains the URL of the Bing Photo of the day.
 
+    :param market: Bing Market Area, defaults to get_market().
+    :param idx: Number of days previous the present day.
+    :param n: Number of images to return, starting at idx.
     :return: URL with the Bing Photo of the day.
     """
     # idx = Number days previous the present day.
     # 0 means today, 1 means yesterday
     # n = Number of images previous the day given by idx
     # mkt = Bing Market Area, see get_valid_bing_markets.
-    market = get_market()
-    return f"https://www.bing.com/HPImageArchive.aspx?format=xml&idx=0&n=1&mkt={market}"
+    if market is None:
+        market = get_market()
+    return f"{get_upstream_url()}/HPImageArchive.aspx?format=xml&idx={idx}&n={n}&mkt={market}"
 
 
 def get_maximum_screen_resolution():
-    window = Gtk.Window()
-    screen = window.get_screen()
-    nmons = screen.get_n_monitors()
-    maxw = 0
-    maxh = 0
-    if nmons == 1:
-        maxw = screen.get_width()
-        maxh = screen.get_height()
-    else:
-        for m in range(nmons):
-            mg = screen.get_monitor_geometry(m)
-            if mg.width > maxw or mg.height > maxw:
-                maxw = mg.width
-                maxh = mg.height
+    """
+    Get the size the wallpaper is needed at in the configured layout.
 
-    return maxw, maxh
+    :return: (width, height)
+    """
+    return screen_layout.get_required_size(screen_layout.get_monitors(), get_layout_mode())
+
+
+def get_layout_wallpaper(image_path: pathlib.Path, added: list):
+    """
+    Get the file to show for an image in the configured layout, composing it if needed.
+
+    :param added: Newly written files are appended to this list.
+    :return: Path to the image itself, or to an image composed for all monitors.
+    """
+    monitors = screen_layout.get_monitors()
+    mode = get_layout_mode()
+    if not screen_layout.is_composed(monitors, mode):
+        return image_path
+    path = screen_layout.get_composed_path(image_path, monitors, mode)
+    if not path.exists() or image_path in added:
+        screen_layout.compose(image_path, monitors, mode, path)
+        added.append(path)
+    return path
 
 
 def get_screen_resolution():
@@ -230,8 +519,9 @@ def get_screen_resolution():
              [1366, [768]], [1920, [1080, 1200]], [2560, [1440]], [3840, [2160]]]
     sizes_mobile = [[768, [1024]], [720, [1280]],
                     [768, [1280, 1366]], [1080, [1920]]]
-    default_w = 1920
-    default_h = 1080
+    # Larger screens (or a span of several) get the largest size Bing has
+    default_w = 3840
+    default_h = 2160
     default_mobile_w = 1080
     default_mobile_h = 1920
     is_mobile = False
@@ -267,27 +557,35 @@ def get_screen_resolution():
     return sizew, sizeh
 
 
-def get_image_metadata():
+def get_image_metadata(refresh: bool = False):
     """
     Get Bing wallpaper metadata.
 
+    The response is cached until Bing's next rollover, see metadata_cache.
+
+    :param refresh: Revalidate a cached response even if it hasn't expired.
     :return: XML tag object for the wallpaper image.
     """
-    bing_xml_url = get_bing_xml()
-    page = urllib.request.urlopen(bing_xml_url)
+    try:
+        page = metadata_cache.fetch(get_bing_xml(), get_metadata_cache_file(), refresh)
+    except Exception as err:
+        if not fall_back_to_bing(err):
+            raise
+        page = metadata_cache.fetch(get_bing_xml(), get_metadata_cache_file(), refresh)
 
-    bing_xml = ET.parse(page).getroot()
+    bing_xml = ET.fromstring(page)
 
     # For extracting complete URL of the image
     images = bing_xml.findall('image')
     return images[0]
 
 
-def get_image_url(metadata):
+def get_image_url(metadata, size=None):
     """
     Get an appropriate Wallpaper URL based on your screen resolution.
 
     :param metadata: XML tag object with image metadata.
+    :param size: Optional (width, height), defaults to get_screen_resolution().
     :return: URL with Bing Wallpaper image.
     """
     base_image = metadata.find("url").text
@@ -295,8 +593,39 @@ def get_image_url(metadata):
     # from your main monitor
     image_id = dict(urllib.parse.parse_qsl(base_image[base_image.find("?") + 1:]))["id"]
     image_id = "_".join(image_id.split("_")[:-1])
-    sizew, sizeh = get_screen_resolution()
-    return f"https://bing.com/th?id={image_id}_UHD.jpg&rf=LaDigue_UHD.jpg&pid=hp&w={sizew}&h={sizeh}"
+    sizew, sizeh = size or get_screen_resolution()
+    return f"{get_upstream_url()}/th?id={image_id}_UHD.jpg&rf=LaDigue_UHD.jpg&pid=hp&w={sizew}&h={sizeh}"
+
+
+def get_image_variant_url(metadata, size=None):
+    """
+    Get the URL of the smallest size Bing offers that covers the screen, see image_variants.
+
+    Falls back to get_image_url if the sizes can't be probed.
+
+    :param metadata: XML tag object with image metadata.
+    :param size: Optional (width, height), defaults to get_maximum_screen_resolution().
+    :return: URL with Bing Wallpaper image.
+    """
+    width, height = size or get_maximum_screen_resolution()
+    urlbase = catalog.get_text(metadata, 'urlBase', 'urlbase')
+    if urlbase is None:
+        return get_image_url(metadata, size)
+    try:
+        selected = image_variants.select_variant(
+            urlbase, width, height, get_image_variants_file(), get_max_image_size(),
+            bing_url=get_upstream_url())
+    except Exception as err:
+        print(f'Could not probe image sizes: {err}')
+        selected = None
+    if selected is None:
+        return get_image_url(metadata, size)
+
+    variant, variant_bytes, reference_bytes = selected
+    if reference_bytes is not None:
+        print(f'Downloading {variant} ({variant_bytes} bytes), '
+              f'{reference_bytes - variant_bytes} bytes less than {image_variants.REFERENCE_VARIANT}')
+    return image_variants.get_variant_url(urlbase, variant, get_upstream_url())
 
 
 def init_dir(path: pathlib.Path):
@@ -321,113 +650,278 @@ def p2_dirscan(path):
     return files, size
 
 
-def check_limit():
+def check_limit(added=(), protect=(), hashes=None, dir_mtime: int = None):
+    """
+    Delete images until the download directory is within its configured limits.
+
+    :param added: Files written by this run, registered without rescanning the directory.
+    :param protect: Files that must not be deleted, e.g. the current wallpaper.
+    :param hashes: Dict of downloaded images to Bing's hsh. They are moved into the
+        blob store, so the photo isn't downloaded or stored again.
+    :param dir_mtime: st_mtime_ns of the download directory before this run wrote to it.
+        If the index was up to date then, the directory isn't listed again just
+        because of the files in added.
+    """
     download_path = get_download_path()
-    (files, size) = p2_dirscan(download_path)
-    max_size = get_directory_limit()
-    while (max_size > 0 and size > max_size and len(files) > 1):
-        files[0][0].unlink()
-        size = size - files[0][1]
-        del files[0]
+    with archive_index.open_index(download_path) as index:
+        if dir_mtime is None or not archive_index.is_current(index, dir_mtime):
+            timing.count(n_files=archive_index.sync(index, download_path))
+        for path, hsh in (hashes or {}).items():
+            blob_store.add(index, archive_index.get_blob_dir(download_path), path, hsh)
+        for path in added:
+            archive_index.add(index, path)
+        archive_index.evict(index, download_path, get_eviction_policy(),
+                            protect=[pathlib.Path(path).name for path in protect])
+
+
+def link_stored_image(metadata, image_path: pathlib.Path, size=None):
+    """
+    Link image_path to a stored copy of the photo, if one covers the screen.
 
+    :param metadata: XML tag object with image metadata.
+    :param size: Optional (width, height), defaults to get_maximum_screen_resolution().
+    :return: True if image_path was linked and needs no download.
+    """
+    download_path = image_path.parent
+    with archive_index.open_index(download_path) as index:
+        path_blob = blob_store.find(index, archive_index.get_blob_dir(download_path), catalog.get_text(metadata, 'hsh'),
+                                    *(size or get_maximum_screen_resolution()))
+    if path_blob is None:
+        return False
+    blob_store.link(path_blob, image_path)
+    return True
 
-def wait_for_internet_connection(url, timeout, timeout_urlopen):
-    time_start = time.monotonic()
-    while True:
-        try:
-            time_loop = time.monotonic()
-            urllib.request.urlopen(url, timeout=timeout_urlopen)
-            break
-        except Exception as e:
-            time_now = time.monotonic()
-            if time_now - time_start > timeout:
-                raise e
 
-            seconds_sleep = max(0, timeout_urlopen - (time_now - time_loop))
-            time.sleep(seconds_sleep)
+def mark_shown(path: pathlib.Path):
+    """
+    Record in the archive index that path was set as the wallpaper.
+    """
+    path = pathlib.Path(path)
+    if path.parent in (get_derivative_cache_dir(), get_rotation_dir()):
+        # An upscaled or rendered image, which is kept apart from its source
+        derivative_cache.touch(path)
+        _, source = archive_index.classify(path.name)
+        if source is None:
+            return
+        path = get_download_path() / source
+    if path.parent != get_download_path():
+        return
+    with archive_index.open_index(path.parent) as index:
+        archive_index.mark_shown(index, path)
+
+
+def set_pinned(name: str, pinned: bool):
+    """
+    Pin or unpin an image in the download directory.
+    """
+    download_path = get_download_path()
+    with archive_index.open_index(download_path) as index:
+        archive_index.sync(index, download_path)
+        if not archive_index.set_pinned(index, pathlib.Path(name).name, pinned):
+            print(f'{name} is not in {download_path}')
+            sys.exit(1)
+    sys.exit(0)
+
 
+def wait_for_internet_connection(url, timeout):
+    """
+    Wait until url is reachable, see connectivity.wait_for_connection.
+    """
+    monitor = connectivity.get_network_monitor()
+    connectivity.wait_for_connection(url, timeout, monitor, use_glib=monitor is not None)
 
-def show_notification(summary: str, body: str, path_icon: pathlib.Path):
-    path_icon = path_icon if path_icon.exists() else None
-    app_notification = Notify.Notification.new(summary, str(body), str(path_icon))
-    app_notification.show()
 
+def wait_for_upstream(timeout):
+    """
+    Wait until the network is up and fall back to Bing if the mirror isn't reachable then.
 
-def main(force: bool, desktop_environment: str, upscale_fancy: bool):
+    A mirror that's down is probed once with a short timeout instead of
+    retrying it for the whole timeout: whether the network is up is told by
+    the network monitor or by reaching Bing.
     """
-    Main application entry point.
+    upstream = get_upstream_url()
+    if upstream == BING_URL:
+        wait_for_internet_connection(BING_URL, timeout)
+        return
+    monitor = connectivity.get_network_monitor()
+    probed = monitor is None or monitor.get_network_available()
+    if probed and connectivity.probe(upstream, MIRROR_PROBE_TIMEOUT):
+        return
+    wait_for_internet_connection(BING_URL, timeout)
+    # The mirror wasn't probed while the network was down, give it its chance now
+    if not probed and connectivity.probe(upstream, MIRROR_PROBE_TIMEOUT):
+        return
+    fall_back_to_bing(ConnectionError(f'{upstream} not reachable'))
+
+
+def get_notify():
     """
-    app_name = 'Bing Desktop Wallpaper'
-    Notify.init(app_name)
-    exit_status = 0
+    Get libnotify, imported and initialised when the first notification is shown.
+    """
+    global Notify
+    if Notify is None:
+        import gi
+        gi.require_version('Notify', '0.7')
+        from gi.repository import Notify as _Notify
+        _Notify.init(APP_NAME)
+        Notify = _Notify
+    return Notify
 
-    # Setup Notifications
+
+def show_notification(summary: str, body: str, path_icon: pathlib.Path):
+    path_icon = path_icon if path_icon.exists() else None
+    app_notification = get_notify().Notification.new(summary, str(body), str(path_icon))
+    app_notification.show()
+
+
+def get_icon_path():
     path_bing_wallpaper = pathlib.Path(__file__).resolve()
     path_icon = path_bing_wallpaper.parent / 'icon.svg'
     if not path_icon.exists():
         # Fallback to set of included icons
         # Likely in development environment
         path_icon = path_bing_wallpaper.parent.parent / 'icon/Bing.svg'
+    return path_icon
 
-    try:
-        wait_for_internet_connection('https://www.bing.com', 1, 2)
-    except Exception as err:
-        print(err)
 
-        summary = f'Error executing {app_name}'
-        body = str(err)
-        show_notification(summary, str(body), path_icon)
-        sys.exit(1)
+def run(force: bool, desktop_environment: str, upscale_fancy: bool):
+    """
+    Update the wallpaper once.
 
-    # Determine desktop environment
-    if desktop_environment is None:
-        desktop_environment = 'gnome'
-        source = Gio.SettingsSchemaSource.get_default()
-        cinnamon_exists = source.lookup('org.cinnamon.desktop.background', True)
-        if cinnamon_exists:
-            desktop_environment = 'cinnamon'
+    :return: Exit status.
+    """
+    global _mirror_failed
+    app_name = APP_NAME
+    exit_status = 0
+    # Try the mirror again, it may be back since the last run of the daemon
+    _mirror_failed = False
 
-    try:
-        image_metadata = get_image_metadata()
-        image_name = image_metadata.find("startdate").text + ".jpg"
-        image_url = get_image_url(image_metadata)
+    # Setup Notifications
+    path_icon = get_icon_path()
+
+    def wait_for_network():
+        # The network isn't needed while the cached metadata is still current
+        if force or not metadata_cache.is_fresh(get_bing_xml(), get_metadata_cache_file()):
+            wait_for_upstream(get_connection_timeout())
 
+    def get_desktop():
+        # Determine desktop environment
+        name = desktop.detect() if desktop_environment is None else desktop_environment
+        # The user may have changed the wallpaper since the last run of the daemon
+        desktop.get_desktop(name).refresh()
+        return name, get_current_background(name)
+
+    dir_mtime = None
+
+    def get_download_dir():
+        nonlocal dir_mtime
         download_path = get_download_path()
         init_dir(download_path)
-        image_path = download_path / image_name
-
-        if not image_path.is_file() or force:
-            urllib.request.urlretrieve(image_url, image_path)
-            change_background(image_path, desktop_environment)
-            change_screensaver(image_path, 'gnome')
+        # Before this run writes to it, see check_limit
+        dir_mtime = download_path.stat().st_mtime_ns
+        return download_path
+
+    def get_image_path(image_metadata, download_path):
+        image_path = download_path / (image_metadata.find("startdate").text + ".jpg")
+        needed = not image_path.is_file() or not download.is_valid_jpeg(image_path) or force
+        return image_path, needed
+
+    def link_stored(image_metadata, image):
+        # The same photo may be stored already, e.g. downloaded for another market
+        image_path, needed = image
+        return needed and not force and link_stored_image(image_metadata, image_path)
+
+    def select_variant(image_metadata, image, stored):
+        _, needed = image
+        return get_image_variant_url(image_metadata) if needed and not stored else None
+
+    def download_image(image_metadata, image, stored, image_url):
+        image_path, needed = image
+        if needed and not stored:
+            try:
+                download.download(image_url, image_path)
+            except Exception as err:
+                if not fall_back_to_bing(err):
+                    raise
+                download.download(get_image_variant_url(image_metadata), image_path)
+        return needed
+
+    def get_wallpaper(image, downloaded):
+        image_path, _ = image
+        added = [image_path] if downloaded else []
+        wallpaper_path = get_layout_wallpaper(image_path, added)
+        return wallpaper_path, added
+
+    def set_wallpaper(image_metadata, image, downloaded, wallpaper, current):
+        image_path, _ = image
+        wallpaper_path, _ = wallpaper
+        desktop_environment, current_path = current
+        spanned = wallpaper_path != image_path
+        # Also unchanged if an upscaled derivative of the image is shown
+        current_source = None
+        if current_path is not None:
+            _, current_source = archive_index.classify(current_path.name)
+            # Upscaled images are in the derivative cache, their source in the download directory
+            current_source = image_path.with_name(current_source) if current_source else None
+
+        if downloaded:
+            change_background(wallpaper_path, desktop_environment, spanned)
+            change_screensaver(image_path, desktop_environment)
             summary = 'Bing Wallpaper updated successfully'
-            body = image_metadata.find("copyright").text.encode('utf-8')
-
-            text = str(image_name) + " -- " + str(body) + "\n"
-            with open(download_path / "image-details.txt", "a+") as myfile:
-                myfile.write(text)
-
-        elif (
-            get_current_background_uri(desktop_environment).exists() and
-            (get_current_background_uri(desktop_environment).samefile(image_path) or
-             (get_current_background_uri(desktop_environment).parent /
-             '_'.join(get_current_background_uri(desktop_environment).stem.split('_')[:-1])).with_suffix('.jpg')
-                .samefile(image_path)
-             )
+            body = image_metadata.find("copyright").text
+
+        elif current_path is not None and current_path.exists() and (
+            current_path.samefile(wallpaper_path) or
+            (not spanned and current_source is not None and current_source.exists() and
+             current_source.samefile(image_path))
         ):
             summary = 'Bing Wallpaper unchanged'
-            body = ('%s already exists in Wallpaper directory' %
-                    image_metadata.find("copyright").text.encode('utf-8'))
+            body = f'{image_metadata.find("copyright").text} already exists in Wallpaper directory'
 
         else:
-            change_background(image_path, desktop_environment)
-            change_screensaver(image_path, 'gnome')
+            change_background(wallpaper_path, desktop_environment, spanned)
+            change_screensaver(image_path, desktop_environment)
             summary = 'Wallpaper changed to current Bing wallpaper'
-            body = ('%s already exists in Wallpaper directory' %
-                    image_metadata.find("copyright").text.encode('utf-8'))
-        check_limit()
-
+            body = f'{image_metadata.find("copyright").text} set from Wallpaper directory'
         show_notification(summary, str(body), path_icon)
+
+    def add_to_catalog(image_metadata, image, downloaded, download_path):
+        if downloaded:
+            image_path, _ = image
+            with catalog.open_catalog(download_path) as image_catalog:
+                catalog.add_image(image_catalog, image_metadata, get_market(), image_path)
+
+    def evict(image_metadata, image, downloaded, stored, wallpaper):
+        image_path, _ = image
+        wallpaper_path, added = wallpaper
+        hashes = {image_path: catalog.get_text(image_metadata, 'hsh')} if downloaded and not stored else None
+        check_limit(added, protect=[image_path, wallpaper_path], hashes=hashes, dir_mtime=dir_mtime)
+
+    # Network requests run in order on the network lane, whose thread and
+    # connections are kept across the runs of a daemon. Waiting for the
+    # network may need a GLib main loop, so it stays on the main thread with
+    # GTK and GSettings. The catalog and the eviction
+    # run after the wallpaper is set, so they don't delay the visible change.
+    tasks = pipeline.Pipeline()
+    tasks.add('network_wait', wait_for_network, lane=pipeline.MAIN)
+    tasks.add('download_path', get_download_dir)
+    tasks.add('metadata', lambda: get_image_metadata(refresh=force), after=['network_wait'], lane='network')
+    tasks.add('desktop', get_desktop, lane=pipeline.MAIN)
+    tasks.add('monitors', screen_layout.get_monitors, lane=pipeline.MAIN)
+    tasks.add('image_path', get_image_path, ['metadata', 'download_path'])
+    # The screen size comes from the monitors queried on the main thread
+    tasks.add('stored', link_stored, ['metadata', 'image_path'], after=['monitors'])
+    tasks.add('variant_select', select_variant, ['metadata', 'image_path', 'stored'], lane='network')
+    tasks.add('download', download_image, ['metadata', 'image_path', 'stored', 'variant_select'], lane='network')
+    tasks.add('layout', get_wallpaper, ['image_path', 'download'], after=['monitors'])
+    tasks.add('set_wallpaper', set_wallpaper, ['metadata', 'image_path', 'download', 'layout', 'desktop'],
+              lane=pipeline.MAIN)
+    tasks.add('catalog', add_to_catalog, ['metadata', 'image_path', 'download', 'download_path'],
+              after=['set_wallpaper'])
+    tasks.add('check_limit', evict, ['metadata', 'image_path', 'download', 'stored', 'layout'],
+              after=['set_wallpaper'])
+    try:
+        results = tasks.run()
     except Exception as err:
         print(err)
 
@@ -439,61 +933,58 @@ def main(force: bool, desktop_environment: str, upscale_fancy: bool):
         except:
             pass
         show_notification(summary, str(body), path_icon)
-        sys.exit(1)
+        return 1
 
-    if upscale_fancy:
-        try:
-            import shutil
+    image_path, _ = results['image_path']
+    wallpaper_path, _ = results['layout']
+    desktop_environment, current_path = results['desktop']
+    spanned = wallpaper_path != image_path
 
-            import skimage.io
-            import upscale_arbsr
+    if upscale_fancy and spanned:
+        print('Not upscaling, the wallpaper is composed for multiple monitors')
+    elif upscale_fancy:
+        try:
+            import upscale_queue
 
             path_background = image_path
-            background = skimage.io.imread(path_background)
-            background_height = background.shape[0]
-            background_width = background.shape[1]
-            del background
+            background_width, background_height = image_probe.get_size(path_background)
 
             maxw, maxh = get_maximum_screen_resolution()
             f = max((maxw/background_width), (maxh/background_height))
             maxw, maxh = int(round(background_width*f)), int(round(background_height*f))
 
-            path_background_upscaled = pathlib.Path(path_background).parent / \
-                (pathlib.Path(path_background).stem + f'_{maxw}x{maxh}.png')
+            # Cached by the source's content, the size, the model and the encoding
+            encoding = get_derivative_encoding()
+            path_key = get_derivative_cache_dir() / derivative_cache.get_key(path_background, maxw, maxh)
+            path_background_upscaled = derivative_cache.find(path_key.parent, path_key.name,
+                                                             get_upscale_model_ids(), encoding)
 
-            skip_upscale = False
             if maxw <= background_width and maxh <= background_height:
-                skip_upscale = True
                 summary = f'{app_name}: Skipping upscaling, destination size is smaller than source size'
                 body = f'From {background_width}x{background_height} to {maxw}x{maxh}'
                 show_notification(summary, str(body), path_icon)
-            elif (not path_background_upscaled.exists()) or force:
+            elif path_background_upscaled is None or force:
                 assert maxw > background_width or maxh > background_height
 
-                summary = f'{app_name}: Starting Upscaling'
-                body = 'This may take some time'
-                show_notification(summary, str(body), path_icon)
-                path_upscaled = upscale_arbsr.upscale_cpu(path_background, maxw, maxh)
-
-                shutil.move(path_upscaled, path_background_upscaled)
+                # The original stays set until the worker swaps in the upscaled image.
+                # The worker names the target after the model it picks
+                with timing.span('upscale_enqueue'):
+                    upscale_queue.enqueue(get_upscale_queue_dir(), path_background, path_key,
+                                          maxw, maxh, desktop_environment=desktop_environment,
+                                          encoding=encoding._asdict())
+                    upscale_queue.spawn_worker([str(pathlib.Path(__file__).resolve()), '--upscale-jobs'])
 
-                summary = f'{app_name}: Successfully upscaled'
+                summary = f'{app_name}: Upscaling in the background'
                 body = f'From {background_width}x{background_height} to {maxw}x{maxh}'
                 show_notification(summary, str(body), path_icon)
-            else:
-                summary = f'{app_name}: Upscaled background already exists'
-                body = f'filename: {path_background_upscaled.name}'
-                show_notification(summary, str(body), path_icon)
-
-            if skip_upscale:
-                pass
-            elif get_current_background_uri(desktop_environment).samefile(path_background_upscaled):
+            elif (current_path is not None and current_path.exists() and
+                  current_path.samefile(path_background_upscaled)):
                 summary = f'{app_name}: Upscaled background already set'
                 body = f'filename: {path_background_upscaled.name}'
                 show_notification(summary, str(body), path_icon)
             else:
                 change_background(path_background_upscaled, desktop_environment)
-                change_screensaver(path_background_upscaled, 'gnome')
+                change_screensaver(path_background_upscaled, desktop_environment)
 
                 summary = f'{app_name}: Set to upscaled background'
                 body = f'filename: {path_background_upscaled.name}'
@@ -505,7 +996,360 @@ def main(force: bool, desktop_environment: str, upscale_fancy: bool):
             body = f'Error Upscaling {image_path}\n' + str(err)
             show_notification(summary, str(body), path_icon)
 
-    sys.exit(exit_status)
+    return exit_status
+
+
+def setup_timing(profile: bool = False):
+    """
+    Enable the timing of the phases of a run if it is configured or profile is set, see timing.
+    """
+    log = get_settings().timing_log
+    textfile = get_settings().prometheus_textfile
+    if profile or log or textfile:
+        timing.enable(pathlib.Path(log).expanduser() if log else None,
+                      pathlib.Path(textfile).expanduser() if textfile else None)
+
+
+def run_timed(force: bool, desktop_environment: str, upscale_fancy: bool, profile: bool = False):
+    """
+    run() inside a timing span, writing the recorded spans afterwards.
+
+    :param profile: Print a breakdown of the time spent per phase.
+    :return: Exit status.
+    """
+    with timing.span('run'):
+        exit_status = run(force, desktop_environment, upscale_fancy)
+    spans = timing.finish()
+    if profile:
+        print(timing.format_report(spans))
+    return exit_status
+
+
+def main(force: bool, desktop_environment: str, upscale_fancy: bool, profile: bool = False):
+    """
+    Main application entry point.
+    """
+    setup_timing(profile)
+    sys.exit(run_timed(force, desktop_environment, upscale_fancy, profile))
+
+
+def run_upscale_jobs():
+    """
+    Work through the upscale queue at low priority, see upscale_queue.
+
+    Started in the background by run() with --upscale-fancy. Jobs only run on
+    AC power or while the system is idle, and the upscaled image replaces the
+    wallpaper when it is done, unless the wallpaper was changed meanwhile.
+    """
+    import upscale_arbsr
+    import upscale_queue
+    import upscale_worker
+
+    app_name = APP_NAME
+    queue_dir = get_upscale_queue_dir()
+    with upscale_queue.lock(queue_dir) as locked:
+        if not locked:
+            print('Another upscale worker is running')
+            sys.exit(0)
+        upscale_queue.set_low_priority()
+        path_icon = get_icon_path()
+
+        while True:
+            jobs = upscale_queue.get_jobs(queue_dir)
+            if not jobs:
+                break
+            job_dir = jobs[0]
+            job = upscale_queue.load_job(job_dir)
+            if not upscale_queue.wait_until_allowed(job_dir):
+                upscale_queue.remove(job_dir)
+                continue
+
+            try:
+                backend_name, backend = select_upscale_backend(job['width'] * job['height'])
+                path_key = pathlib.Path(job['target'])
+                encoding = derivative_cache.Encoding(**job.get('encoding', {}))
+                path_upscaled = derivative_cache.get_path(path_key.parent, path_key.name,
+                                                          upscale_arbsr.MODEL_IDS[backend_name], encoding)
+                if not path_upscaled.is_file():
+                    # No more tiles at a time than there are workers, the others would only wait for one
+                    upscale_queue.run_job(job_dir, backend, tiled=backend_name != 'lanczos',
+                                          target=path_upscaled, encoding=encoding,
+                                          max_workers=upscale_worker.get_worker_count(backend))
+            except upscale_arbsr.Cancelled:
+                print(f'Cancelled upscaling {job["source"]}')
+                upscale_queue.remove(job_dir)
+                continue
+            except upscale_queue.Paused:
+                # Kept in the queue, wait_until_allowed holds it until it may continue
+                print(f'Paused upscaling {job["source"]}')
+                continue
+            except Exception as err:
+                print(err)
+                show_notification(f'Warning {app_name}', f'Error Upscaling {job.get("source")}\n{err}', path_icon)
+                upscale_queue.remove(job_dir)
+                continue
+            upscale_queue.remove(job_dir)
+
+            desktop_environment = job['desktop_environment']
+            current_path = get_current_background(desktop_environment)
+            derivative_cache.evict(path_upscaled.parent, get_settings().cache_max_size,
+                                   protect=[path_upscaled] + ([current_path] if current_path is not None else []))
+            if current_path is not None and current_path.exists() and current_path.samefile(job['source']):
+                change_background(path_upscaled, desktop_environment)
+                change_screensaver(path_upscaled, desktop_environment)
+                summary = f'{app_name}: Set to upscaled background'
+            else:
+                summary = f'{app_name}: Successfully upscaled'
+            body = f'filename: {path_upscaled.name} ({backend_name})'
+            show_notification(summary, str(body), path_icon)
+    sys.exit(0)
+
+
+def get_next_refresh():
+    """
+    Get the time of Bing's next rollover, as far as the cached metadata tells.
+
+    :return: POSIX timestamp, or None if nothing is cached.
+    """
+    return metadata_cache.get_expiry(get_bing_xml(), get_metadata_cache_file())
+
+
+def run_daemon(force: bool, desktop_environment: str, upscale_fancy: bool, profile: bool = False):
+    """
+    Keep running and update the wallpaper at every Bing rollover.
+    """
+    import scheduler
+
+    setup_timing(profile)
+
+    def refresh():
+        nonlocal force
+        # Only the first refresh is forced
+        exit_status = run_timed(force, desktop_environment, upscale_fancy, profile)
+        force = False
+        return exit_status
+
+    scheduler.run(refresh, get_next_refresh, connectivity.get_network_monitor())
+    sys.exit(0)
+
+
+def get_rotation_wallpaper(image_path: pathlib.Path, monitors, mode: str):
+    """
+    Get the file to show for an archived image in rotation mode.
+
+    :return: Tuple of (path, spanned), the path is the image itself if it already fits the screen.
+    """
+    spanned = screen_layout.is_composed(monitors, mode)
+    if not spanned and image_probe.get_size(image_path) == screen_layout.get_largest(monitors):
+        return image_path, spanned
+    return get_rotation_dir() / screen_layout.get_rendered_path(image_path, monitors, mode).name, spanned
+
+
+def prerender(image_path: pathlib.Path, monitors, mode: str):
+    """
+    Render an archived image for the screen unless that was already done.
+
+    :return: Path to the file to show.
+    """
+    wallpaper_path, _ = get_rotation_wallpaper(image_path, monitors, mode)
+    if not wallpaper_path.exists():
+        screen_layout.render(image_path, monitors, mode, wallpaper_path)
+    return wallpaper_path
+
+
+def prune_renders(keep=()):
+    """
+    Delete the rendered images of rotation except keep, i.e. the current and the next one.
+    """
+    keep = {pathlib.Path(path).name for path in keep}
+    for path in get_rotation_dir().iterdir():
+        if path.name not in keep:
+            path.unlink(missing_ok=True)
+
+
+def rotate(desktop_environment: str, order: str):
+    """
+    Show the next archived image, without network access.
+
+    The image was rendered for the screen while the previous one was shown, so
+    switching is a single settings write. The image after it is picked and
+    rendered in a background thread.
+
+    :return: The thread rendering the next image, or None if the archive is empty.
+    """
+    if desktop_environment is None:
+        desktop_environment = desktop.detect()
+    desktop.get_desktop(desktop_environment).refresh()
+    download_path = get_download_path()
+    monitors = screen_layout.get_monitors()
+    mode = get_layout_mode()
+
+    with archive_index.open_index(download_path) as index:
+        archive_index.sync(index, download_path)
+        name = archive_index.get_rotation_next(index, order)
+        if name is None:
+            current_path = get_current_background(desktop_environment)
+            current = None
+            if current_path is not None:
+                kind, current = archive_index.classify(current_path.name)
+                current = current_path.name if kind == 'original' else current
+            name = archive_index.pick_next(index, order, current)
+        if name is None:
+            print(f'No images to rotate through in {download_path}')
+            return None
+        following = archive_index.pick_next(index, order, name)
+        archive_index.set_rotation_next(index, order, following)
+
+    image_path = download_path / name
+    with timing.span('render'):
+        wallpaper_path = prerender(image_path, monitors, mode)
+    with timing.span('set_wallpaper'):
+        change_background(wallpaper_path, desktop_environment, screen_layout.is_composed(monitors, mode))
+        change_screensaver(image_path, desktop_environment)
+
+    # Only the shown and the next render are kept, the previous one is deleted
+    following_path, _ = get_rotation_wallpaper(download_path / following, monitors, mode)
+    prune_renders([wallpaper_path, following_path])
+    thread = threading.Thread(target=prerender, args=(download_path / following, monitors, mode))
+    thread.start()
+    return thread
+
+
+def run_rotation(desktop_environment: str, daemon: bool, profile: bool = False):
+    """
+    Rotate through the archived images, once or every rotation interval.
+    """
+    setup_timing(profile)
+    order = get_rotation_order()
+    thread = None
+
+    def step():
+        nonlocal thread
+        # Only one render at a time, the previous one has long finished normally
+        if thread is not None:
+            thread.join()
+        with timing.span('run'):
+            try:
+                thread = rotate(desktop_environment, order)
+            except Exception as err:
+                print(err)
+        spans = timing.finish()
+        if profile:
+            print(timing.format_report(spans))
+        return True
+
+    step()
+    if daemon:
+        from gi.repository import GLib
+
+        loop = GLib.MainLoop()
+        GLib.timeout_add_seconds(get_rotation_interval(), step)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signum, loop.quit)
+        loop.run()
+    if thread is not None:
+        thread.join()
+    sys.exit(0)
+
+
+def run_mirror(bind: str, port: int):
+    """
+    Serve the metadata cache and the downloaded images to other machines, see mirror.
+    """
+    import mirror
+
+    download_path = get_download_path()
+    init_dir(download_path)
+    mirror.serve((bind, port), download_path, get_cache_dir() / 'mirror', get_metadata_cache_file(), BING_URL)
+    sys.exit(0)
+
+
+def query_catalog(text: str, since: str, until: str, market: str, limit: int):
+    """
+    Print the catalog entries matching the query.
+    """
+    download_path = get_download_path()
+    init_dir(download_path)
+    with catalog.open_catalog(download_path) as image_catalog:
+        rows = catalog.search(image_catalog, text, since, until, market, limit)
+    for row in rows:
+        print(f"{row['startdate']}  {row['market'] or '-':5}  {row['copyright'] or ''}")
+        if row['path']:
+            print(f"    {row['path']}")
+    sys.exit(0 if rows else 1)
+
+
+def import_details(path_details: str):
+    """
+    Import an image-details.txt written by older versions into the catalog.
+    """
+    download_path = get_download_path()
+    init_dir(download_path)
+    with catalog.open_catalog(download_path) as image_catalog:
+        count = catalog.import_details(image_catalog, pathlib.Path(path_details))
+    print(f'Imported {count} entries from {path_details}')
+    sys.exit(0)
+
+
+def dedupe():
+    """
+    Move the download directory into the blob store, replacing duplicate images by hardlinks.
+    """
+    download_path = get_download_path()
+    init_dir(download_path)
+    with catalog.open_catalog(download_path) as image_catalog:
+        hashes = catalog.get_hashes(image_catalog)
+    with archive_index.open_index(download_path) as index:
+        replaced, freed = archive_index.dedupe(index, download_path, hashes)
+        total_size, total_count = archive_index.get_totals(index)
+    print(f'Replaced {replaced} duplicate(s) by links, freed {freed / 1024 / 1024:.1f} MiB, '
+          f'{total_count} file(s) in {total_size / 1024 / 1024:.1f} MiB')
+    sys.exit(0)
+
+
+def get_backfill_markets(markets: str):
+    """
+    Parse the --markets argument.
+
+    :param markets: 'all', or a comma separated list of Bing markets.
+    :return: List of Bing markets.
+    """
+    if markets == 'all':
+        return list(BING_MARKETS)
+    markets = [market.strip() for market in markets.split(',') if market.strip()]
+    unknown = [market for market in markets if market not in BING_MARKETS]
+    if unknown:
+        raise ValueError(f'Unknown Bing market(s): {", ".join(unknown)}')
+    return markets
+
+
+def run_backfill(markets: str, days: int):
+    """
+    Download the images of the last days for one or more markets.
+    """
+    import backfill
+
+    preferred_market = get_market()
+    markets = get_backfill_markets(markets) if markets else [preferred_market]
+    download_path = get_download_path()
+    init_dir(download_path)
+    dir_mtime = download_path.stat().st_mtime_ns
+    size = get_screen_resolution()
+
+    time_start = time.monotonic()
+    downloaded, errors = backfill.backfill(
+        markets, days, download_path, preferred_market,
+        get_bing_xml, lambda metadata: get_image_url(metadata, size),
+        lambda metadata, image_path: link_stored_image(metadata, image_path, size))
+    for market, err in errors:
+        print(f'{market or "download"}: {err}')
+    print(f'Downloaded {len(downloaded)} image(s) from {len(markets)} market(s) '
+          f'in {time.monotonic() - time_start:.1f}s')
+    with catalog.open_catalog(download_path) as image_catalog:
+        hashes = catalog.get_hashes(image_catalog)
+    check_limit(downloaded, hashes={path: hashes.get(path.name) for path in downloaded}, dir_mtime=dir_mtime)
+
+    sys.exit(1 if errors else 0)
 
 
 if __name__ == '__main__':
@@ -514,8 +1358,61 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Automatically downloads and changes desktop wallpaper to Bing Photo of the Day.')
     parser.add_argument('-f', '--force', action='store_true')
-    parser.add_argument('-d', '--desktop_environment', default=None)
+    parser.add_argument('-d', '--desktop_environment', default=None, choices=desktop.DESKTOP_ENVIRONMENTS,
+                        help='desktop whose wallpaper is changed, detected if not given')
     parser.add_argument('-u', '--upscale-fancy', action='store_true')
+    parser.add_argument('--backfill', action='store_true',
+                        help='download the images of the last days instead of changing the wallpaper')
+    parser.add_argument('--markets', default=None,
+                        help="markets to backfill: 'all' or a comma separated list (default: configured market)")
+    parser.add_argument('--days', type=int, default=8,
+                        help='number of days to backfill, at most 15 (default: 8)')
+    parser.add_argument('--pin', metavar='FILENAME', default=None,
+                        help='never delete this image from the download directory')
+    parser.add_argument('--unpin', metavar='FILENAME', default=None,
+                        help='allow this image to be deleted again')
+    parser.add_argument('--query', action='store_true',
+                        help='list catalog entries matching --text, --since, --until and --market')
+    parser.add_argument('--text', default=None, help='full-text search over copyright and title')
+    parser.add_argument('--since', default=None, help='first date, YYYYMMDD')
+    parser.add_argument('--until', default=None, help='last date, YYYYMMDD')
+    parser.add_argument('--market', default=None, help='Bing market')
+    parser.add_argument('--limit', type=int, default=100, help='maximum number of results (default: 100)')
+    parser.add_argument('--import-details', metavar='PATH', default=None,
+                        help='import an image-details.txt written by older versions into the catalog')
+    parser.add_argument('--upscale-jobs', action='store_true',
+                        help='work through the queued upscale jobs, started in the background by -u')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the time spent in every phase of the update')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and update the wallpaper at every Bing rollover')
+    parser.add_argument('--serve', action='store_true',
+                        help='serve the metadata and images to other machines, set as upstream in their config')
+    parser.add_argument('--bind', default='0.0.0.0', help='address --serve listens on (default: all)')
+    parser.add_argument('--port', type=int, default=8080, help='port --serve listens on (default: 8080)')
+    parser.add_argument('--rotate', action='store_true',
+                        help='show the next image of the download directory, with --daemon every rotation interval')
+    parser.add_argument('--dedupe', action='store_true',
+                        help='replace duplicate images in the download directory by hardlinks')
     args = parser.parse_args()
 
-    main(**vars(args))
+    if args.upscale_jobs:
+        run_upscale_jobs()
+    elif args.serve:
+        run_mirror(args.bind, args.port)
+    elif args.rotate:
+        run_rotation(args.desktop_environment, args.daemon, args.profile)
+    elif args.daemon:
+        run_daemon(args.force, args.desktop_environment, args.upscale_fancy, args.profile)
+    elif args.query:
+        query_catalog(args.text, args.since, args.until, args.market, args.limit)
+    elif args.import_details:
+        import_details(args.import_details)
+    elif args.pin or args.unpin:
+        set_pinned(args.pin or args.unpin, bool(args.pin))
+    elif args.dedupe:
+        dedupe()
+    elif args.backfill:
+        run_backfill(args.markets, args.days)
+    else:
+        main(args.force, args.desktop_environment, args.upscale_fancy, args.profile)
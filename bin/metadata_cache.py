@@ -0,0 +1,105 @@
+import datetime
+import pathlib
+import time
+import xml.etree.ElementTree as ET
+
+import http_pool
+import json_file
+
+# Bing sometimes publishes the next image a bit after the announced rollover,
+# until then the cached response is revalidated at this interval.
+RETRY_INTERVAL = 15 * 60
+# Fallback lifetime when a response carries no usable dates.
+DEFAULT_TTL = 60 * 60
+# Entries that expired this long ago (e.g. of a previously configured market) are dropped.
+PRUNE_AGE = 7 * 24 * 60 * 60
+
+
+def get_rollover(bing_xml: bytes):
+    """
+    Get the time at which the first image of a HPImageArchive response is replaced.
+
+    fullstartdate is the UTC time (YYYYMMDDHHMM) the image went live, and the
+    image stays up from startdate until enddate (YYYYMMDD).
+
+    :param bing_xml: Raw HPImageArchive XML.
+    :return: Rollover as a POSIX timestamp, or None if it can't be determined.
+    """
+    try:
+        image = ET.fromstring(bing_xml).find('image')
+        fullstartdate = datetime.datetime.strptime(image.find('fullstartdate').text, '%Y%m%d%H%M')
+        startdate = datetime.datetime.strptime(image.find('startdate').text, '%Y%m%d')
+        enddate = datetime.datetime.strptime(image.find('enddate').text, '%Y%m%d')
+    except (ET.ParseError, AttributeError, TypeError, ValueError):
+        return None
+    rollover = fullstartdate + (enddate - startdate)
+    return rollover.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def is_fresh(url: str, path: pathlib.Path, now: float = None):
+    """
+    Check whether a cached response for url can be used without a network request.
+    """
+    entry = json_file.load(path).get(url)
+    now = time.time() if now is None else now
+    return entry is not None and now < entry['expires']
+
+
+def get_expiry(url: str, path: pathlib.Path):
+    """
+    :return: Time until which the cached response for url is used, or None if not cached.
+    """
+    entry = json_file.load(path).get(url)
+    return None if entry is None else entry['expires']
+
+
+def fetch(url: str, path: pathlib.Path, refresh: bool = False, now: float = None):
+    """
+    Get a HPImageArchive response, served from the cache until the next rollover.
+
+    After the rollover the cached response is revalidated with a conditional
+    request (ETag/Last-Modified), so an unchanged response costs a 304.
+
+    :param url: HPImageArchive URL.
+    :param path: Path to the JSON cache file.
+    :param refresh: Ignore the expiry time of a cached response.
+    :return: Raw XML.
+    """
+    now = time.time() if now is None else now
+    cache = json_file.load(path)
+    entry = cache.get(url)
+    if entry is not None and now < entry['expires'] and not refresh:
+        return entry['body'].encode('utf-8')
+
+    headers = {}
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    response = http_pool.fetch(url, headers=headers)
+    if response.status == 304 and entry is not None:
+        body = entry['body'].encode('utf-8')
+    elif response.status == 200:
+        body = response.body
+        entry = {
+            'body': body.decode('utf-8'),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+    else:
+        raise RuntimeError(f'HPImageArchive returned HTTP {response.status}')
+
+    expires = get_rollover(body)
+    if expires is None:
+        expires = now + DEFAULT_TTL
+    elif expires <= now:
+        # Past the announced rollover, but the new image isn't published yet
+        expires = now + RETRY_INTERVAL
+    entry['expires'] = expires
+
+    cache = {key: value for key, value in cache.items() if value['expires'] > now - PRUNE_AGE}
+    cache[url] = entry
+    json_file.save(path, cache)
+    return body
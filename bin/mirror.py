@@ -0,0 +1,228 @@
+import concurrent.futures
+import http.server
+import os
+import pathlib
+import re
+import threading
+import time
+import urllib.parse
+
+import catalog
+import download
+import image_probe
+import image_variants
+import metadata_cache
+
+MAX_WORKERS = 32
+# Idle keep-alive connections give their worker back after this many seconds
+REQUEST_TIMEOUT = 15
+# Images fetched for clients are deleted this long after they were last requested
+PRUNE_AGE = 30 * 24 * 60 * 60
+# Only plain image ids, so an id can't point outside the cache directory
+IMAGE_ID = re.compile(r'^[\w.-]+_\w+\.jpg$')
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers the requests this program makes to Bing: HPImageArchive.aspx and /th.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'bdwc-mirror'
+    # Headers and body are written separately, don't hold the body back for an ACK
+    disable_nagle_algorithm = True
+    timeout = REQUEST_TIMEOUT
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def respond(self, send_body: bool):
+        parts = urllib.parse.urlsplit(self.path)
+        try:
+            if parts.path == '/HPImageArchive.aspx':
+                self.send_bytes(200, 'text/xml; charset=utf-8', self.server.get_archive(parts.query), send_body)
+            elif parts.path == '/th':
+                image_id = urllib.parse.parse_qs(parts.query).get('id', [''])[0]
+                self.send_image(image_id, send_body)
+            elif parts.path == '/':
+                self.send_bytes(200, 'text/plain', b'bing-desktop-wallpaper-changer mirror\n', send_body)
+            else:
+                self.send_bytes(404, 'text/plain', b'Not found\n', send_body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away
+            self.close_connection = True
+        except Exception as err:
+            self.log_error('%s', err)
+            self.send_bytes(502, 'text/plain', f'{err}\n'.encode('utf-8'), send_body)
+
+    def send_bytes(self, status: int, content_type: str, body: bytes, send_body: bool):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def send_image(self, image_id: str, send_body: bool):
+        if not IMAGE_ID.match(image_id):
+            self.send_bytes(404, 'text/plain', b'Not found\n', send_body)
+            return
+        path = self.server.get_image(image_id, fetch=send_body)
+        if path is None and not send_body:
+            # Answer a size probe without fetching the image
+            length = self.server.get_upstream_length(image_id)
+            if length is None:
+                self.send_bytes(404, 'text/plain', b'Not found\n', send_body)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(length))
+            self.end_headers()
+            return
+        if path is None:
+            self.send_bytes(404, 'text/plain', b'Not found\n', send_body)
+            return
+
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            if send_body:
+                # Straight from the page cache to the socket, without copying through Python
+                self.connection.sendfile(f)
+
+
+class MirrorServer(http.server.HTTPServer):
+    """
+    HTTP server handling connections on a fixed pool of worker threads.
+
+    HPImageArchive responses come from the metadata cache, which fetches each
+    URL from Bing once per rollover. Images are served from the download
+    directory, looked up by urlBase in the catalog, and otherwise fetched from
+    Bing once into cache_dir.
+    """
+
+    def __init__(self, address, download_path: pathlib.Path, cache_dir: pathlib.Path,
+                 metadata_cache_file: pathlib.Path, upstream: str = image_variants.BING_URL,
+                 max_workers: int = MAX_WORKERS):
+        super().__init__(address, Handler)
+        self.download_path = pathlib.Path(download_path)
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.metadata_cache_file = pathlib.Path(metadata_cache_file)
+        self.upstream = upstream.rstrip('/')
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='mirror')
+        self.lock = threading.Lock()
+        self.archive_lock = threading.Lock()
+        self.image_locks = {}
+        self.upstream_lengths = {}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+    def get_archive(self, query: str):
+        # One client at a time, so a rollover fetches each URL from Bing only once
+        with self.archive_lock:
+            return metadata_cache.fetch(f'{self.upstream}/HPImageArchive.aspx?{query}', self.metadata_cache_file)
+
+    def get_image_lock(self, image_id: str):
+        with self.lock:
+            return self.image_locks.setdefault(image_id, threading.Lock())
+
+    def find_local(self, image_id: str):
+        """
+        Find a downloaded image that is the requested variant.
+
+        The catalog doesn't record which variant was downloaded, so it is told by the image size.
+        """
+        urlbase, _, variant = image_id.removesuffix('.jpg').rpartition('_')
+        if variant not in image_variants.VARIANTS:
+            return None
+        with catalog.open_catalog(self.download_path) as image_catalog:
+            paths = catalog.get_paths(image_catalog, f'/th?id={urlbase}')
+        for path in paths:
+            try:
+                if image_probe.get_size(path) == image_variants.VARIANTS[variant]:
+                    return path
+            except (OSError, ValueError):
+                continue
+        return None
+
+    def get_image(self, image_id: str, fetch: bool = True):
+        """
+        :param fetch: Download the image from upstream if it isn't available locally.
+        :return: Path of the image, or None if it doesn't exist.
+        """
+        path = self.cache_dir / image_id
+        if path.is_file():
+            os.utime(path)
+            return path
+        path_local = self.find_local(image_id)
+        if path_local is not None or not fetch:
+            return path_local
+
+        with self.get_image_lock(image_id):
+            # Another client may have fetched it while this one waited
+            if not path.is_file():
+                length = self.get_upstream_length(image_id)
+                if length is None:
+                    return None
+                download.download(f'{self.upstream}/th?id={image_id}', path)
+                self.prune()
+        return path
+
+    def get_upstream_length(self, image_id: str):
+        """
+        :return: Size of the image upstream in bytes, or None if it doesn't exist.
+        """
+        if image_id not in self.upstream_lengths:
+            self.upstream_lengths[image_id] = image_variants.probe(f'{self.upstream}/th?id={image_id}')
+        return self.upstream_lengths[image_id]
+
+    def prune(self, now: float = None):
+        now = time.time() if now is None else now
+        for path in self.cache_dir.iterdir():
+            try:
+                if path.stat().st_mtime < now - PRUNE_AGE:
+                    path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def serve(address, download_path: pathlib.Path, cache_dir: pathlib.Path, metadata_cache_file: pathlib.Path,
+          upstream: str = image_variants.BING_URL, max_workers: int = MAX_WORKERS):
+    """
+    Run a mirror until interrupted.
+
+    :param address: (host, port) to listen on.
+    """
+    server = MirrorServer(address, download_path, cache_dir, metadata_cache_file, upstream, max_workers)
+    print(f'Serving on {server.url} with {max_workers} workers')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,116 @@
+import collections
+import concurrent.futures
+
+import timing
+
+# Tasks on this lane run in the thread that calls Pipeline.run(), e.g. for GTK and GSettings
+MAIN = 'main'
+MAX_WORKERS = 4
+
+Task = collections.namedtuple('Task', ['name', 'function', 'inputs', 'after', 'lane'])
+
+# Thread of every named lane, kept for the life of the process so the next
+# run() of a daemon reuses the lane's pooled connections
+_lanes = {}
+
+
+def get_lane_executor(lane: str):
+    if lane not in _lanes:
+        _lanes[lane] = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix=f'pipeline-{lane}')
+    return _lanes[lane]
+
+
+def shutdown_lanes():
+    """
+    Stop the threads of the named lanes, dropping their connections. The next run() starts new ones.
+    """
+    while _lanes:
+        _lanes.popitem()[1].shutdown(wait=True)
+
+
+class Pipeline:
+    """
+    Run tasks as soon as the tasks they depend on are done.
+
+    Every task runs on a lane: MAIN runs it in the calling thread, None on a
+    shared thread pool, and any other name on a thread of its own, one task
+    at a time. A named lane keeps related work on one thread, also across
+    pipelines, e.g. requests that should reuse the thread's pooled connection
+    (see http_pool).
+    Each task is timed as a span named after it.
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS):
+        self.max_workers = max_workers
+        self.tasks = {}
+
+    def add(self, name: str, function, inputs=(), after=(), lane: str = None):
+        """
+        :param function: Called with the results of the tasks in inputs, in that order.
+        :param inputs: Names of the tasks whose results this one needs, added before it.
+        :param after: Names of further tasks that must be done before this one starts.
+        """
+        assert name not in self.tasks, f'Task {name} added twice'
+        after = tuple(inputs) + tuple(dependency for dependency in after if dependency not in inputs)
+        assert all(dependency in self.tasks for dependency in after), f'Unknown dependency of {name}'
+        self.tasks[name] = Task(name, function, tuple(inputs), after, lane)
+
+    def call(self, task: Task, results: dict, depth: int):
+        with timing.span(task.name, depth):
+            return task.function(*[results[dependency] for dependency in task.inputs])
+
+    def run(self):
+        """
+        Run all tasks. After a task failed no new tasks are started, and the
+        error is raised once the running ones are done.
+
+        :return: Dict of task name to result.
+        """
+        depth = timing.get_depth()
+        results = {}
+        pending = dict(self.tasks)
+        running = {}
+        error = None
+        executors = {None: concurrent.futures.ThreadPoolExecutor(self.max_workers, thread_name_prefix='pipeline')}
+        try:
+            while pending or running:
+                ready = [task for task in pending.values()
+                         if error is None and all(dependency in results for dependency in task.after)]
+                # A named lane only gets its next task once the previous one is done
+                busy = {self.tasks[name].lane for name in running.values()}
+                for task in ready:
+                    if task.lane == MAIN or (task.lane is not None and task.lane in busy):
+                        continue
+                    if task.lane not in executors:
+                        executors[task.lane] = get_lane_executor(task.lane)
+                    del pending[task.name]
+                    running[executors[task.lane].submit(self.call, task, results, depth)] = task.name
+                    busy.add(task.lane)
+
+                main_ready = [task for task in ready if task.lane == MAIN]
+                if main_ready:
+                    task = main_ready[0]
+                    del pending[task.name]
+                    try:
+                        results[task.name] = self.call(task, results, depth)
+                    except Exception as err:
+                        error = error or err
+                    continue
+                if not running:
+                    break
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as err:
+                        error = error or err
+        finally:
+            # The lanes are kept, only the tasks of this run are waited for
+            concurrent.futures.wait(running)
+            executors[None].shutdown(wait=True)
+
+        if error is not None:
+            raise error
+        return results
@@ -0,0 +1,134 @@
+import collections
+import concurrent.futures
+import struct
+import zlib
+
+import numpy as np
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# PNG colour type per number of channels: greyscale, RGB, RGBA
+COLOR_TYPES = {1: 0, 3: 2, 4: 6}
+FILTER_SUB = 1
+# Filtered bytes compressed as one independent deflate block by a worker
+STRIP_BYTES = 1024 * 1024
+# Each strip is primed with the end of the previous one, as deflate would see it
+WINDOW_SIZE = 32 * 1024
+# Compression level in the FLEVEL bits of the zlib header, informational only
+ZLIB_FLEVELS = [0, 0, 1, 1, 1, 1, 2, 3, 3, 3]
+
+
+def compress_strip(data: bytes, compress_level: int, zdict: bytes):
+    """
+    Compress a strip into raw deflate data ending on a byte boundary, so strips
+    can be concatenated into a single stream.
+    """
+    if zdict:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class PngWriter:
+    """
+    Write an 8 bit PNG strip by strip, so the full image never has to be in memory.
+
+    Rows are passed top to bottom with write_rows() and filtered. The filtered
+    bytes are cut into strips of about STRIP_BYTES that are compressed
+    independently on a thread pool (zlib releases the GIL), like pigz does:
+    every strip is primed with the last 32KiB of the previous one and ends
+    with a sync flush, so their concatenation is a single zlib stream and the
+    file is hardly larger than with one compressor.
+    """
+
+    def __init__(self, path, width: int, height: int, channels: int, compress_level: int = 6, workers: int = 1):
+        """
+        :param workers: Number of threads compressing strips, 1 compresses in the calling thread.
+        """
+        assert channels in COLOR_TYPES
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.rows_written = 0
+        self.compress_level = compress_level
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers) if workers > 1 else None
+        # Compressed strips in file order, bounded so memory stays at a few strips per worker
+        self.pending = collections.deque()
+        self.max_pending = 2 * workers
+        self.zdict = b''
+        self.adler = zlib.adler32(b'')
+        self.f = open(path, 'wb')
+        self.f.write(PNG_SIGNATURE)
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, COLOR_TYPES[channels], 0, 0, 0))
+        self.write_chunk(b'IDAT', self.get_zlib_header())
+
+    def get_zlib_header(self):
+        cmf = 0x78
+        flg = ZLIB_FLEVELS[self.compress_level] << 6
+        return bytes([cmf, flg + 31 - (cmf * 256 + flg) % 31])
+
+    def write_chunk(self, chunk_type: bytes, data: bytes):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(chunk_type)
+        self.f.write(data)
+        self.f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+
+    def write_rows(self, rows: np.ndarray):
+        """
+        :param rows: uint8 array of shape (n, width, channels) or (n, width).
+        """
+        rows = rows.reshape(rows.shape[0], -1)
+        assert rows.shape[1] == self.width * self.channels
+        assert self.rows_written + rows.shape[0] <= self.height
+
+        # Sub filter: every byte minus the same channel of the pixel to its left
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = FILTER_SUB
+        filtered[:, 1:self.channels + 1] = rows[:, :self.channels]
+        np.subtract(rows[:, self.channels:], rows[:, :-self.channels], out=filtered[:, self.channels + 1:])
+
+        data = filtered.tobytes()
+        for start in range(0, len(data), STRIP_BYTES):
+            self.write_strip(data[start:start + STRIP_BYTES])
+        self.rows_written += rows.shape[0]
+
+    def write_strip(self, strip: bytes):
+        self.adler = zlib.adler32(strip, self.adler)
+        if self.executor is None:
+            self.write_chunk(b'IDAT', compress_strip(strip, self.compress_level, self.zdict))
+        else:
+            self.pending.append(self.executor.submit(compress_strip, strip, self.compress_level, self.zdict))
+            while len(self.pending) > self.max_pending:
+                self.write_chunk(b'IDAT', self.pending.popleft().result())
+        self.zdict = (self.zdict + strip)[-WINDOW_SIZE:]
+
+    def close(self):
+        if self.f.closed:
+            return
+        try:
+            assert self.rows_written == self.height, f'{self.rows_written} of {self.height} rows written'
+            while self.pending:
+                self.write_chunk(b'IDAT', self.pending.popleft().result())
+            # An empty final block and the checksum end the zlib stream
+            end = zlib.compressobj(self.compress_level, zlib.DEFLATED, -15).flush()
+            self.write_chunk(b'IDAT', end + struct.pack('>I', self.adler))
+            self.write_chunk(b'IEND', b'')
+        finally:
+            self.shutdown()
+            self.f.close()
+
+    def shutdown(self):
+        if self.executor is not None:
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.shutdown()
+            self.f.close()
@@ -0,0 +1,124 @@
+import signal
+import time
+
+# Bing publishes the new image around the announced rollover, give it a moment
+ROLLOVER_GRACE = 60
+RETRY_INTERVAL = 15 * 60
+# Timers run on the monotonic clock, which stops during suspend and doesn't
+# follow changes of the wall clock. Waking up at least this often bounds the
+# error if a resume or clock change is missed.
+MAX_SLEEP = 60 * 60
+
+
+class Scheduler:
+    """
+    Run refresh() at every Bing rollover from a GLib main loop.
+
+    The process sleeps on a single timer until the next rollover. It is woken
+    early on resume from suspend (logind PrepareForSleep) and, after a failed
+    refresh, when the network comes back. Nothing accumulates between refreshes,
+    so memory stays flat however long it runs.
+    """
+
+    def __init__(self, refresh, get_next_refresh, monitor=None):
+        """
+        :param refresh: Callable () -> exit status, 0 on success.
+        :param get_next_refresh: Callable () -> POSIX timestamp of the next rollover, or None.
+        :param monitor: Gio.NetworkMonitor, or None.
+        """
+        from gi.repository import GLib
+
+        self.refresh = refresh
+        self.get_next_refresh = get_next_refresh
+        self.monitor = monitor
+        self.loop = GLib.MainLoop()
+        self.timer = None
+        self.next_refresh = None
+        self.failed = False
+        self.running = False
+
+    def get_delay(self, now: float = None):
+        now = time.time() if now is None else now
+        return min(MAX_SLEEP, max(1, self.next_refresh - now))
+
+    def schedule(self):
+        from gi.repository import GLib
+
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+        if self.failed:
+            self.next_refresh = time.time() + RETRY_INTERVAL
+        else:
+            next_refresh = self.get_next_refresh()
+            self.next_refresh = (next_refresh + ROLLOVER_GRACE) if next_refresh else time.time() + RETRY_INTERVAL
+        self.timer = GLib.timeout_add_seconds(int(self.get_delay()), self.on_timer)
+
+    def run_refresh(self):
+        # A refresh may run a nested main loop (see connectivity), in which
+        # signals arrive that would start another one
+        if self.running:
+            return
+        self.running = True
+        try:
+            self.failed = self.refresh() != 0
+        except Exception as err:
+            print(err)
+            self.failed = True
+        finally:
+            self.running = False
+        self.schedule()
+
+    def refresh_if_due(self):
+        if time.time() >= self.next_refresh:
+            self.run_refresh()
+        else:
+            self.schedule()
+
+    def on_timer(self):
+        self.timer = None
+        self.refresh_if_due()
+        return False
+
+    def on_network_changed(self, monitor, available):
+        if available and self.failed:
+            self.run_refresh()
+
+    def on_prepare_for_sleep(self, connection, sender, path, interface, signal_name, parameters, *args):
+        going_to_sleep, = parameters.unpack()
+        if not going_to_sleep:
+            self.refresh_if_due()
+
+    def subscribe_sleep(self):
+        """
+        Listen for logind's PrepareForSleep signal, if the system bus is available.
+        """
+        from gi.repository import Gio
+
+        try:
+            bus = Gio.bus_get_sync(Gio.BusType.SYSTEM, None)
+        except Exception as err:
+            print(f'Not watching for suspend/resume: {err}')
+            return None
+        bus.signal_subscribe(
+            'org.freedesktop.login1', 'org.freedesktop.login1.Manager', 'PrepareForSleep',
+            '/org/freedesktop/login1', None, Gio.DBusSignalFlags.NONE, self.on_prepare_for_sleep)
+        return bus
+
+    def run(self):
+        from gi.repository import GLib
+
+        self.bus = self.subscribe_sleep()
+        if self.monitor is not None:
+            self.monitor.connect('network-changed', self.on_network_changed)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signum, self.loop.quit)
+
+        self.run_refresh()
+        self.loop.run()
+
+
+def run(refresh, get_next_refresh, monitor=None):
+    """
+    Run refresh() now and then at every Bing rollover until SIGINT/SIGTERM.
+    """
+    Scheduler(refresh, get_next_refresh, monitor).run()
@@ -0,0 +1,192 @@
+import collections
+import pathlib
+
+# largest: one image sized for the largest monitor, as set by the desktop
+# per-monitor: every monitor shows the whole image, cropped to its aspect ratio
+# span: one image stretched across all monitors
+LAYOUT_MODES = ['largest', 'per-monitor', 'span']
+# Suffix of the composed derivative of each mode, e.g. 20231017_5760x2160-span.jpg
+LAYOUT_SUFFIXES = {'per-monitor': 'monitors', 'span': 'span'}
+# Suffix of an image cropped and resized to a single screen, e.g. 20231017_1920x1080-screen.jpg
+RENDERED_SUFFIX = 'screen'
+JPEG_QUALITY = 95
+
+# Geometry in device pixels, relative to the top left of the virtual screen
+Monitor = collections.namedtuple('Monitor', ['x', 'y', 'width', 'height'])
+# Assumed while GDK reports no monitors and none were seen before, e.g. in a headless session
+DEFAULT_MONITORS = [Monitor(0, 0, 1920, 1080)]
+
+_monitors = None
+# Last layout with monitors, kept while they are gone during a hotplug
+_last_monitors = None
+_screen = None
+
+
+def _on_monitors_changed(screen):
+    global _monitors
+    _monitors = None
+
+
+def get_monitors():
+    """
+    Get the monitor layout, queried once and cached until the monitors change.
+
+    While GDK reports no monitors the last layout, or DEFAULT_MONITORS, is
+    returned and the monitors are queried again on the next call.
+
+    :return: List of Monitor.
+    """
+    global _monitors, _last_monitors, _screen
+    if _monitors is not None:
+        return _monitors
+
+    import gi
+    gi.require_version('Gdk', '3.0')
+    from gi.repository import Gdk
+
+    # Gdk.Screen.get_default() instead of Gtk.Window().get_screen(), which leaks
+    # a toplevel window per call in a long running process
+    screen = Gdk.Screen.get_default()
+    if screen is not _screen:
+        screen.connect('monitors-changed', _on_monitors_changed)
+        _screen = screen
+
+    monitors = []
+    for m in range(screen.get_n_monitors()):
+        geometry = screen.get_monitor_geometry(m)
+        scale = screen.get_monitor_scale_factor(m)
+        monitors.append(Monitor(geometry.x * scale, geometry.y * scale,
+                                geometry.width * scale, geometry.height * scale))
+    if not monitors:
+        return _last_monitors or DEFAULT_MONITORS
+    # The virtual screen may start at negative coordinates
+    x0 = min(monitor.x for monitor in monitors)
+    y0 = min(monitor.y for monitor in monitors)
+    _monitors = [monitor._replace(x=monitor.x - x0, y=monitor.y - y0) for monitor in monitors]
+    _last_monitors = _monitors
+    return _monitors
+
+
+def get_bounding_size(monitors):
+    """
+    :return: (width, height) of the virtual screen.
+    """
+    return (max(monitor.x + monitor.width for monitor in monitors),
+            max(monitor.y + monitor.height for monitor in monitors))
+
+
+def get_largest(monitors):
+    """
+    :return: (width, height) of the monitor with the most pixels.
+    """
+    largest = max(monitors, key=lambda monitor: monitor.width * monitor.height)
+    return largest.width, largest.height
+
+
+def get_required_size(monitors, mode: str):
+    """
+    Get the size an image must have to be shown without upscaling in a layout mode.
+
+    :return: (width, height)
+    """
+    if mode == 'span':
+        return get_bounding_size(monitors)
+    if mode == 'per-monitor':
+        return (max(monitor.width for monitor in monitors),
+                max(monitor.height for monitor in monitors))
+    return get_largest(monitors)
+
+
+def is_composed(monitors, mode: str):
+    """
+    Whether a mode needs a composed image, a single monitor shows the image as is.
+    """
+    return mode in LAYOUT_SUFFIXES and len(monitors) > 1
+
+
+def get_composed_path(path_input: pathlib.Path, monitors, mode: str):
+    width, height = get_bounding_size(monitors)
+    path_input = pathlib.Path(path_input)
+    return path_input.with_name(f'{path_input.stem}_{width}x{height}-{LAYOUT_SUFFIXES[mode]}.jpg')
+
+
+def get_cover_box(width: int, height: int, target_width: int, target_height: int):
+    """
+    Get the centred crop of an image with the aspect ratio of the target, so that
+    resizing it covers the target without bars or distortion.
+
+    :return: (left, upper, right, lower)
+    """
+    f = max(target_width / width, target_height / height)
+    crop_width = target_width / f
+    crop_height = target_height / f
+    left = (width - crop_width) / 2
+    upper = (height - crop_height) / 2
+    return left, upper, left + crop_width, upper + crop_height
+
+
+def compose(path_input: pathlib.Path, monitors, mode: str, path_output: pathlib.Path = None):
+    """
+    Compose an image covering the virtual screen from one downloaded image.
+
+    In span mode the image is resized once to cover the whole virtual screen. In
+    per-monitor mode it is resized to cover each monitor and placed at that
+    monitor's position. Crop and resize are a single resampling pass per output.
+
+    :return: Path to the composed JPEG, to be shown with picture-options 'spanned'.
+    """
+    from PIL import Image
+
+    path_output = get_composed_path(path_input, monitors, mode) if path_output is None else path_output
+    size = get_bounding_size(monitors)
+    with Image.open(path_input) as image:
+        image = image.convert('RGB')
+        if mode == 'span':
+            composed = image.resize(size, Image.Resampling.LANCZOS, box=get_cover_box(*image.size, *size))
+        else:
+            composed = Image.new('RGB', size)
+            for monitor in monitors:
+                composed.paste(
+                    image.resize((monitor.width, monitor.height), Image.Resampling.LANCZOS,
+                                 box=get_cover_box(*image.size, monitor.width, monitor.height)),
+                    (monitor.x, monitor.y))
+
+    return _save_jpeg(composed, path_output)
+
+
+def _save_jpeg(image, path_output: pathlib.Path):
+    path_tmp = path_output.with_name(f'.{path_output.name}.part')
+    image.save(path_tmp, 'JPEG', quality=JPEG_QUALITY)
+    path_tmp.replace(path_output)
+    return path_output
+
+
+def get_rendered_path(path_input: pathlib.Path, monitors, mode: str):
+    """
+    Get the path of an image prepared for the screen by render().
+    """
+    if is_composed(monitors, mode):
+        return get_composed_path(path_input, monitors, mode)
+    width, height = get_largest(monitors)
+    path_input = pathlib.Path(path_input)
+    return path_input.with_name(f'{path_input.stem}_{width}x{height}-{RENDERED_SUFFIX}.jpg')
+
+
+def render(path_input: pathlib.Path, monitors, mode: str, path_output: pathlib.Path = None):
+    """
+    Crop and resize an image to exactly what the screen shows, so the desktop
+    only needs to decode it without scaling a full-size image.
+
+    :return: Path to the rendered JPEG, composed for all monitors if the mode needs it.
+    """
+    if is_composed(monitors, mode):
+        return compose(path_input, monitors, mode, path_output)
+
+    from PIL import Image
+
+    path_output = get_rendered_path(path_input, monitors, mode) if path_output is None else path_output
+    size = get_largest(monitors)
+    with Image.open(path_input) as image:
+        image = image.convert('RGB')
+        rendered = image.resize(size, Image.Resampling.LANCZOS, box=get_cover_box(*image.size, *size))
+    return _save_jpeg(rendered, path_output)
@@ -0,0 +1,170 @@
+import collections
+import configparser
+import functools
+import os
+import pathlib
+import re
+
+import archive_index
+import derivative_cache
+import screen_layout
+
+UPSCALE_BACKENDS = ['auto', 'arbsr-cpu', 'arbsr-gpu', 'lanczos']
+# A line of user-dirs.dirs, e.g. XDG_PICTURES_DIR="$HOME/Pictures"
+USER_DIR = re.compile(r'^\s*XDG_(?P<name>\w+)_DIR\s*=\s*"(?P<path>.*)"\s*$')
+# Values of config.ini with their types given by the defaults. rotation_interval is in minutes
+DEFAULTS = {
+    'market_area': '',
+    'dir_path': '',
+    'dir_max_size': 100 * 1024 * 1024,
+    'dir_max_count': -1,
+    'dir_max_age': -1,
+    'eviction': 'name',
+    'layout': 'largest',
+    'rotation_order': 'shuffle',
+    'rotation_interval': 30.0,
+    'timeout': 60.0,
+    'max_image_size': -1,
+    'metered_max_image_size': 1024 * 1024,
+    'upstream': '',
+    'upscale_backend': 'auto',
+    'time_budget': 600.0,
+    'worker_urls': '',
+    'workers': 1,
+    'upscale_format': 'png',
+    'png_level': 6,
+    'upscale_quality': 95,
+    'cache_max_size': 500 * 1024 * 1024,
+    'timing_log': '',
+    'prometheus_textfile': '',
+}
+
+# The config file, empty or invalid values replaced by their defaults
+Settings = collections.namedtuple('Settings', list(DEFAULTS), defaults=list(DEFAULTS.values()))
+
+# (section, key, field) in the order of the config file
+KEYS = [
+    ('market', 'area', 'market_area'),
+    ('directory', 'dir_path', 'dir_path'),
+    ('directory', 'dir_max_size', 'dir_max_size'),
+    ('directory', 'dir_max_count', 'dir_max_count'),
+    ('directory', 'dir_max_age', 'dir_max_age'),
+    ('directory', 'eviction', 'eviction'),
+    ('screen', 'layout', 'layout'),
+    ('rotation', 'order', 'rotation_order'),
+    ('rotation', 'interval', 'rotation_interval'),
+    ('network', 'timeout', 'timeout'),
+    ('network', 'max_image_size', 'max_image_size'),
+    ('network', 'metered_max_image_size', 'metered_max_image_size'),
+    ('network', 'upstream', 'upstream'),
+    ('upscale', 'backend', 'upscale_backend'),
+    ('upscale', 'time_budget', 'time_budget'),
+    ('upscale', 'worker_urls', 'worker_urls'),
+    ('upscale', 'workers', 'workers'),
+    ('upscale', 'format', 'upscale_format'),
+    ('upscale', 'png_compression', 'png_level'),
+    ('upscale', 'quality', 'upscale_quality'),
+    ('upscale', 'cache_max_size', 'cache_max_size'),
+    ('timing', 'log', 'timing_log'),
+    ('timing', 'prometheus_textfile', 'prometheus_textfile'),
+]
+CHOICES = {
+    'eviction': list(archive_index.EVICTION_ORDERS),
+    'layout': screen_layout.LAYOUT_MODES,
+    'rotation_order': archive_index.ROTATION_ORDERS,
+    'upscale_backend': UPSCALE_BACKENDS,
+    'upscale_format': derivative_cache.ENCODINGS,
+    'png_level': list(range(10)),
+    'upscale_quality': list(range(1, 101)),
+}
+
+
+def parse(config: configparser.ConfigParser):
+    """
+    Convert and validate the values of a config file, printing what is wrong with invalid ones.
+
+    :return: Settings
+    """
+    values = {}
+    for section, key, field in KEYS:
+        default = DEFAULTS[field]
+        try:
+            text = config.get(section, key, fallback='').strip()
+        except configparser.Error as err:
+            # e.g. a stray % in the value
+            print(f'Invalid {key} in [{section}]: {err}, using {default}')
+            continue
+        if not text:
+            continue
+        try:
+            value = type(default)(text)
+        except ValueError:
+            print(f'Invalid {key} in [{section}]: {text}, using {default}')
+            continue
+        if field in CHOICES and value not in CHOICES[field]:
+            print(f'Unknown {key} in [{section}]: {value}, using {default}')
+            continue
+        values[field] = value
+    if 'upstream' in values:
+        values['upstream'] = values['upstream'].rstrip('/')
+    return Settings(**values)
+
+
+@functools.lru_cache(maxsize=4)
+def _load(path: str, mtime_ns: int, size: int):
+    # A key given twice takes the last value instead of failing
+    config = configparser.ConfigParser(strict=False)
+    try:
+        config.read(path)
+    except configparser.ParsingError as err:
+        # Raised once the whole file was read, the valid lines are kept
+        print(f'Malformed config file {path}: {err}')
+    except (configparser.Error, UnicodeDecodeError) as err:
+        print(f'Malformed config file {path}: {err}, using the defaults')
+        config = configparser.ConfigParser()
+    return parse(config)
+
+
+def load(path: pathlib.Path):
+    """
+    Get the settings of a config file.
+
+    The file is only parsed again after it changed, so reading the settings
+    costs a single stat() and a long running process still sees edits. A
+    malformed file or value prints a warning and uses the defaults for what
+    can't be read.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return Settings()
+    return _load(str(path), stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=None)
+def get_user_dir(name: str):
+    """
+    Get an XDG user directory like xdg-user-dir does, but without starting a shell.
+
+    :param name: Directory name as in user-dirs.dirs, e.g. PICTURES.
+    :return: Path, the home directory if it isn't configured.
+    """
+    home = pathlib.Path.home()
+    config_home = pathlib.Path(os.environ.get('XDG_CONFIG_HOME') or home / '.config')
+    try:
+        with open(config_home / 'user-dirs.dirs', encoding='utf-8') as f:
+            lines = f.readlines()
+    except OSError:
+        return home
+
+    for line in lines:
+        match = USER_DIR.match(line)
+        if match is None or match.group('name') != name:
+            continue
+        path = match.group('path').replace('\\"', '"')
+        # Paths are either absolute or relative to $HOME
+        if path == '$HOME' or path.startswith('$HOME/'):
+            return home / path[len('$HOME/'):]
+        if path.startswith('/'):
+            return pathlib.Path(path)
+    return home
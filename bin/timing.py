@@ -0,0 +1,173 @@
+import json
+import os
+import pathlib
+import threading
+import time
+
+# Spans are only recorded after enable(), until then span() and count() return
+# right away, so the instrumentation costs next to nothing by default
+_enabled = False
+_log_path = None
+_textfile_path = None
+_finished = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class Span:
+    """
+    A timed phase of a run, with the bytes transferred and files scanned during it.
+    """
+
+    def __init__(self, name: str, depth: int):
+        self.name = name
+        self.depth = depth
+        self.bytes = 0
+        self.files = 0
+        self.start = None
+        self.seconds = None
+        self.error = None
+
+    def __enter__(self):
+        _stack().append(self)
+        self.start = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self._start
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        _stack().remove(self)
+        with _lock:
+            _finished.append(self)
+        return False
+
+    def to_dict(self):
+        return {
+            'name': self.name, 'depth': self.depth, 'start': self.start, 'seconds': self.seconds,
+            'bytes': self.bytes, 'files': self.files, 'error': self.error,
+        }
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def enable(log_path: pathlib.Path = None, textfile_path: pathlib.Path = None):
+    """
+    Start recording spans.
+
+    :param log_path: JSON-lines file every finished span is appended to.
+    :param textfile_path: Prometheus textfile collector file (*.prom), rewritten by finish().
+    """
+    global _enabled, _log_path, _textfile_path
+    _enabled = True
+    _log_path = log_path
+    _textfile_path = textfile_path
+
+
+def is_enabled():
+    return _enabled
+
+
+def span(name: str, depth: int = None):
+    """
+    Time a phase, as a context manager. Spans started inside it are nested in the report.
+
+    :param depth: Nesting level in the report, for spans in another thread than their parent, see get_depth().
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(name, len(_stack()) if depth is None else depth)
+
+
+def get_depth():
+    """
+    :return: Nesting level of a span started now in the calling thread.
+    """
+    return len(_stack()) if _enabled else 0
+
+
+def count(n_bytes: int = 0, n_files: int = 0):
+    """
+    Add transferred bytes or scanned files to the innermost span of the calling thread.
+    """
+    if not _enabled:
+        return
+    stack = _stack()
+    if stack:
+        stack[-1].bytes += n_bytes
+        stack[-1].files += n_files
+
+
+def format_report(spans):
+    lines = [f'{"phase":<32} {"seconds":>9} {"bytes":>12} {"files":>8}']
+    for s in sorted(spans, key=lambda s: s.start):
+        name = '  ' * s.depth + s.name + (f' ({s.error})' if s.error else '')
+        lines.append(f'{name:<32} {s.seconds:>9.3f} {s.bytes:>12} {s.files:>8}')
+    return '\n'.join(lines)
+
+
+def _write_textfile(path: pathlib.Path, spans):
+    # Phases that occur more than once per run (e.g. per tile) are summed
+    totals = {}
+    for s in spans:
+        total = totals.setdefault(s.name, [0.0, 0, 0])
+        total[0] += s.seconds
+        total[1] += s.bytes
+        total[2] += s.files
+
+    lines = []
+    for metric, index, help_text in (
+            ('bdwc_phase_seconds', 0, 'Wall time of a phase of the last run'),
+            ('bdwc_phase_bytes', 1, 'Bytes transferred during a phase of the last run'),
+            ('bdwc_phase_files', 2, 'Files scanned during a phase of the last run')):
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} gauge')
+        for name, total in sorted(totals.items()):
+            lines.append(f'{metric}{{phase="{name}"}} {total[index]}')
+    lines.append('# HELP bdwc_last_run_timestamp_seconds Time the last run finished')
+    lines.append('# TYPE bdwc_last_run_timestamp_seconds gauge')
+    lines.append(f'bdwc_last_run_timestamp_seconds {time.time()}')
+
+    # The collector may read at any time, so replace the file atomically
+    path = pathlib.Path(path)
+    path_tmp = path.with_name(path.name + '.tmp')
+    with open(path_tmp, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(path_tmp, path)
+
+
+def finish():
+    """
+    Write the spans finished since the last call to the log and the textfile.
+
+    :return: List of the finished spans.
+    """
+    global _finished
+    if not _enabled:
+        return []
+    with _lock:
+        spans, _finished = _finished, []
+
+    if _log_path is not None:
+        with open(_log_path, 'a') as f:
+            for s in spans:
+                f.write(json.dumps(s.to_dict()) + '\n')
+    if _textfile_path is not None and spans:
+        _write_textfile(_textfile_path, spans)
+    return spans
@@ -1,8 +1,30 @@
+import concurrent.futures
+import math
+import os
 import subprocess
 import pathlib
 
 import numpy as np
-import skimage.io  # Preferred over opencv, since it is smaller and we are just doing io (perf not important)
+
+import png_writer
+
+# Upscaled tiles are kept under this name in their tile directory, so an
+# interrupted upscale can resume from the finished tiles
+CHECKPOINT_NAME = 'upscaled.png'
+
+GPU_MODEL = 'r8.im/longguangwang/arbsr@sha256:9e20d2768e62c16716c585a899105a63cd5d36f6be17a208dbc201027325d881'
+# https://github.com/knoffelcut/ArbSR-cpu, build using `cog build -t arbsr-cpu`
+CPU_MODEL = 'arbsr-cpu'
+# Backend and model version, part of the name of an upscaled image in the derivative cache
+MODEL_IDS = {
+    'arbsr-gpu': f'arbsr-gpu-{GPU_MODEL.rpartition(":")[2][:12]}',
+    'arbsr-cpu': CPU_MODEL,
+    'lanczos': 'lanczos',
+}
+
+# Rough peak memory of one upscaling worker per output pixel of its tile,
+# used to keep the number of concurrent tiles within the available memory
+WORKER_BYTES_PER_PIXEL = 256
 
 
 def upscale_gpu(path_input: str, target_width: int, target_height: int, directory_working: str = '/tmp'):
@@ -11,7 +33,7 @@ def upscale_gpu(path_input: str, target_width: int, target_height: int, director
     path_output.unlink(missing_ok=True)
     call = [
         'cog', 'predict',
-        'r8.im/longguangwang/arbsr@sha256:9e20d2768e62c16716c585a899105a63cd5d36f6be17a208dbc201027325d881',
+        GPU_MODEL,
         '-i', f'image=@{path_input}',
         '-i', f'target_width={target_width}',
         '-i', f'target_height={target_height}',
@@ -27,7 +49,7 @@ def upscale_cpu(path_input: str, target_width: int, target_height: int, director
     path_output.unlink(missing_ok=True)
     call = [
         'cog', 'predict',
-        'arbsr-cpu',  # https://github.com/knoffelcut/ArbSR-cpu, build using `cog build -t arbsr-cpu`
+        CPU_MODEL,
         '-i', f'image=@{path_input}',
         '-i', f'target_width={target_width}',
         '-i', f'target_height={target_height}',
@@ -37,54 +59,215 @@ def upscale_cpu(path_input: str, target_width: int, target_height: int, director
     return path_output
 
 
+def upscale_lanczos(path_input: str, target_width: int, target_height: int, directory_working: str = '/tmp'):
+    """
+    Classical Lanczos upscaling in-process, a fast fallback when ArbSR is unavailable or too slow.
+    """
+    from PIL import Image
+
+    assert pathlib.Path(path_input).exists()
+    path_output = pathlib.Path(directory_working) / 'output.png'
+    path_output.unlink(missing_ok=True)
+    with Image.open(path_input) as image:
+        image.resize((target_width, target_height), Image.Resampling.LANCZOS).save(path_output)
+    assert path_output.exists()
+    return path_output
+
+
+def get_available_memory():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_pool_size(n_tiles: int, tile_pixels: int):
+    """
+    Number of tiles to upscale concurrently, bounded by the cores and the available memory.
+    """
+    workers = min(n_tiles, os.cpu_count() or 1)
+    memory = get_available_memory()
+    if memory is not None:
+        workers = min(workers, memory // (tile_pixels * WORKER_BYTES_PER_PIXEL))
+    return max(1, workers)
+
+
+def get_parts(workers: int = None):
+    """
+    Split into at least as many tiles as there are cores, as square as possible.
+
+    :return: (parts_x, parts_y)
+    """
+    workers = workers or os.cpu_count() or 1
+    parts_x = math.ceil(math.sqrt(workers))
+    parts_y = math.ceil(workers / parts_x)
+    return parts_x, parts_y
+
+
+def get_ramp(length: int, ramp_start: int, ramp_end: int):
+    """
+    Blending weights along one axis of a tile.
+
+    The weights rise linearly over the overlap with the previous tile and fall
+    over the overlap with the next tile. The rising ramp of a tile and the
+    falling ramp of its neighbour sum to 1 at every pixel.
+    """
+    ramp = np.ones(length, dtype=np.float32)
+    if ramp_start > 0:
+        ramp[:ramp_start] = (np.arange(ramp_start, dtype=np.float32) + 0.5) / ramp_start
+    if ramp_end > 0:
+        ramp[length - ramp_end:] = 1 - (np.arange(ramp_end, dtype=np.float32) + 0.5) / ramp_end
+    return ramp
+
+
+def get_tile_bounds(length: int, parts: int, overlap: int, f: float, target_length: int):
+    """
+    Get the source and target bounds of the tiles along one axis.
+
+    :param length: Source size.
+    :param parts: Number of tiles.
+    :param overlap: Overlap in source pixels added on each side of an inner tile edge.
+    :param f: Scale factor.
+    :param target_length: Target size.
+    :return: List of (source start, source end, target start, target end).
+    """
+    edges = np.linspace(0, length, parts + 1).round().astype(int)
+    bounds = []
+    for i in range(parts):
+        s0 = max(0, edges[i] - overlap) if i > 0 else 0
+        s1 = min(length, edges[i + 1] + overlap) if i < parts - 1 else length
+        t0 = min(target_length, int(round(s0 * f)))
+        t1 = min(target_length, int(round(s1 * f))) if i < parts - 1 else target_length
+        bounds.append((s0, s1, t0, t1))
+    return bounds
+
+
+class Cancelled(Exception):
+    pass
+
+
+def upscale_tile(backend, path_input: pathlib.Path, target_width: int, target_height: int,
+                 directory_working: pathlib.Path):
+    """
+    Upscale a tile with backend, unless it was already upscaled by an earlier run.
+
+    :return: Path to the checkpoint of the upscaled tile.
+    """
+    path_checkpoint = pathlib.Path(directory_working) / CHECKPOINT_NAME
+    if not path_checkpoint.exists():
+        path_output = backend(path_input, target_width, target_height, directory_working)
+        os.replace(path_output, path_checkpoint)
+    return path_checkpoint
+
+
 def upscale_parts(
     path_input: str, target_width: int, target_height: int,
     parts_x: int = 2, parts_y: int = 2, overlap: int = 128,
-    directory_working: str = '/tmp'
+    directory_working: str = '/tmp', backend=upscale_gpu, max_workers: int = None,
+    resume: bool = False, is_cancelled=None, compress_level: int = 6, encode_workers: int = 1
 ):
+    """
+    Upscale an image in overlapping tiles, concurrently.
+
+    Every tile gets its own working directory and is upscaled by backend on a
+    process pool sized to the cores and the available memory. Overlaps are
+    blended with linear feathering.
+
+    The output is assembled one row of tiles at a time: the rows that no later
+    tile overlaps are encoded and dropped, so only a band of about one tile
+    height is held in memory instead of the whole output.
+
+    :param overlap: Overlap between neighbouring tiles in target pixels.
+    :param backend: upscale_cpu, upscale_gpu or any function with the same signature.
+    :param max_workers: Maximum number of concurrent tiles, defaults to get_pool_size.
+    :param resume: Reuse tiles upscaled by an earlier, interrupted call with the same directory_working.
+    :param is_cancelled: Optional callable () -> bool, polled between tiles.
+    :param compress_level: zlib level of the output PNG.
+    :param encode_workers: Threads compressing the output PNG, see png_writer.
+    :raises Cancelled: If is_cancelled returned True.
+    :return: Path to the upscaled PNG in directory_working.
+    """
+    from PIL import Image
+
     assert pathlib.Path(path_input).exists()
 
     path_input = pathlib.Path(path_input)
-    image = skimage.io.imread(path_input)
-    image_height = image.shape[0]
-    image_width = image.shape[1]
-    fx = (target_width/image_width)
-    fy = (target_height/image_height)
+    directory_working = pathlib.Path(directory_working)
+    tiles = {}
+    # The source is decoded once and only its tile crops are written out; it
+    # is released before any upscaled tile is loaded
+    with Image.open(path_input) as image:
+        if image.mode not in ('L', 'RGB', 'RGBA'):
+            image = image.convert('RGB')
+        mode = image.mode
+        channels = len(mode)
+        image_width, image_height = image.size
+        fx = (target_width/image_width)
+        fy = (target_height/image_height)
 
-    parts_x = list(np.linspace(0, image_width, parts_x, endpoint=False, dtype=int))
-    parts_y = list(np.linspace(0, image_height, parts_y, endpoint=False, dtype=int))
+        # Overlap on each side of an edge, so the blended zone is twice as wide
+        overlap_x = math.ceil(overlap / fx / 2)
+        overlap_y = math.ceil(overlap / fy / 2)
+        bounds_x = get_tile_bounds(image_width, parts_x, overlap_x, fx, target_width)
+        bounds_y = get_tile_bounds(image_height, parts_y, overlap_y, fy, target_height)
 
-    directory_working = pathlib.Path(directory_working)
-    parts = []
-    for y0, y1 in zip(parts_y, parts_y[1:] + [None, ]):
-        parts_ = []
-        for x0, x1 in zip(parts_x, parts_x[1:] + [None, ]):
-            overlap_x = overlap/fx
-            overlap_y = overlap/fy
-            assert overlap_x == int(overlap_x) and overlap_y == int(overlap_y)
-            overlap_x, overlap_y = int(overlap_x), int(overlap_y)
-
-            py0, py1 = overlap_x*bool(y0), overlap_x*bool(y1)
-            px0, px1 = overlap_y*bool(x0), overlap_y*bool(x1)
-
-            part = image[y0 - py0:(y1 + py1) if y1 is not None else y1, x0 - px0:(x1 + px1) if x1 is not None else x1]
-            path_part = (directory_working / 'input').with_suffix(path_input.suffix)
-            skimage.io.imsave(path_part, part)
-
-            part_target_width = fx*part.shape[1]
-            part_target_height = fy*part.shape[0]
-            assert part_target_width == int(part_target_width) and part_target_height == int(part_target_height)
-            part_target_width, part_target_height = int(part_target_width), int(part_target_height)
-            path_upscale = upscale_gpu(path_part, part_target_width, part_target_height, directory_working)
-            part_upscale = skimage.io.imread(path_upscale)
-
-            # Remove the upscaled overlap sections
-            py0, py1 = int(fy*py0), int(fy*py1)
-            px0, px1 = int(fx*px0), int(fx*px1)
-            part_upscale = part_upscale[py0:-py1 if py1 > 0 else None, px0:-px1 if px1 > 0 else None]
-
-            parts_.append(part_upscale)
-        parts.append(parts_)
-
-    upscaled = np.vstack([np.hstack(parts_) for parts_ in parts])
-    return upscaled
+        for iy, (sy0, sy1, ty0, ty1) in enumerate(bounds_y):
+            for ix, (sx0, sx1, tx0, tx1) in enumerate(bounds_x):
+                directory_tile = directory_working / f'tile_{iy}_{ix}'
+                directory_tile.mkdir(parents=True, exist_ok=True)
+                path_part = (directory_tile / 'input').with_suffix(path_input.suffix)
+                if not resume:
+                    (directory_tile / CHECKPOINT_NAME).unlink(missing_ok=True)
+                image.crop((sx0, sy0, sx1, sy1)).save(path_part)
+                tiles[(iy, ix)] = (path_part, tx1 - tx0, ty1 - ty0, directory_tile)
+
+    tile_pixels = max(width * height for _, width, height, _ in tiles.values())
+    if max_workers is None:
+        max_workers = get_pool_size(len(tiles), tile_pixels)
+
+    path_output = directory_working / 'output.png'
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor, \
+            png_writer.PngWriter(path_output, target_width, target_height, channels,
+                                 compress_level, encode_workers) as writer:
+        futures = {key: executor.submit(upscale_tile, backend, *tile) for key, tile in tiles.items()}
+
+        # Blended rows from band_start on; the ramps of overlapping tiles sum
+        # to 1, so the weighted sum needs no normalisation
+        band_start = 0
+        band = np.zeros((0, target_width, channels), dtype=np.float32)
+        for iy in range(parts_y):
+            ty0, ty1 = bounds_y[iy][2:]
+            band_end = band_start + band.shape[0]
+            if ty1 > band_end:
+                band = np.concatenate([band, np.zeros((ty1 - band_end, target_width, channels), dtype=np.float32)])
+            ramp_top = bounds_y[iy - 1][3] - ty0 if iy > 0 else 0
+            ramp_bottom = ty1 - bounds_y[iy + 1][2] if iy < parts_y - 1 else 0
+            ramp_y = get_ramp(ty1 - ty0, ramp_top, ramp_bottom)
+
+            for ix in range(parts_x):
+                if is_cancelled is not None and is_cancelled():
+                    # Tiles that are running still finish and are kept for a resume
+                    for future in futures.values():
+                        future.cancel()
+                    raise Cancelled()
+                tx0, tx1 = bounds_x[ix][2:]
+                with Image.open(futures[(iy, ix)].result()) as part:
+                    part_upscale = np.asarray(part.convert(mode) if part.mode != mode else part)
+                if part_upscale.ndim == 2:
+                    part_upscale = part_upscale[..., np.newaxis]
+                assert part_upscale.shape[:2] == (ty1 - ty0, tx1 - tx0)
+
+                # The blended zone spans from the start of the next tile to the end of this one
+                ramp_left = bounds_x[ix - 1][3] - tx0 if ix > 0 else 0
+                ramp_right = tx1 - bounds_x[ix + 1][2] if ix < parts_x - 1 else 0
+                weight = np.outer(ramp_y, get_ramp(tx1 - tx0, ramp_left, ramp_right))[..., np.newaxis]
+                band[ty0 - band_start:ty1 - band_start, tx0:tx1] += part_upscale * weight
+                del part_upscale, weight
+
+            # Rows above the next row of tiles are final
+            done = bounds_y[iy + 1][2] if iy < parts_y - 1 else target_height
+            writer.write_rows(np.clip(np.round(band[:done - band_start]), 0, 255).astype(np.uint8))
+            band = band[done - band_start:].copy()
+            band_start = done
+
+    return path_output
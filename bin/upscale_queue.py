@@ -0,0 +1,216 @@
+import contextlib
+import fcntl
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import time
+
+import derivative_cache
+import json_file
+import upscale_arbsr
+
+JOB_FILE_NAME = 'job.json'
+# Created in a job directory when a newer wallpaper replaced the job's image
+CANCELLED_FILE_NAME = 'cancelled'
+LOCK_FILE_NAME = 'worker.lock'
+NICENESS = 19
+# Without AC power, jobs only run while the 1 minute load average per core is below this
+IDLE_LOAD = 0.5
+CHECK_INTERVAL = 60
+POWER_SUPPLY_PATH = pathlib.Path('/sys/class/power_supply')
+
+
+class Paused(Exception):
+    """
+    The system left AC power or stopped being idle while a job ran. The job
+    stays queued and resumes from its finished tiles.
+    """
+
+
+def _read_text(path: pathlib.Path):
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return None
+
+
+def is_on_ac_power(power_supply_path: pathlib.Path = POWER_SUPPLY_PATH):
+    """
+    :return: True if a mains adapter is online, or if the machine has no battery.
+    """
+    try:
+        supplies = list(power_supply_path.iterdir())
+    except OSError:
+        return True
+    has_battery = False
+    for supply in supplies:
+        supply_type = _read_text(supply / 'type')
+        if supply_type == 'Mains' and _read_text(supply / 'online') == '1':
+            return True
+        has_battery |= supply_type == 'Battery'
+    return not has_battery
+
+
+def is_idle(own_load: float = 0):
+    """
+    :param own_load: Load caused by this program, e.g. the tiles of a running job.
+    """
+    try:
+        return os.getloadavg()[0] < IDLE_LOAD * (os.cpu_count() or 1) + own_load
+    except OSError:
+        return True
+
+
+def is_allowed(own_load: float = 0):
+    return is_on_ac_power() or is_idle(own_load)
+
+
+def set_low_priority():
+    """
+    Lower the CPU and I/O priority of this process, inherited by the upscaling processes it starts.
+    """
+    os.nice(NICENESS - os.nice(0))
+    if shutil.which('ionice'):
+        subprocess.run(['ionice', '-c', '3', '-p', str(os.getpid())], check=False)
+
+
+def get_jobs(queue_dir: pathlib.Path):
+    """
+    :return: Job directories, oldest first.
+    """
+    try:
+        directories = [path for path in queue_dir.iterdir() if (path / JOB_FILE_NAME).is_file()]
+    except FileNotFoundError:
+        return []
+    return sorted(directories, key=lambda path: load_job(path).get('created', 0))
+
+
+def load_job(job_dir: pathlib.Path):
+    return json_file.load(job_dir / JOB_FILE_NAME)
+
+
+def is_cancelled(job_dir: pathlib.Path):
+    return (job_dir / CANCELLED_FILE_NAME).exists()
+
+
+def enqueue(queue_dir: pathlib.Path, source: pathlib.Path, target: pathlib.Path, width: int, height: int,
+            **extra):
+    """
+    Add an upscale job, cancelling the jobs of older images.
+
+    A job for the same target that was interrupted keeps its finished tiles.
+
+    :param extra: Additional values stored with the job, e.g. the desktop environment.
+    :return: Job directory.
+    """
+    job_dir = queue_dir / pathlib.Path(target).stem
+    for other in get_jobs(queue_dir):
+        if other != job_dir:
+            (other / CANCELLED_FILE_NAME).touch()
+
+    job_dir.mkdir(parents=True, exist_ok=True)
+    (job_dir / CANCELLED_FILE_NAME).unlink(missing_ok=True)
+    if not (job_dir / JOB_FILE_NAME).is_file():
+        parts_x, parts_y = upscale_arbsr.get_parts()
+        job = dict(extra, source=str(source), target=str(target), width=width, height=height,
+                   parts_x=parts_x, parts_y=parts_y, created=time.time())
+        json_file.save(job_dir / JOB_FILE_NAME, job)
+    return job_dir
+
+
+def remove(job_dir: pathlib.Path):
+    shutil.rmtree(job_dir, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def lock(queue_dir: pathlib.Path):
+    """
+    Hold the worker lock of the queue, so only one worker runs at a time.
+
+    :return: True if the lock was acquired, False if another worker holds it.
+    """
+    queue_dir.mkdir(parents=True, exist_ok=True)
+    with open(queue_dir / LOCK_FILE_NAME, 'w') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+
+
+def spawn_worker(command):
+    """
+    Start a worker in the background, detached from this process and its session.
+
+    :param command: Arguments after the Python interpreter, e.g. ['main.py', '--upscale-jobs'].
+    """
+    subprocess.Popen([sys.executable] + list(command), start_new_session=True,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_until_allowed(job_dir: pathlib.Path):
+    """
+    Sleep until the system is on AC power or idle.
+
+    :return: False if the job was cancelled meanwhile.
+    """
+    while not is_allowed():
+        if is_cancelled(job_dir):
+            return False
+        time.sleep(CHECK_INTERVAL)
+    return not is_cancelled(job_dir)
+
+
+def run_job(job_dir: pathlib.Path, backend, tiled: bool = True, target: pathlib.Path = None,
+            encoding: derivative_cache.Encoding = None, max_workers: int = None):
+    """
+    Upscale the image of a job and move the result to its target.
+
+    Tiles are upscaled in the job directory, so a job that is interrupted
+    (logout, shutdown) resumes from its finished tiles. Between tiles the job
+    stops if the system left AC power and is no longer idle.
+
+    :param backend: Upscale function, see upscale_arbsr.
+    :param tiled: Upscale in tiles, with checkpoints; otherwise backend gets the whole image.
+    :param target: Path of the upscaled image, defaults to the job's target.
+    :param encoding: derivative_cache.Encoding of the target, None keeps the backend's PNG.
+    :param max_workers: Maximum number of concurrent tiles, see upscale_arbsr.upscale_parts.
+    :raises upscale_arbsr.Cancelled: If a newer wallpaper replaced the job's image.
+    :raises Paused: If the system stopped being on AC power or idle, see wait_until_allowed.
+    :return: Path to the upscaled image.
+    """
+    job = load_job(job_dir)
+    directory_working = job_dir / 'work'
+    directory_working.mkdir(exist_ok=True)
+    # A tiled PNG is encoded as it is assembled, anything else is encoded from a quickly compressed PNG
+    encoded = tiled and (encoding is None or encoding.format == 'png')
+    if tiled:
+        # The running tiles add up to one to the load each
+        own_load = max_workers or os.cpu_count() or 1
+        try:
+            path_upscaled = upscale_arbsr.upscale_parts(
+                job['source'], job['width'], job['height'], job['parts_x'], job['parts_y'],
+                directory_working=directory_working, backend=backend, max_workers=max_workers,
+                resume=True, is_cancelled=lambda: is_cancelled(job_dir) or not is_allowed(own_load),
+                compress_level=(encoding or derivative_cache.Encoding()).png_level if encoded else 1,
+                encode_workers=os.cpu_count() or 1)
+        except upscale_arbsr.Cancelled:
+            if not is_cancelled(job_dir):
+                raise Paused()
+            raise
+    else:
+        path_upscaled = backend(job['source'], job['width'], job['height'], directory_working)
+    if is_cancelled(job_dir):
+        raise upscale_arbsr.Cancelled()
+
+    target = pathlib.Path(job['target'] if target is None else target)
+    path_tmp = target.with_name(f'.{target.name}.part')
+    if encoded or encoding is None:
+        shutil.move(path_upscaled, path_tmp)
+    else:
+        derivative_cache.encode(path_upscaled, path_tmp, encoding)
+    os.replace(path_tmp, target)
+    return target
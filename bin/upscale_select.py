@@ -0,0 +1,108 @@
+import pathlib
+import tempfile
+import time
+
+import numpy as np
+
+import json_file
+
+# Source sizes of the calibration runs, each upscaled 2x. Two sizes separate
+# the fixed cost per call (container start, model load) from the cost per pixel.
+# The larger is a tile of a 1920x1080 image split 2x2 by upscale_parts, large
+# enough for the cost per pixel to stand out of the noise of the fixed cost.
+BENCHMARK_SIZES = [(64, 64), (960, 540)]
+# Benchmarks are repeated after this many seconds, failed or inconclusive ones
+# sooner, e.g. to notice that cog got installed
+BENCHMARK_MAX_AGE = 30 * 24 * 60 * 60
+BENCHMARK_ERROR_MAX_AGE = 24 * 60 * 60
+
+
+def benchmark(backend):
+    """
+    Measure the fixed cost per call and the cost per output pixel of a backend.
+
+    :param backend: Upscale function, see upscale_arbsr.
+    :return: Dict with 'fixed' and 'per_pixel' seconds, or 'error' if the backend failed.
+        per_pixel is None if the larger run wasn't slower, so the cost is unknown.
+    """
+    import skimage.io
+
+    rng = np.random.default_rng(0)
+    timings = []
+    try:
+        with tempfile.TemporaryDirectory(prefix='bdwc-benchmark-') as directory_working:
+            for width, height in BENCHMARK_SIZES:
+                path_input = pathlib.Path(directory_working) / f'input_{width}x{height}.png'
+                skimage.io.imsave(path_input, rng.integers(0, 256, (height, width, 3), dtype=np.uint8),
+                                  check_contrast=False)
+                time_start = time.perf_counter()
+                backend(path_input, 2 * width, 2 * height, directory_working)
+                timings.append((4 * width * height, time.perf_counter() - time_start))
+    except Exception as err:
+        return {'error': str(err), 'measured': time.time()}
+
+    (pixels_small, time_small), (pixels_large, time_large) = timings
+    if time_large <= time_small:
+        # Noise, not free
+        return {'fixed': time_small, 'per_pixel': None, 'measured': time.time()}
+    per_pixel = (time_large - time_small) / (pixels_large - pixels_small)
+    fixed = max(0.0, time_small - per_pixel * pixels_small)
+    return {'fixed': fixed, 'per_pixel': per_pixel, 'measured': time.time()}
+
+
+def is_conclusive(result: dict):
+    return 'error' not in result and result.get('per_pixel') is not None
+
+
+def get_benchmarks(backends: dict, path: pathlib.Path, now: float = None):
+    """
+    Get the benchmark of every backend, measuring those that are missing or stale.
+
+    :param backends: Dict of backend name to upscale function.
+    :param path: JSON file the results are recorded in.
+    :return: Dict of backend name to benchmark result.
+    """
+    now = time.time() if now is None else now
+    benchmarks = json_file.load(path)
+    changed = False
+    for name, backend in backends.items():
+        result = benchmarks.get(name)
+        max_age = BENCHMARK_ERROR_MAX_AGE if result is not None and not is_conclusive(result) else BENCHMARK_MAX_AGE
+        if result is None or now - result.get('measured', 0) > max_age:
+            benchmarks[name] = benchmark(backend)
+            changed = True
+    if changed:
+        json_file.save(path, benchmarks, indent=2)
+    return {name: benchmarks[name] for name in backends}
+
+
+def estimate(result: dict, pixels: int):
+    """
+    :return: Estimated seconds to produce an image of this many pixels, None if the
+        backend failed or its cost per pixel is unknown.
+    """
+    if not is_conclusive(result):
+        return None
+    return result['fixed'] + result['per_pixel'] * pixels
+
+
+def select_backend(candidates, benchmarks: dict, pixels: int, time_budget: float):
+    """
+    Pick the first candidate that is expected to finish within the time budget.
+
+    :param candidates: Backend names, best quality first.
+    :param benchmarks: Result of get_benchmarks.
+    :param pixels: Number of output pixels.
+    :param time_budget: Seconds.
+    :return: Name of the selected backend, the fastest working one if none fits,
+             or None if none works. A backend of unknown cost never counts as
+             fitting, it is only picked if no other works.
+    """
+    estimates = {name: estimate(benchmarks[name], pixels) for name in candidates}
+    known = [name for name in candidates if estimates[name] is not None]
+    for name in known:
+        if estimates[name] <= time_budget:
+            return name
+    if known:
+        return min(known, key=estimates.get)
+    return next((name for name in candidates if 'error' not in benchmarks[name]), None)
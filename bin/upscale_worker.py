@@ -0,0 +1,172 @@
+import base64
+import functools
+import http.client
+import json
+import mimetypes
+import pathlib
+import random
+import subprocess
+import time
+
+import http_pool
+
+# Local workers are arbsr-cpu containers serving cog's HTTP prediction API,
+# which keeps the model loaded between requests
+WORKER_IMAGE = 'arbsr-cpu'
+WORKER_NAME = 'bdwc-arbsr'
+WORKER_FIRST_PORT = 5151
+WORKER_START_TIMEOUT = 300
+PREDICTION_TIMEOUT = 60 * 60
+# A worker that can't be reached or answers with something that isn't a
+# prediction is dropped
+ERRORS = (OSError, http.client.HTTPException, ValueError)
+
+
+class WorkerUnavailable(Exception):
+    pass
+
+
+def to_data_uri(path: pathlib.Path):
+    mime_type = mimetypes.guess_type(str(path))[0] or 'application/octet-stream'
+    with open(path, 'rb') as f:
+        return f'data:{mime_type};base64,' + base64.b64encode(f.read()).decode('ascii')
+
+
+def from_data_uri(uri: str):
+    header, _, data = uri.partition(',')
+    if not header.startswith('data:') or not header.endswith(';base64'):
+        raise ValueError(f'Unexpected prediction output: {uri[:64]}')
+    return base64.b64decode(data)
+
+
+def is_ready(base_url: str, timeout: float = 2):
+    """
+    Check whether a worker finished loading its model.
+    """
+    try:
+        response = http_pool.fetch(f'{base_url}/health-check', timeout=timeout)
+        return response.status == 200 and json.loads(response.body).get('status') == 'READY'
+    except ERRORS:
+        return False
+
+
+def predict(base_url: str, path_input: pathlib.Path, target_width: int, target_height: int,
+            path_output: pathlib.Path):
+    """
+    Upscale one image on a worker.
+
+    :raises WorkerUnavailable: If the worker can't be reached or its response is malformed.
+    :return: True if the image was upscaled, False if the worker is busy.
+    """
+    request = {'input': {
+        'image': to_data_uri(path_input),
+        'target_width': target_width,
+        'target_height': target_height,
+    }}
+    try:
+        response = http_pool.fetch(
+            f'{base_url}/predictions', method='POST', timeout=PREDICTION_TIMEOUT,
+            headers={'Content-Type': 'application/json'}, body=json.dumps(request).encode('utf-8'))
+    except ERRORS as err:
+        raise WorkerUnavailable(f'{base_url}: {err}')
+    if response.status == 409:
+        return False
+    if response.status != 200:
+        raise RuntimeError(f'{base_url} returned HTTP {response.status}: {response.body[:200]}')
+
+    try:
+        prediction = json.loads(response.body)
+        if prediction.get('status') != 'succeeded':
+            raise RuntimeError(f'{base_url}: prediction {prediction.get("status")}: {prediction.get("error")}')
+        output = prediction['output']
+        if output.startswith('data:'):
+            data = from_data_uri(output)
+        else:
+            data = http_pool.fetch(output, timeout=PREDICTION_TIMEOUT).body
+    except (*ERRORS, AttributeError, KeyError, TypeError) as err:
+        raise WorkerUnavailable(f'{base_url}: malformed prediction: {err!r}')
+    with open(path_output, 'wb') as f:
+        f.write(data)
+    return True
+
+
+def upscale(path_input: str, target_width: int, target_height: int, directory_working: str = '/tmp',
+            base_urls=(), fallback=None):
+    """
+    Upscale backend (see upscale_arbsr) that uses persistent workers.
+
+    A worker handles one prediction at a time, so tiles are spread over the
+    workers, waiting for as long as all of them are busy. Only if none can be
+    reached is the one-shot fallback backend used instead.
+
+    Bind base_urls and fallback with functools.partial to get a backend that
+    can be passed to upscale_arbsr.upscale_parts, with get_worker_count as its
+    max_workers.
+    """
+    assert pathlib.Path(path_input).exists()
+    path_output = pathlib.Path(directory_working) / 'output.png'
+    path_output.unlink(missing_ok=True)
+
+    base_urls = list(base_urls)
+    random.shuffle(base_urls)
+    while base_urls:
+        for base_url in list(base_urls):
+            try:
+                if predict(base_url, path_input, target_width, target_height, path_output):
+                    return path_output
+            except WorkerUnavailable as err:
+                print(err)
+                base_urls.remove(base_url)
+        if base_urls:
+            time.sleep(1 + random.random())
+
+    if fallback is None:
+        raise WorkerUnavailable('No upscaler worker available')
+    return fallback(path_input, target_width, target_height, directory_working)
+
+
+def get_worker_count(backend):
+    """
+    :return: Number of workers of a backend bound from upscale with functools.partial,
+        None for any other backend.
+    """
+    if isinstance(backend, functools.partial) and backend.func is upscale:
+        return len(backend.keywords.get('base_urls', ())) or None
+    return None
+
+
+def is_container_running(name: str):
+    result = subprocess.run(
+        ['docker', 'inspect', '-f', '{{.State.Running}}', name],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return result.returncode == 0 and result.stdout.strip() == b'true'
+
+
+def ensure_local_workers(count: int = 1, image: str = WORKER_IMAGE, first_port: int = WORKER_FIRST_PORT):
+    """
+    Start local worker containers unless they are already running.
+
+    The containers keep running after this process exits, so later runs (and
+    the tiles of this run) don't pay for container start and model load again.
+
+    :param count: Number of workers, each one holds its own copy of the model.
+    :return: List of worker base URLs.
+    """
+    base_urls = []
+    for i in range(count):
+        name = f'{WORKER_NAME}-{i}'
+        port = first_port + i
+        if not is_container_running(name):
+            subprocess.run(['docker', 'rm', '-f', name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            subprocess.check_call(
+                ['docker', 'run', '-d', '--rm', '--name', name, '-p', f'127.0.0.1:{port}:5000', image],
+                stdout=subprocess.DEVNULL)
+        base_urls.append(f'http://127.0.0.1:{port}')
+
+    deadline = time.monotonic() + WORKER_START_TIMEOUT
+    for base_url in base_urls:
+        while not is_ready(base_url):
+            if time.monotonic() > deadline:
+                raise WorkerUnavailable(f'{base_url} did not become ready')
+            time.sleep(1)
+    return base_urls
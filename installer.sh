@@ -424,9 +424,9 @@ install_system() {
   fi
 
   sudo cp -Rvf * $INSTALLPATH
-  # Restore main.py to original directory
+  # Restore main.py and the modules it imports to the original directory
   sudo mv -vf $INSTALLPATH/bin/main.py $INSTALLPATH/main.py
-  sudo mv -vf $INSTALLPATH/bin/upscale_arbsr.py $INSTALLPATH/upscale_arbsr.py
+  sudo mv -vf "$INSTALLPATH"/bin/*.py "$INSTALLPATH"/
 }
 
 install_set_files() {